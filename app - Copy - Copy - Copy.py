@@ -19,6 +19,39 @@ app.config['SESSION_COOKIE_SECURE'] = False  # Allow HTTP for development
 app.config['SESSION_COOKIE_HTTPONLY'] = True
 app.config['SESSION_COOKIE_SAMESITE'] = 'Lax'
 app.config['PERMANENT_SESSION_LIFETIME'] = 3600  # 1 hour
+app.config['TEMPLATE_VERSION'] = os.environ.get('TEMPLATE_VERSION', '1')  # bump to invalidate cached pages on deploy
+app.config['PAGE_CACHE_MAX_BYTES'] = int(os.environ.get('PAGE_CACHE_MAX_BYTES', 16 * 1024 * 1024))  # per worker
+app.config['PAGE_CACHE_MAX_AGE'] = int(os.environ.get('PAGE_CACHE_MAX_AGE', 300))  # seconds a rendered page is served, see page_cache.py
+app.config['CATEGORY_CACHE_MAX_AGE'] = int(os.environ.get('CATEGORY_CACHE_MAX_AGE', 60))  # seconds before other workers' category writes show, see category_cache.py
+app.config['FACET_CACHE_MAX_AGE'] = int(os.environ.get('FACET_CACHE_MAX_AGE', 60))  # seconds cached sidebar counts live, see facets.py
+app.config['COUNT_CACHE_MAX_AGE'] = int(os.environ.get('COUNT_CACHE_MAX_AGE', 30))  # seconds a listing's total is reused across pages, see pagination.py
+app.config['SUGGEST_INDEX_MAX_AGE'] = int(os.environ.get('SUGGEST_INDEX_MAX_AGE', 600))  # seconds before the typeahead index reloads, see suggest.py
+app.config['CACHE_CONTROL_POLICIES'] = {}  # per-endpoint Cache-Control overrides, see http_cache.py
+app.config['CART_STORE_URL'] = os.environ.get('CART_STORE_URL')  # anonymous carts: memory://, sqlite:///path or redis://, see cart_store.py
+app.config['CART_STORE_TTL'] = int(os.environ.get('CART_STORE_TTL', 7 * 24 * 3600))
+app.config['STOCK_HOLD_TTL'] = int(os.environ.get('STOCK_HOLD_TTL', 900))  # seconds checkout holds stock, see reservations.py
+app.config['STOCK_HOLD_SWEEP_INTERVAL'] = int(os.environ.get('STOCK_HOLD_SWEEP_INTERVAL', 60))  # 0 leaves sweeping to sweep_reservations.py
+app.config['IDEMPOTENCY_TTL'] = int(os.environ.get('IDEMPOTENCY_TTL', 24 * 3600))  # seconds a replayable response is kept, see idempotency.py
+app.config['IDEMPOTENCY_FINGERPRINT_TTL'] = int(os.environ.get('IDEMPOTENCY_FINGERPRINT_TTL', 10))  # same, for requests without a client key (plain form posts)
+app.config['IDEMPOTENCY_LOCK_TIMEOUT'] = int(os.environ.get('IDEMPOTENCY_LOCK_TIMEOUT', 60))  # an unfinished request older than this can be retried
+app.config['PAYMENT_GATEWAY'] = os.environ.get('PAYMENT_GATEWAY', 'live')  # 'local' swaps in the stand-in gateway, see payment_jobs.py
+app.config['PAYMENT_WORKERS'] = int(os.environ.get('PAYMENT_WORKERS', 4))  # gateway calls run on this many threads per worker
+app.config['PAYMENT_QUEUE_SIZE'] = int(os.environ.get('PAYMENT_QUEUE_SIZE', 32))  # payments waiting beyond the running ones are turned away
+app.config['ORDER_EVENTS_SETTLE'] = int(os.environ.get('ORDER_EVENTS_SETTLE', 5))  # seconds an event id gap is waited on, see order_status.py
+app.config['MPESA_CALLBACK_BATCH'] = int(os.environ.get('MPESA_CALLBACK_BATCH', 100))  # callbacks applied per transaction, see mpesa_callbacks.py
+app.config['MPESA_CALLBACK_INTERVAL'] = float(os.environ.get('MPESA_CALLBACK_INTERVAL', 1))  # seconds the worker waits to gather a batch; 0 leaves it to replay_mpesa_callbacks.py
+app.config['MPESA_BASE_URL'] = os.environ.get('MPESA_BASE_URL', 'https://sandbox.safaricom.co.ke')  # fake_daraja.py serves the same API locally
+app.config['MPESA_CONSUMER_KEY'] = os.environ.get('MPESA_CONSUMER_KEY')
+app.config['MPESA_CONSUMER_SECRET'] = os.environ.get('MPESA_CONSUMER_SECRET')
+app.config['MPESA_BUSINESS_SHORTCODE'] = os.environ.get('MPESA_BUSINESS_SHORTCODE')
+app.config['MPESA_PASSKEY'] = os.environ.get('MPESA_PASSKEY')
+app.config['MPESA_CALLBACK_URL'] = os.environ.get('MPESA_CALLBACK_URL')
+app.config['MPESA_CONNECT_TIMEOUT'] = float(os.environ.get('MPESA_CONNECT_TIMEOUT', 3.05))
+app.config['MPESA_TIMEOUT'] = float(os.environ.get('MPESA_TIMEOUT', 10))  # read timeout per Daraja call, see mpesa.py
+app.config['MPESA_RETRIES'] = int(os.environ.get('MPESA_RETRIES', 3))
+app.config['MPESA_BACKOFF'] = float(os.environ.get('MPESA_BACKOFF', 0.5))  # seconds, doubled per retry
+app.config['MPESA_POOL_SIZE'] = int(os.environ.get('MPESA_POOL_SIZE', 10))  # keep-alive connections per worker
+app.config['MPESA_TOKEN_MARGIN'] = int(os.environ.get('MPESA_TOKEN_MARGIN', 60))  # seconds before expiry a cached OAuth token is replaced
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1) # needed for url_for to generate with https
 
 # configure the database
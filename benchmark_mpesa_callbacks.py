@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Benchmark M-Pesa callback ingestion against the old per-callback handler
+
+Records a set of STK callback bodies (2,000 by default, one in ten delivered
+twice the way Daraja sometimes does) to a JSONL file in the temp directory,
+then feeds them to:
+
+- the old handler: look the order up by payment_reference and commit, per callback
+- the callback route: store and acknowledge, then apply in batches of each size given
+
+and prints acknowledgement latency and end-to-end throughput for each. The
+recorded file can be fed to replay_mpesa_callbacks.py.
+
+Usage:
+    python benchmark_mpesa_callbacks.py [callbacks] [batch sizes...]
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+"""
+
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_mpesa_callbacks_benchmark.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ["MPESA_CALLBACK_INTERVAL"] = "0"
+
+import main  # registers the routes
+from app import app, db
+from models import User, Order, PaymentAttempt, PaymentMethod
+from mpesa_callbacks import drain_callbacks
+
+DEFAULT_CALLBACKS = 2000
+DEFAULT_BATCH_SIZES = [1, 25, 100]
+DUPLICATE_RATE = 0.1
+RECORDED_PATH = os.path.join(tempfile.gettempdir(), "mosolar_mpesa_callbacks.jsonl")
+
+
+def recorded_callback(rng, index):
+    """An STK callback body as Daraja sends it; about one in eight is a cancelled prompt"""
+    checkout_request_id = f'ws_CO_{20240101000000 + index}{rng.randint(100000, 999999)}'
+    merchant_request_id = f'{rng.randint(10000, 99999)}-{rng.randint(10000000, 99999999)}-1'
+    if rng.random() < 0.125:
+        callback = {'MerchantRequestID': merchant_request_id, 'CheckoutRequestID': checkout_request_id,
+                    'ResultCode': 1032, 'ResultDesc': 'Request cancelled by user'}
+    else:
+        callback = {
+            'MerchantRequestID': merchant_request_id, 'CheckoutRequestID': checkout_request_id,
+            'ResultCode': 0, 'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': rng.choice([4500, 15000, 32000, 87500])},
+                {'Name': 'MpesaReceiptNumber', 'Value': f'NLJ{rng.randint(1000000, 9999999)}'},
+                {'Name': 'TransactionDate', 'Value': 20240101000000 + index},
+                {'Name': 'PhoneNumber', 'Value': 254700000000 + rng.randint(0, 99999999)},
+            ]},
+        }
+    return json.dumps({'Body': {'stkCallback': callback}})
+
+
+def record_callbacks(count):
+    """Write the deliveries (duplicates included) to RECORDED_PATH"""
+    rng = random.Random(42)
+    bodies = [recorded_callback(rng, index) for index in range(count)]
+    deliveries = bodies + rng.sample(bodies, int(count * DUPLICATE_RATE))
+    rng.shuffle(deliveries)
+    with open(RECORDED_PATH, 'w') as recorded:
+        recorded.writelines(body + '\n' for body in deliveries)
+    return deliveries
+
+
+def seed(deliveries):
+    """Recreate the schema with a pending order and STK attempt per recorded callback"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    payment_method = PaymentMethod(name='M-Pesa', code='mpesa', is_active=True)
+    user = User(username='buyer', email='buyer@example.com', password_hash='x')
+    db.session.add_all([payment_method, user])
+    db.session.flush()
+
+    references = sorted({json.loads(body)['Body']['stkCallback']['CheckoutRequestID'] for body in deliveries})
+    db.session.execute(db.insert(Order), [
+        {'user_id': user.id, 'payment_method_id': payment_method.id, 'total_amount': 15000,
+         'shipping_address': 'Moi Avenue', 'shipping_city': 'Nairobi', 'shipping_country': 'Kenya',
+         'shipping_postal_code': '00100', 'contact_phone': '0700000000',
+         'contact_email': 'buyer@example.com', 'payment_reference': reference}
+        for reference in references
+    ])
+    orders = db.session.query(Order.id, Order.payment_reference).all()
+    db.session.execute(db.insert(PaymentAttempt), [
+        {'order_id': order_id, 'user_id': user.id, 'method': 'mpesa', 'status': 'pending', 'reference': reference}
+        for order_id, reference in orders
+    ])
+    db.session.commit()
+
+
+def legacy_mpesa_callback():
+    """The callback route this replaces: one lookup on payment_reference and one commit per callback"""
+    from flask import jsonify, request
+    result = request.get_json()["Body"]["stkCallback"]
+    if result["ResultCode"] == 0:
+        order = Order.query.filter_by(payment_reference=result["CheckoutRequestID"]).first()
+        if order:
+            order.status = 'paid'
+            db.session.commit()
+    return jsonify({'success': True}), 200
+
+
+# Mounted next to the real route so both pay the same request overhead
+app.add_url_rule('/benchmark/legacy-mpesa-callback', view_func=legacy_mpesa_callback, methods=['POST'])
+
+
+def paid_orders():
+    return Order.query.filter_by(status='paid').count()
+
+
+def post_deliveries(deliveries, url):
+    """POST every recorded body. Returns (per-request seconds, perf_counter at the start)."""
+    client = app.test_client()
+    latencies = []
+    # The callback route prints a DEBUG line per delivery
+    with redirect_stdout(io.StringIO()):
+        started = time.perf_counter()
+        for body in deliveries:
+            request_started = time.perf_counter()
+            client.post(url, data=body, content_type='application/json')
+            latencies.append(time.perf_counter() - request_started)
+    return latencies, started
+
+
+def run_legacy(deliveries):
+    with app.app_context():
+        seed(deliveries)
+    latencies, started = post_deliveries(deliveries, '/benchmark/legacy-mpesa-callback')
+    elapsed = time.perf_counter() - started
+    with app.app_context():
+        return latencies, elapsed, elapsed, paid_orders()
+
+
+def run_ingestion(deliveries, batch_size):
+    with app.app_context():
+        seed(deliveries)
+    latencies, started = post_deliveries(deliveries, '/mpesa/callback')
+    acked = time.perf_counter() - started
+    with app.app_context():
+        drain_callbacks(batch_size)
+        elapsed = time.perf_counter() - started
+        return latencies, acked, elapsed, paid_orders()
+
+
+def run_benchmark(count, batch_sizes):
+    with app.app_context():
+        db.engine.echo = False
+        print(f"Database: {db.engine.dialect.name}")
+    deliveries = record_callbacks(count)
+    print(f"(recorded {len(deliveries):,} deliveries of {count:,} callbacks to {RECORDED_PATH})")
+    print(f"{'handler':>16} {'ack p50 ms':>11} {'ack p95 ms':>11} {'acks/s':>9} {'applied/s':>10} {'paid':>7}")
+    print("-" * 69)
+
+    runs = [('per-callback', lambda: run_legacy(deliveries))]
+    runs += [(f'batch of {size}', lambda size=size: run_ingestion(deliveries, size)) for size in batch_sizes]
+    for name, run in runs:
+        latencies, acked, elapsed, paid = run()
+        latencies.sort()
+        print(f"{name:>16} {statistics.median(latencies) * 1000:>11.2f} "
+              f"{latencies[int(len(latencies) * 0.95) - 1] * 1000:>11.2f} "
+              f"{len(deliveries) / acked:>9,.0f} {len(deliveries) / elapsed:>10,.0f} {paid:>7,}")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_CALLBACKS
+    batch_sizes = [int(arg) for arg in sys.argv[2:]] or DEFAULT_BATCH_SIZES
+    run_benchmark(count, batch_sizes)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Benchmark the full-text product search against the legacy ILIKE scan
+
+Fills a scratch database with synthetic products (10k, 100k and 1M rows by
+default) and times both search paths for a handful of typical queries.
+
+Usage:
+    python benchmark_search.py [sizes...]
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it deletes products.
+"""
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_search_benchmark.db")
+)
+
+from app import app, db
+from models import Category, Product
+from search import apply_product_search, ensure_search_index, rebuild_search_index
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+QUERIES = ['solar', 'inverter 5kw', 'lifepo4 battery', 'mounting', 'flood light 30w']
+RUNS = 5
+PAGE_SIZE = 12
+
+BRANDS = ['Mo Solar', 'Must', 'Neelux', 'AquaHeat', 'Seven Stars', 'V380', 'DAT', 'Felicity', 'Growatt']
+KINDS = ['Solar Panel', 'Inverter', 'LiFePO4 Battery', 'Water Heater', 'Flood Light',
+         'Charge Controller', 'Security Camera', 'Mounting Kit', 'DC Cable Set']
+RATINGS = ['30W', '100W', '250W', '550W', '3kW', '5kW', '100Ah', '200Ah', '150L', '200L', '30A']
+WORDS = ['high', 'efficiency', 'monocrystalline', 'waterproof', 'durable', 'warranty', 'residential',
+         'commercial', 'pure', 'sine', 'wave', 'lcd', 'display', 'mppt', 'grid', 'tie', 'backup',
+         'outdoor', 'uv', 'resistant', 'pressurized', 'tank', 'vacuum', 'tubes', 'motion', 'night']
+
+
+def synthetic_rows(count, category_id, start=0):
+    """Generate product rows for bulk insertion"""
+    rng = random.Random(42 + start)
+    for i in range(start, start + count):
+        name = f"{rng.choice(BRANDS)} {rng.choice(RATINGS)} {rng.choice(KINDS)}"
+        yield {
+            'name': name,
+            'description': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(12, 40))),
+            'price': rng.randint(500, 150000),
+            'stock': rng.randint(0, 80),
+            'slug': f'bench-product-{i}',
+            'featured': False,
+            'category_id': category_id,
+        }
+
+
+def load_catalog(size):
+    """Replace the products table with `size` synthetic products"""
+    db.session.execute(db.delete(Product))
+    category = Category.query.filter_by(slug='benchmark').first()
+    if not category:
+        category = Category(name='Benchmark', slug='benchmark')
+        db.session.add(category)
+        db.session.flush()
+
+    batch = 10_000
+    for start in range(0, size, batch):
+        rows = list(synthetic_rows(min(batch, size - start), category.id, start))
+        db.session.execute(db.insert(Product), rows)
+
+    rebuild_search_index()
+    db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        db.session.execute(db.text("ANALYZE products"))
+        db.session.execute(db.text("ANALYZE product_search"))
+        db.session.commit()
+
+
+def time_query(build_query):
+    """Median wall time in milliseconds for fetching the first page of results"""
+    timings = []
+    for _ in range(RUNS):
+        started = time.perf_counter()
+        query = build_query()
+        query.limit(PAGE_SIZE).all()
+        query.order_by(None).count()
+        timings.append((time.perf_counter() - started) * 1000)
+        db.session.rollback()
+    return statistics.median(timings)
+
+
+def ilike_query(search_query):
+    pattern = f'%{search_query}%'
+    return Product.query.filter(Product.name.ilike(pattern) | Product.description.ilike(pattern)) \
+        .order_by(Product.name.asc())
+
+
+def fulltext_query(search_query):
+    query, rank = apply_product_search(Product.query, search_query)
+    if rank is not None:
+        query = query.order_by(rank.desc(), Product.id)
+    return query
+
+
+def run_benchmark(sizes):
+    with app.app_context():
+        db.engine.echo = False
+        ensure_search_index()
+
+        print(f"Database: {db.engine.dialect.name}")
+        print(f"{'products':>10}  {'query':<18} {'ilike ms':>10} {'fts ms':>10} {'speedup':>8}")
+        print("-" * 62)
+
+        for size in sizes:
+            started = time.perf_counter()
+            load_catalog(size)
+            print(f"(loaded {size:,} products in {time.perf_counter() - started:.1f}s)")
+
+            for search_query in QUERIES:
+                ilike_ms = time_query(lambda: ilike_query(search_query))
+                fts_ms = time_query(lambda: fulltext_query(search_query))
+                speedup = ilike_ms / fts_ms if fts_ms else float('inf')
+                print(f"{size:>10,}  {search_query:<18} {ilike_ms:>10.2f} {fts_ms:>10.2f} {speedup:>7.1f}x")
+
+
+if __name__ == "__main__":
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    run_benchmark(sizes)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Benchmark the search-as-you-type prefix index under concurrent keystrokes
+
+Builds an in-memory suggestion index over synthetic products (100k by
+default) and replays typing sessions from several threads at once, one
+lookup per keystroke, while a writer thread keeps patching products the way
+catalog writes do. Prints lookup latency percentiles per thread count.
+
+Usage:
+    python benchmark_suggest.py [products] [threads...]
+
+The database is not touched; DATABASE_URL only needs to be importable and
+defaults to a throwaway SQLite file in the temp directory.
+"""
+
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_suggest_benchmark.db")
+)
+
+from suggest import PrefixIndex, category_suggestion, product_suggestion
+
+DEFAULT_PRODUCTS = 100_000
+DEFAULT_THREADS = [1, 4, 16]
+SESSIONS_PER_THREAD = 200
+LIMIT = 8
+
+BRANDS = ['Mo Solar', 'Must', 'Neelux', 'AquaHeat', 'Seven Stars', 'V380', 'DAT', 'Felicity', 'Growatt']
+KINDS = ['Solar Panel', 'Inverter', 'LiFePO4 Battery', 'Water Heater', 'Flood Light',
+         'Charge Controller', 'Security Camera', 'Mounting Kit', 'DC Cable Set']
+RATINGS = ['30W', '100W', '250W', '550W', '3kW', '5kW', '100Ah', '200Ah', '150L', '200L', '30A']
+TYPED = ['solar panel', 'inverter 5kw', 'lifepo4', 'mo solar 550w', 'flood light', 'growatt',
+         'water heater 200l', 'security cam', 'mounting', 'charge controller 30a', 'seven stars']
+
+
+def synthetic_product(rng, product_id):
+    name = f"{rng.choice(BRANDS)} {rng.choice(RATINGS)} {rng.choice(KINDS)}"
+    return product_suggestion(product_id, name, f'bench-product-{product_id}',
+                              rng.random() < 0.05, rng.randint(0, 80))
+
+
+def build_index(size):
+    rng = random.Random(42)
+    index = PrefixIndex()
+    suggestions = [synthetic_product(rng, product_id) for product_id in range(1, size + 1)]
+    suggestions += [category_suggestion(i, kind + 's', kind.lower().replace(' ', '-'))
+                    for i, kind in enumerate(KINDS, 1)]
+    index.build(suggestions)
+    return index
+
+
+def typist(index, seed, timings):
+    """Type whole queries one character at a time, looking up every prefix"""
+    rng = random.Random(seed)
+    for _ in range(SESSIONS_PER_THREAD):
+        query = rng.choice(TYPED)
+        for length in range(1, len(query) + 1):
+            started = time.perf_counter()
+            index.lookup(query[:length], LIMIT)
+            timings.append((time.perf_counter() - started) * 1_000_000)
+
+
+def writer(index, size, stop):
+    """Patch about 50 products a second until told to stop, like admin edits and stock updates"""
+    rng = random.Random(7)
+    writes = 0
+    while not stop.is_set():
+        index.upsert(synthetic_product(rng, rng.randint(1, size)))
+        writes += 1
+        time.sleep(0.02)
+    return writes
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def run_benchmark(size, thread_counts):
+    started = time.perf_counter()
+    index = build_index(size)
+    print(f"(indexed {len(index):,} entries in {time.perf_counter() - started:.1f}s)")
+    print(f"{'threads':>8} {'lookups':>9} {'p50 us':>8} {'p95 us':>8} {'p99 us':>8} {'max us':>9} {'lookups/s':>10}")
+    print("-" * 66)
+
+    for thread_count in thread_counts:
+        timings = [[] for _ in range(thread_count)]
+        stop = threading.Event()
+        background = threading.Thread(target=writer, args=(index, size, stop))
+        threads = [threading.Thread(target=typist, args=(index, seed, timings[seed]))
+                   for seed in range(thread_count)]
+
+        background.start()
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+        stop.set()
+        background.join()
+
+        samples = sorted(timing for thread_timings in timings for timing in thread_timings)
+        print(f"{thread_count:>8} {len(samples):>9,} {statistics.median(samples):>8.1f} "
+              f"{percentile(samples, 0.95):>8.1f} {percentile(samples, 0.99):>8.1f} "
+              f"{samples[-1]:>9.1f} {len(samples) / elapsed:>10,.0f}")
+
+
+if __name__ == "__main__":
+    size = int(sys.argv[1]) if len(sys.argv) > 1 else DEFAULT_PRODUCTS
+    thread_counts = [int(arg) for arg in sys.argv[2:]] or DEFAULT_THREADS
+    run_benchmark(size, thread_counts)
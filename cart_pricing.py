@@ -0,0 +1,175 @@
+"""
+Cart pricing
+
+Prices a cart in the database: one aggregate query returns every line with
+its product and subtotal, and window sums over the same rows give the grand
+total, the item count and whether everything is in stock. Amounts come back
+as Decimal, rounded to the cent, so the cart page, checkout and the order
+written from it all agree on the same figures.
+"""
+from collections import namedtuple
+from decimal import Decimal, ROUND_HALF_UP
+
+from app import db
+from models import Cart, CartItem, Product
+
+CENT = Decimal('0.01')
+
+# One row of a priced cart; item is the CartItem for database carts, None for session carts
+PricedLine = namedtuple('PricedLine', ['id', 'item', 'product', 'quantity', 'unit_price', 'subtotal', 'in_stock'])
+
+
+def money(value):
+    """Round an amount to the cent as a Decimal"""
+    if value is None:
+        value = 0
+    elif isinstance(value, float):
+        value = str(value)  # SQLite hands back REAL arithmetic
+    return Decimal(value).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+class CartSummary:
+    """Priced cart: lines, grand total, item count and stock availability"""
+
+    def __init__(self, cart_id=None):
+        self.cart_id = cart_id
+        self.lines = []
+        # CartItems (or session product ids) whose product is gone, or short of stock when stock is required
+        self.unavailable = []
+        self.total = money(0)
+        self.count = 0
+        self.in_stock = True
+
+    def line(self, line_id):
+        """The priced line with the given id, or None"""
+        return next((line for line in self.lines if line.id == line_id), None)
+
+    def __bool__(self):
+        return bool(self.lines)
+
+
+def _priced_rows(query, quantity, available):
+    """
+    Add the pricing columns to a query over products.
+
+    Args:
+        query: query selecting the entities each line needs
+        quantity: column or expression holding the line quantity
+        available: SQL condition for a line counting towards the totals
+    """
+    subtotal = Product.price * quantity
+    # Empty OVER (): each window sum runs over the whole cart
+    return query.add_columns(
+        Product.price.label('unit_price'),
+        subtotal.label('subtotal'),
+        (Product.stock >= quantity).label('in_stock'),
+        db.func.sum(db.case((available, subtotal), else_=0)).over().label('total'),
+        db.func.sum(db.case((available, quantity), else_=0)).over().label('count'),
+        db.func.min(db.case((Product.stock >= quantity, 1), else_=0)).over().label('all_in_stock'),
+    )
+
+
+def _fill(summary, row):
+    summary.total = money(row.total)
+    summary.count = int(row.count or 0)
+    summary.in_stock = bool(row.all_in_stock)
+
+
+def price_user_cart(user_id, require_stock=False):
+    """
+    Price a user's database cart with one query.
+
+    Args:
+        user_id: owner of the cart
+        require_stock: treat lines whose quantity exceeds the stock as unavailable
+
+    Returns:
+        CartSummary
+    """
+    available = Product.id.isnot(None)
+    if require_stock:
+        available = db.and_(available, Product.stock >= CartItem.quantity)
+
+    query = db.session.query(CartItem, Product) \
+        .join(Cart, Cart.id == CartItem.cart_id) \
+        .outerjoin(Product, Product.id == CartItem.product_id) \
+        .filter(Cart.user_id == user_id) \
+        .order_by(CartItem.id)
+    rows = _priced_rows(query, CartItem.quantity, available).all()
+
+    summary = CartSummary(rows[0].CartItem.cart_id if rows else None)
+    for row in rows:
+        item, product = row.CartItem, row.Product
+        if product is None or (require_stock and not row.in_stock):
+            summary.unavailable.append(item)
+            continue
+        summary.lines.append(PricedLine(item.id, item, product, item.quantity,
+                                        money(row.unit_price), money(row.subtotal), bool(row.in_stock)))
+    if rows:
+        _fill(summary, rows[0])
+    return summary
+
+
+def price_session_cart(cart_data, require_stock=False):
+    """
+    Price an anonymous cart kept in the session ({product_id: {'quantity': n}}) with one query.
+
+    The quantities travel into the query as a CASE on the product id, so the
+    database does the arithmetic exactly as it does for database carts.
+
+    Args:
+        cart_data: the session cart
+        require_stock: treat lines whose quantity exceeds the stock as unavailable
+
+    Returns:
+        CartSummary
+    """
+    summary = CartSummary()
+    quantities = {}
+    for product_id, item in cart_data.items():
+        try:
+            quantities[int(product_id)] = int(item.get('quantity', 1))
+        except (AttributeError, TypeError, ValueError):
+            summary.unavailable.append(product_id)
+    if not quantities:
+        return summary
+
+    quantity = db.case(quantities, value=Product.id, else_=0)
+    available = Product.stock >= quantity if require_stock else db.true()
+
+    query = db.session.query(Product) \
+        .filter(Product.id.in_(quantities)) \
+        .order_by(Product.id)
+    rows = _priced_rows(query, quantity, available).all()
+
+    found = set()
+    for row in rows:
+        product = row.Product
+        found.add(product.id)
+        if require_stock and not row.in_stock:
+            summary.unavailable.append(str(product.id))
+            continue
+        summary.lines.append(PricedLine(f"session_{product.id}", None, product, quantities[product.id],
+                                        money(row.unit_price), money(row.subtotal), bool(row.in_stock)))
+    summary.unavailable.extend(str(product_id) for product_id in quantities if product_id not in found)
+    if rows:
+        _fill(summary, rows[0])
+    return summary
+
+
+def cart_summary_json(summary):
+    """JSON-ready form of a CartSummary, amounts as numbers like the other cart endpoints"""
+    return {
+        'lines': [{
+            'id': line.id,
+            'product_id': line.product.id,
+            'name': line.product.name,
+            'quantity': line.quantity,
+            'unit_price': float(line.unit_price),
+            'subtotal': float(line.subtotal),
+            'in_stock': line.in_stock,
+        } for line in summary.lines],
+        'total': float(summary.total),
+        'count': summary.count,
+        'in_stock': summary.in_stock,
+    }
@@ -0,0 +1,177 @@
+"""
+Cart writes and counts
+
+Adding to a cart, batch quantity updates and the login merge write every
+line in a fixed number of statements however many lines there are. Reading a cart together with its
+prices lives in cart_pricing.py.
+
+Database carts carry a denormalized item_count that every cart write
+refreshes, so the cart badge is a single-column read. Session carts are
+counted in memory.
+"""
+from sqlalchemy.orm import joinedload
+
+from app import db
+from db_helpers import upsert_increment
+from models import Cart, CartItem, Product
+
+
+def load_cart_item(item_id):
+    """A cart item with its cart and product, or None"""
+    return CartItem.query \
+        .options(joinedload(CartItem.cart), joinedload(CartItem.product)) \
+        .filter_by(id=item_id) \
+        .first()
+
+
+def add_to_user_cart(user_id, quantities):
+    """
+    Add quantities to a user's database cart, creating the cart if needed.
+
+    Product ids are validated with one query and every line is written with
+    one INSERT ... ON CONFLICT (cart_id, product_id) DO UPDATE that adds to
+    the existing quantity, so the cost doesn't grow with the number of lines.
+    Unknown products and non-positive quantities are skipped. Runs in the
+    caller's transaction.
+
+    Args:
+        user_id: owner of the cart
+        quantities: {product_id: quantity to add}
+
+    Returns:
+        int: number of cart lines written
+    """
+    quantities = {product_id: quantity for product_id, quantity in quantities.items() if quantity > 0}
+    if not quantities:
+        return 0
+
+    cart_id = db.session.query(Cart.id).filter_by(user_id=user_id).scalar()
+    if cart_id is None:
+        cart = Cart(user_id=user_id)
+        db.session.add(cart)
+        db.session.flush()
+        cart_id = cart.id
+
+    existing = {row.id for row in db.session.query(Product.id).filter(Product.id.in_(quantities))}
+    rows = [
+        {'cart_id': cart_id, 'product_id': product_id, 'quantity': quantity}
+        for product_id, quantity in quantities.items() if product_id in existing
+    ]
+    upsert_increment(CartItem, rows, ['cart_id', 'product_id'], ['quantity'])
+    refresh_item_counts(cart_ids=[cart_id])
+    return len(rows)
+
+
+def merge_session_cart(user_id, cart_data):
+    """
+    Move an anonymous session cart into the user's database cart at login.
+
+    Returns:
+        int: number of cart lines written
+    """
+    quantities = {}
+    for product_id, item in cart_data.items():
+        try:
+            product_id, quantity = int(product_id), int(item.get('quantity', 1))
+        except (AttributeError, TypeError, ValueError):
+            continue
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+    return add_to_user_cart(user_id, quantities)
+
+
+def update_user_cart_lines(user_id, quantities):
+    """
+    Set or remove many lines of a user's database cart at once.
+
+    Ownership and stock for every line are checked with one query; if any
+    line fails nothing is written. Otherwise removals go out as one DELETE
+    and new quantities as one UPDATE ... CASE. Runs in the caller's
+    transaction.
+
+    Args:
+        user_id: owner of the cart
+        quantities: {cart_item_id: new quantity}, 0 removes the line
+
+    Returns:
+        list: one {'item_id', 'message', 'available'} dict per rejected line, empty on success
+    """
+    if not quantities:
+        return []
+
+    rows = db.session.query(CartItem.id, CartItem.cart_id, Product.stock) \
+        .join(Cart, Cart.id == CartItem.cart_id) \
+        .outerjoin(Product, Product.id == CartItem.product_id) \
+        .filter(Cart.user_id == user_id, CartItem.id.in_(quantities)) \
+        .all()
+    found = {row.id: row for row in rows}
+
+    errors = []
+    for item_id, quantity in quantities.items():
+        row = found.get(item_id)
+        if row is None:
+            errors.append({'item_id': str(item_id), 'message': 'Item not found', 'available': 0})
+        elif quantity > 0 and (row.stock or 0) < quantity:
+            errors.append({'item_id': str(item_id), 'message': f'Only {row.stock or 0} units available',
+                           'available': row.stock or 0})
+    if errors:
+        return errors
+
+    removed = [item_id for item_id, quantity in quantities.items() if quantity <= 0]
+    changed = {item_id: quantity for item_id, quantity in quantities.items() if quantity > 0}
+    if removed:
+        db.session.query(CartItem).filter(CartItem.id.in_(removed)).delete(synchronize_session=False)
+    if changed:
+        db.session.execute(
+            db.update(CartItem)
+            .where(CartItem.id.in_(changed))
+            .values(quantity=db.case(changed, value=CartItem.id)),
+            execution_options={'synchronize_session': False}
+        )
+    refresh_item_counts(cart_ids={row.cart_id for row in rows})
+    return []
+
+
+def refresh_item_counts(cart_ids=None, user_id=None):
+    """
+    Recompute Cart.item_count from the cart's lines with one UPDATE.
+
+    Call after any write to cart_items, inside the same transaction. Counting
+    in SQL rather than adding deltas keeps the counter right when requests
+    for the same cart interleave.
+    """
+    if cart_ids is not None:
+        cart_ids = list(cart_ids)
+    if not cart_ids and user_id is None:
+        return
+    db.session.flush()
+
+    quantity = db.select(db.func.coalesce(db.func.sum(CartItem.quantity), 0)) \
+        .where(CartItem.cart_id == Cart.id) \
+        .scalar_subquery()
+    stmt = db.update(Cart).values(item_count=quantity)
+    if cart_ids is not None:
+        stmt = stmt.where(Cart.id.in_(cart_ids))
+    if user_id is not None:
+        stmt = stmt.where(Cart.user_id == user_id)
+    db.session.execute(stmt, execution_options={'synchronize_session': False})
+
+
+def user_cart_count(user_id):
+    """Total quantity in a user's cart: one indexed read of the maintained counter"""
+    row = db.session.query(Cart.item_count).filter_by(user_id=user_id).first()
+    return row.item_count if row else 0
+
+
+def session_cart_count(cart_data):
+    """Total quantity of a session cart, counted in memory"""
+    return sum(item.get('quantity', 0) for item in cart_data.values())
+
+
+def cart_version(user_id):
+    """The user's cart lines as a string, e.g. '3x1,7x2' (product x quantity); changes whenever the cart does"""
+    lines = db.session.query(CartItem.product_id, CartItem.quantity) \
+        .join(Cart, Cart.id == CartItem.cart_id) \
+        .filter(Cart.user_id == user_id) \
+        .order_by(CartItem.product_id) \
+        .all()
+    return ','.join(f'{product_id}x{quantity}' for product_id, quantity in lines)
@@ -0,0 +1,261 @@
+"""
+Server-side store for anonymous carts
+
+Anonymous carts used to live in Flask's signed session cookie, which grew
+with every product and was re-signed on every request. Now the cookie only
+carries an opaque cart id and the lines live here, behind a small key-value
+interface:
+
+    memory://                   per-process dict, for tests and single-worker dev
+    sqlite:///path/to/carts.db  file shared by every worker on one host
+    redis://host:6379/0         shared by every worker everywhere (needs the redis package)
+
+Entries expire ttl seconds after their last write. Carts are stored in a
+compact text encoding, "product_id:quantity" pairs joined by commas, and come
+back in the shape the cart code uses: {product_id (str): {'quantity': n}}.
+"""
+import os
+import secrets
+import sqlite3
+import tempfile
+import threading
+import time
+
+from flask import g, session
+
+from app import app
+
+SESSION_KEY = 'cart_id'
+# Old cookie-held carts, moved into the store the first time they're seen
+LEGACY_SESSION_KEY = 'cart'
+
+
+def encode_cart(cart):
+    """Encode a cart as "product_id:quantity,..." """
+    return ','.join(f"{int(product_id)}:{int(item.get('quantity', 1))}" for product_id, item in cart.items())
+
+
+def decode_cart(raw):
+    """Decode encode_cart() output, skipping malformed pairs"""
+    if isinstance(raw, bytes):
+        raw = raw.decode('ascii')
+    cart = {}
+    for pair in (raw or '').split(','):
+        product_id, _, quantity = pair.partition(':')
+        if product_id.isdigit() and quantity.isdigit():
+            cart[product_id] = {'quantity': int(quantity)}
+    return cart
+
+
+class CartStore:
+    """Interface every backend implements; carts are passed in and out already encoded"""
+
+    def __init__(self, ttl=7 * 24 * 3600):
+        self.ttl = ttl
+
+    def get(self, cart_id):
+        """Encoded cart, or None when missing or expired"""
+        raise NotImplementedError
+
+    def set(self, cart_id, encoded):
+        """Store an encoded cart, resetting its expiry"""
+        raise NotImplementedError
+
+    def delete(self, cart_id):
+        raise NotImplementedError
+
+    def purge_expired(self):
+        """Drop expired entries. Returns how many were removed."""
+        return 0
+
+    def load(self, cart_id):
+        return decode_cart(self.get(cart_id)) if cart_id else {}
+
+    def save(self, cart_id, cart):
+        if cart:
+            self.set(cart_id, encode_cart(cart))
+        else:
+            self.delete(cart_id)
+
+
+class MemoryCartStore(CartStore):
+    """Per-process store; expired entries are dropped on read and swept every sweep_every writes"""
+
+    def __init__(self, ttl=7 * 24 * 3600, sweep_every=1000):
+        super().__init__(ttl)
+        self.sweep_every = sweep_every
+        self._lock = threading.Lock()
+        self._entries = {}  # cart_id -> (encoded, expires_at)
+        self._writes = 0
+
+    def get(self, cart_id):
+        with self._lock:
+            entry = self._entries.get(cart_id)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[cart_id]
+                return None
+            return entry[0]
+
+    def set(self, cart_id, encoded):
+        with self._lock:
+            self._entries[cart_id] = (encoded, time.time() + self.ttl)
+            self._writes += 1
+            sweep = self._writes % self.sweep_every == 0
+        if sweep:
+            self.purge_expired()
+
+    def delete(self, cart_id):
+        with self._lock:
+            self._entries.pop(cart_id, None)
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [cart_id for cart_id, (_, expires_at) in self._entries.items() if expires_at <= now]
+            for cart_id in expired:
+                del self._entries[cart_id]
+        return len(expired)
+
+
+class SQLiteCartStore(CartStore):
+    """Store in a SQLite file, one connection per thread, shared by every worker on the host"""
+
+    def __init__(self, path, ttl=7 * 24 * 3600, sweep_every=1000):
+        super().__init__(ttl)
+        self.path = path
+        self.sweep_every = sweep_every
+        self._local = threading.local()
+        self._writes = 0
+        with self._connection() as connection:
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS anonymous_carts "
+                "(cart_id TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE INDEX IF NOT EXISTS ix_anonymous_carts_expires_at ON anonymous_carts (expires_at)"
+            )
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def get(self, cart_id):
+        row = self._connection().execute(
+            "SELECT data FROM anonymous_carts WHERE cart_id = ? AND expires_at > ?", (cart_id, time.time())
+        ).fetchone()
+        return row[0] if row else None
+
+    def set(self, cart_id, encoded):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT INTO anonymous_carts (cart_id, data, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (cart_id) DO UPDATE SET data = excluded.data, expires_at = excluded.expires_at",
+                (cart_id, encoded, time.time() + self.ttl)
+            )
+        self._writes += 1
+        if self._writes % self.sweep_every == 0:
+            self.purge_expired()
+
+    def delete(self, cart_id):
+        with self._connection() as connection:
+            connection.execute("DELETE FROM anonymous_carts WHERE cart_id = ?", (cart_id,))
+
+    def purge_expired(self):
+        with self._connection() as connection:
+            return connection.execute("DELETE FROM anonymous_carts WHERE expires_at <= ?", (time.time(),)).rowcount
+
+
+class RedisCartStore(CartStore):
+    """Store in Redis; expiry is left to Redis itself"""
+
+    def __init__(self, url, ttl=7 * 24 * 3600, prefix='cart:'):
+        super().__init__(ttl)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("CART_STORE_URL points at Redis but the redis package is not installed")
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url)
+
+    def get(self, cart_id):
+        return self._client.get(self.prefix + cart_id)
+
+    def set(self, cart_id, encoded):
+        self._client.set(self.prefix + cart_id, encoded, ex=self.ttl)
+
+    def delete(self, cart_id):
+        self._client.delete(self.prefix + cart_id)
+
+
+def cart_store_from_url(url, ttl=7 * 24 * 3600):
+    """
+    Build the backend named by a CART_STORE_URL.
+
+    Args:
+        url: memory://, sqlite:///path or redis://...
+        ttl: seconds an untouched cart is kept
+
+    Returns:
+        CartStore
+    """
+    if url.startswith('memory://'):
+        return MemoryCartStore(ttl=ttl)
+    if url.startswith('sqlite:///'):
+        return SQLiteCartStore(url[len('sqlite:///'):], ttl=ttl)
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisCartStore(url, ttl=ttl)
+    raise ValueError(f"Unsupported CART_STORE_URL: {url}")
+
+
+cart_store = cart_store_from_url(
+    app.config.get('CART_STORE_URL') or 'sqlite:///' + os.path.join(tempfile.gettempdir(), 'mosolar_carts.db'),
+    ttl=app.config.get('CART_STORE_TTL', 7 * 24 * 3600)
+)
+
+
+def anonymous_cart():
+    """
+    The current visitor's cart, loaded once per request.
+
+    Returns:
+        dict: {product_id (str): {'quantity': n}}, empty when there is none
+    """
+    if 'anonymous_cart' not in g:
+        cart_id = session.get(SESSION_KEY)
+        cart = cart_store.load(cart_id)
+        legacy = session.pop(LEGACY_SESSION_KEY, None) if LEGACY_SESSION_KEY in session else None
+        if legacy:
+            for product_id, item in legacy.items():
+                line = cart.setdefault(str(product_id), {'quantity': 0})
+                line['quantity'] += item.get('quantity', 1)
+            save_anonymous_cart(cart)
+        elif cart_id and not cart:
+            # Expired or lost: stop pointing at it so the visitor is anonymous again
+            session.pop(SESSION_KEY, None)
+        g.anonymous_cart = cart
+    return g.anonymous_cart
+
+
+def save_anonymous_cart(cart):
+    """Store the visitor's cart, giving them a cart id on first write; an empty cart is deleted"""
+    cart_id = session.get(SESSION_KEY)
+    if cart:
+        if not cart_id:
+            cart_id = session[SESSION_KEY] = secrets.token_urlsafe(16)
+        cart_store.save(cart_id, cart)
+    elif cart_id:
+        cart_store.delete(cart_id)
+        session.pop(SESSION_KEY, None)
+    g.anonymous_cart = cart
+
+
+def clear_anonymous_cart():
+    """Forget the visitor's cart, e.g. once it has been merged into their account"""
+    save_anonymous_cart({})
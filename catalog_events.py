@@ -0,0 +1,70 @@
+"""
+In-process notifications for catalog writes
+
+Caches and indexes that derive data from the products table register a
+listener here; routes that write products call products_changed() after
+committing.
+
+Listing ETags also need to change when a product is deleted, which leaves
+max(updated_at) where it was. The catalog_version row is bumped inside the
+transaction of every product insert or delete, from any worker or script
+(ORM flushes and bulk insert()/delete() statements alike), so
+catalog_version() reads the same value everywhere and the listings need no
+COUNT(*) per request.
+"""
+from itertools import chain
+
+from sqlalchemy import event
+
+from app import db
+from db_helpers import dialect_insert
+from models import CatalogVersion, Product
+
+_listeners = []
+
+
+def on_products_changed(listener):
+    """Register listener(product_ids) to be called after product writes"""
+    _listeners.append(listener)
+    return listener
+
+
+def catalog_version():
+    """Scalar subquery reading the shared catalog version (0 before the first product write)"""
+    return db.select(db.func.coalesce(db.func.max(CatalogVersion.version), 0)).scalar_subquery()
+
+
+def bump_catalog_version(connection):
+    """Add one to the catalog version on the given connection, i.e. in its transaction"""
+    stmt = dialect_insert(CatalogVersion)
+    if stmt is not None:
+        stmt = stmt.values(id=1, version=1)
+        connection.execute(stmt.on_conflict_do_update(
+            index_elements=['id'], set_={'version': CatalogVersion.version + 1}))
+        return
+
+    bumped = connection.execute(db.update(CatalogVersion).where(CatalogVersion.id == 1)
+                                .values(version=CatalogVersion.version + 1))
+    if not bumped.rowcount:
+        connection.execute(db.insert(CatalogVersion).values(id=1, version=1))
+
+
+def products_changed(product_ids):
+    """Notify every listener that the given products were written"""
+    product_ids = [int(product_id) for product_id in product_ids]
+    for listener in _listeners:
+        listener(product_ids)
+
+
+@event.listens_for(db.session, 'after_flush')
+def _products_flushed(session, flush_context):
+    # new and deleted still hold the pre-flush objects here
+    if any(isinstance(obj, Product) for obj in chain(session.new, session.deleted)):
+        bump_catalog_version(session.connection())
+
+
+@event.listens_for(db.session, 'do_orm_execute')
+def _bulk_product_write(orm_execute_state):
+    mapper = orm_execute_state.bind_mapper
+    if (orm_execute_state.is_insert or orm_execute_state.is_delete) and mapper is not None and mapper.class_ is Product:
+        bump_catalog_version(orm_execute_state.session.connection())
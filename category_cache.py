@@ -0,0 +1,130 @@
+"""
+Per-worker cache of the categories table
+
+The category list and slug lookups are served from memory. A version counter
+is bumped whenever this worker writes a category (on flush and again on
+commit), which forces the next read to reload. Writes made by other workers
+are picked up once the cached copy is older than CATEGORY_CACHE_MAX_AGE
+seconds.
+
+Lookups return CachedCategory tuples, not Category models. They carry the
+same columns and a .products list, but they are shared between requests and
+not attached to a session: code that edits a category loads the model.
+"""
+import threading
+import time
+from collections import namedtuple
+
+from sqlalchemy import event
+
+from app import app, db
+from models import Category, Product
+
+class CachedCategory(namedtuple('CachedCategory', ['id', 'name', 'slug', 'description'])):
+    """Read-only stand-in for a Category row, with the model's columns"""
+    __slots__ = ()
+
+    @property
+    def products(self):
+        """The category's products, queried on each access like Category.products (lazy=True)"""
+        return Product.query.filter_by(category_id=self.id).all()
+
+
+class CategoryCache:
+    """Versioned in-memory copy of the categories table"""
+
+    def __init__(self, max_age=60):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._version = 0
+        self._loaded_version = None
+        self._loaded_at = 0.0
+        self._categories = ()
+        self._by_slug = {}
+        self._by_id = {}
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        """Mark the cached copy as stale"""
+        with self._lock:
+            self._version += 1
+
+    def _snapshot(self):
+        with self._lock:
+            if self._loaded_version == self._version and time.monotonic() - self._loaded_at < self.max_age:
+                self.hits += 1
+                return self._categories, self._by_slug, self._by_id
+            self.misses += 1
+            version = self._version
+
+        rows = db.session.query(
+            Category.id, Category.name, Category.slug, Category.description
+        ).order_by(Category.id).all()
+
+        categories = tuple(CachedCategory(*row) for row in rows)
+        by_slug = {category.slug: category for category in categories}
+        by_id = {category.id: category for category in categories}
+
+        with self._lock:
+            # Don't publish a copy that was invalidated while it was loading
+            if self._version == version:
+                self._categories, self._by_slug, self._by_id = categories, by_slug, by_id
+                self._loaded_version = version
+                self._loaded_at = time.monotonic()
+
+        return categories, by_slug, by_id
+
+    def all(self):
+        """All categories, ordered by id"""
+        return list(self._snapshot()[0])
+
+    def get(self, category_id):
+        """Category by id, or None"""
+        return self._snapshot()[2].get(category_id)
+
+    def get_by_slug(self, slug):
+        """Category by slug, or None"""
+        return self._snapshot()[1].get(slug)
+
+    def id_for_slug(self, slug):
+        """Id of the category with this slug, or None"""
+        category = self.get_by_slug(slug)
+        return category.id if category else None
+
+    def stats(self):
+        """Hit/miss counters for this worker"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'version': self._version,
+                'size': len(self._categories),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_version is not None else None,
+            }
+
+
+category_cache = CategoryCache(max_age=app.config.get('CATEGORY_CACHE_MAX_AGE', 60))
+
+
+def _category_written(mapper, connection, target):
+    category_cache.invalidate()
+    db.session.info['categories_written'] = True
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Category, _event_name, _category_written)
+
+
+@event.listens_for(db.session, 'after_commit')
+def _categories_committed(session):
+    # Invalidate again so a reload that raced the commit can't stick
+    if session.info.pop('categories_written', False):
+        category_cache.invalidate()
+
+
+@event.listens_for(db.session, 'after_soft_rollback')
+def _categories_rolled_back(session, previous_transaction):
+    session.info.pop('categories_written', False)
@@ -0,0 +1,71 @@
+"""
+Dialect-aware write helpers
+"""
+from sqlalchemy import tuple_
+
+from app import db
+
+
+def dialect_insert(model):
+    """
+    INSERT construct with ON CONFLICT support for the current database.
+
+    Returns None when the dialect has no native upsert.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert(model)
+
+
+def upsert_increment(model, rows, key_columns, counter_columns, chunk_size=1000):
+    """
+    Insert rows, or add their counter values onto rows that already exist.
+
+    Uses a multi-row INSERT ... ON CONFLICT DO UPDATE where available and
+    falls back to one lookup query plus bulk insert/update elsewhere.
+
+    Args:
+        model: mapped class to write
+        rows: list of dicts holding every key and counter column
+        key_columns: names of the columns forming the unique key
+        counter_columns: names of the columns to add to on conflict
+    """
+    if not rows:
+        return
+
+    for start in range(0, len(rows), chunk_size):
+        chunk = rows[start:start + chunk_size]
+        stmt = dialect_insert(model)
+
+        if stmt is not None:
+            stmt = stmt.values(chunk)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=key_columns,
+                set_={name: getattr(model, name) + getattr(stmt.excluded, name) for name in counter_columns}
+            )
+            db.session.execute(stmt)
+            continue
+
+        # Emulated upsert for databases without ON CONFLICT
+        key_attrs = [getattr(model, name) for name in key_columns]
+        keys = [tuple(row[name] for name in key_columns) for row in chunk]
+        existing = {
+            tuple(getattr(obj, name) for name in key_columns): obj
+            for obj in model.query.filter(tuple_(*key_attrs).in_(keys)).all()
+        }
+        new_rows = []
+        for key, row in zip(keys, chunk):
+            obj = existing.get(key)
+            if obj is None:
+                new_rows.append(row)
+            else:
+                for name in counter_columns:
+                    setattr(obj, name, getattr(obj, name) + row[name])
+        if new_rows:
+            db.session.execute(db.insert(model), new_rows)
+        db.session.flush()
@@ -0,0 +1,168 @@
+"""
+Faceted counts for the catalog sidebar
+
+All facets for a filter set come from one grouped statement: one row per
+category carrying the product count, the in-stock count and one count per
+price bucket. The grouped rows are cached per normalized filter key (the
+category filter is applied afterwards, in memory) and dropped when products
+are written.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import case, func
+
+from app import app, db
+from catalog_events import on_products_changed
+from category_cache import category_cache
+from models import Product
+from search import apply_product_search, search_key
+
+# Price buckets in KSh: (lower bound inclusive, upper bound exclusive or None)
+PRICE_BUCKETS = [
+    (0, 5000),
+    (5000, 20000),
+    (20000, 50000),
+    (50000, 100000),
+    (100000, None),
+]
+
+
+def _bucket_condition(low, high):
+    if high is None:
+        return Product.price >= low
+    return (Product.price >= low) & (Product.price < high)
+
+
+def query_facet_rows(search_query=None, price_min=None, price_max=None, in_stock=False):
+    """
+    Run the grouped facet statement for a filter set.
+
+    Returns:
+        list: (category_id, count, in_stock_count, *bucket_counts) per category
+    """
+    query = db.session.query(
+        Product.category_id,
+        func.count(Product.id),
+        func.sum(case((Product.stock > 0, 1), else_=0)),
+        *[func.sum(case((_bucket_condition(low, high), 1), else_=0)) for low, high in PRICE_BUCKETS]
+    )
+
+    if search_query:
+        query, _ = apply_product_search(query, search_query)
+
+    if price_min is not None:
+        query = query.filter(Product.price >= price_min)
+
+    if price_max is not None:
+        query = query.filter(Product.price <= price_max)
+
+    if in_stock:
+        query = query.filter(Product.stock > 0)
+
+    return [tuple(row) for row in query.group_by(Product.category_id).all()]
+
+
+def summarize_facets(rows, category_id=None):
+    """
+    Turn grouped facet rows into sidebar counts.
+
+    Category counts ignore the category filter so the sidebar can show how
+    many results every other category would give. The in-stock and price
+    bucket counts are for the selected category (or the whole catalog).
+
+    Returns:
+        dict: {'total', 'categories', 'in_stock', 'price_buckets'}
+    """
+    category_counts = {row[0]: row[1] for row in rows}
+    selected = [row for row in rows if category_id is None or row[0] == category_id]
+
+    categories = []
+    for category in category_cache.all():
+        categories.append({
+            'id': category.id,
+            'name': category.name,
+            'slug': category.slug,
+            'count': category_counts.get(category.id, 0),
+        })
+
+    return {
+        'total': sum(row[1] for row in selected),
+        'categories': categories,
+        'in_stock': sum(row[2] or 0 for row in selected),
+        'price_buckets': [
+            {'min': low, 'max': high, 'count': sum(row[3 + index] or 0 for row in selected)}
+            for index, (low, high) in enumerate(PRICE_BUCKETS)
+        ],
+    }
+
+
+def compute_facets(search_query=None, price_min=None, price_max=None, in_stock=False, category_id=None):
+    """Uncached facets for a filter set"""
+    return summarize_facets(query_facet_rows(search_query, price_min, price_max, in_stock), category_id)
+
+
+class FacetCache:
+    """LRU of grouped facet rows keyed by normalized filters"""
+
+    def __init__(self, max_entries=256, max_age=60):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (rows, generation, stored_at)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(search_query, price_min, price_max, in_stock):
+        return (search_key(search_query), price_min, price_max, bool(in_stock))
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def get(self, search_query=None, price_min=None, price_max=None, in_stock=False, category_id=None):
+        """Cached compute_facets()"""
+        key = self.normalize(search_query, price_min, price_max, in_stock)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == self._generation and time.monotonic() - entry[2] < self.max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return summarize_facets(entry[0], category_id)
+            self.misses += 1
+            generation = self._generation
+
+        rows = query_facet_rows(search_query, price_min, price_max, in_stock)
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (rows, generation, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return summarize_facets(rows, category_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'generation': self._generation,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+facet_cache = FacetCache(max_age=app.config.get('FACET_CACHE_MAX_AGE', 60))
+
+
+@on_products_changed
+def _invalidate_facets(product_ids):
+    facet_cache.invalidate()
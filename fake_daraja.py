@@ -0,0 +1,195 @@
+#!/usr/bin/env python3
+"""
+Local stand-in for the Daraja (M-Pesa) API
+
+Serves the two endpoints the shop uses, OAuth token generation and STK push,
+over keep-alive HTTP/1.1, and counts TCP connections, token requests and STK
+pushes so tests can see whether the client reuses both. Latency, token
+lifetime and failures are configurable; with callback_delay set it also
+posts a successful STK callback to the push's CallBackURL, like Daraja does
+once the customer confirms.
+
+Usage:
+    python fake_daraja.py [port]
+
+then run the site with MPESA_BASE_URL=http://127.0.0.1:<port> and any
+MPESA_CONSUMER_KEY/SECRET/BUSINESS_SHORTCODE/PASSKEY values.
+"""
+
+import base64
+import json
+import sys
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+
+
+class DarajaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes; without this, delayed ACKs stall every kept-alive request
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        self.server.daraja.count('connections')
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        daraja = self.server.daraja
+        if not self.path.startswith('/oauth/v1/generate'):
+            return self.send_json(404, {'errorMessage': 'Not found'})
+        daraja.count('token_requests')
+        time.sleep(daraja.latency)
+        failure = daraja.take_failure()
+        if failure:
+            return self.send_json(failure, {'errorMessage': 'Service unavailable'})
+        if not self.headers.get('Authorization', '').startswith('Basic '):
+            return self.send_json(400, {'errorMessage': 'Invalid Authentication passed'})
+        return self.send_json(200, {'access_token': daraja.issue_token(), 'expires_in': str(daraja.token_ttl)})
+
+    def do_POST(self):
+        daraja = self.server.daraja
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path != '/mpesa/stkpush/v1/processrequest':
+            return self.send_json(404, {'errorMessage': 'Not found'})
+        daraja.count('stk_requests')
+        time.sleep(daraja.latency)
+        failure = daraja.take_failure()
+        if failure:
+            return self.send_json(failure, {'errorMessage': 'Service unavailable'})
+        token = self.headers.get('Authorization', '').replace('Bearer ', '', 1)
+        if not daraja.token_valid(token):
+            return self.send_json(401, {'errorCode': '404.001.03', 'errorMessage': 'Invalid Access Token'})
+
+        push = json.loads(body or b'{}')
+        checkout_request_id = f'ws_CO_{uuid.uuid4().hex[:24]}'
+        merchant_request_id = f'{uuid.uuid4().int % 100000}-{uuid.uuid4().int % 100000000}-1'
+        if daraja.callback_delay is not None and push.get('CallBackURL'):
+            threading.Timer(daraja.callback_delay, daraja.send_callback,
+                            args=(push['CallBackURL'], merchant_request_id, checkout_request_id, push)).start()
+        return self.send_json(200, {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResponseCode': '0',
+            'ResponseDescription': 'Success. Request accepted for processing',
+            'CustomerMessage': 'Success. Request accepted for processing',
+        })
+
+
+class DarajaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients that time out hang up mid-answer; that's expected here
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class FakeDaraja:
+    """
+    In-process fake Daraja server.
+
+    Args:
+        port: 0 picks a free port
+        latency: seconds added to every answer
+        token_ttl: expires_in of issued tokens, in seconds
+        callback_delay: post an STK callback this many seconds after each push (None: never)
+    """
+
+    def __init__(self, port=0, latency=0.0, token_ttl=3599, callback_delay=None):
+        self.latency = latency
+        self.token_ttl = token_ttl
+        self.callback_delay = callback_delay
+        self.counters = {'connections': 0, 'token_requests': 0, 'stk_requests': 0, 'callbacks': 0}
+        self._tokens = {}
+        self._failures = []
+        self._lock = threading.Lock()
+        self.server = DarajaServer(('127.0.0.1', port), DarajaHandler)
+        self.server.daraja = self
+        self._thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_address[1]}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name='fake-daraja', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def reset_counters(self):
+        with self._lock:
+            self.counters = dict.fromkeys(self.counters, 0)
+
+    def fail_next(self, requests, status=503):
+        """Answer the next `requests` requests with `status`"""
+        with self._lock:
+            self._failures.extend([status] * requests)
+
+    def take_failure(self):
+        with self._lock:
+            return self._failures.pop(0) if self._failures else None
+
+    def issue_token(self):
+        token = base64.b64encode(uuid.uuid4().bytes).decode().rstrip('=')
+        with self._lock:
+            self._tokens[token] = time.monotonic() + self.token_ttl
+        return token
+
+    def token_valid(self, token):
+        with self._lock:
+            return self._tokens.get(token, 0) > time.monotonic()
+
+    def expire_tokens(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def send_callback(self, url, merchant_request_id, checkout_request_id, push):
+        body = json.dumps({'Body': {'stkCallback': {
+            'MerchantRequestID': merchant_request_id,
+            'CheckoutRequestID': checkout_request_id,
+            'ResultCode': 0,
+            'ResultDesc': 'The service request is processed successfully.',
+            'CallbackMetadata': {'Item': [
+                {'Name': 'Amount', 'Value': push.get('Amount')},
+                {'Name': 'MpesaReceiptNumber', 'Value': f'NLJ{uuid.uuid4().hex[:7].upper()}'},
+                {'Name': 'TransactionDate', 'Value': int(time.strftime('%Y%m%d%H%M%S'))},
+                {'Name': 'PhoneNumber', 'Value': push.get('PhoneNumber')},
+            ]},
+        }}}).encode()
+        try:
+            urlopen(Request(url, data=body, headers={'Content-Type': 'application/json'}), timeout=10).read()
+            self.count('callbacks')
+        except OSError as e:
+            print(f"Fake Daraja: callback to {url} failed: {e}")
+
+
+if __name__ == "__main__":
+    daraja = FakeDaraja(port=int(sys.argv[1]) if len(sys.argv) > 1 else 8099, callback_delay=3).start()
+    print(f"Fake Daraja listening on {daraja.url}")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"Fake Daraja: {daraja.counters}")
+    except KeyboardInterrupt:
+        daraja.stop()
@@ -0,0 +1,94 @@
+"""
+Conditional GET and Cache-Control policies
+
+A route describes its content with a few cheap validator values (timestamps,
+counters, the template version is always added). From those we derive a weak
+ETag, and if the client already holds that version we answer 304 Not Modified
+before anything is rendered or serialized.
+
+Pages that differ per session (logged-in users, session carts, pending flash
+messages) are sent with the route's private policy and no validators, so
+they always render.
+Cache-Control values can be overridden per endpoint through the
+CACHE_CONTROL_POLICIES config key, e.g.
+
+    app.config['CACHE_CONTROL_POLICIES'] = {
+        'product_detail': {'public': 'public, max-age=300'},
+    }
+"""
+import hashlib
+
+from flask import make_response, request
+from werkzeug.http import is_resource_modified
+
+from app import app
+
+DEFAULT_POLICY = {
+    'public': 'public, no-cache',
+    'private': 'private, no-cache',
+}
+
+# endpoint -> {'public': shared response policy, 'private': per-session policy}
+DEFAULT_CACHE_CONTROL_POLICIES = {
+    'index': {'public': 'public, max-age=60, stale-while-revalidate=300'},
+    'products': {'public': 'public, max-age=30, stale-while-revalidate=120'},
+    'api_products': {'public': 'public, max-age=30, stale-while-revalidate=120'},
+    'product_detail': {'public': 'public, max-age=60, stale-while-revalidate=300'},
+    'payment_status_api': {'private': 'private, no-store'},
+}
+
+
+def cache_control_policy(endpoint, public=True):
+    """Cache-Control value for an endpoint, honouring CACHE_CONTROL_POLICIES overrides"""
+    policy = dict(DEFAULT_POLICY)
+    policy.update(DEFAULT_CACHE_CONTROL_POLICIES.get(endpoint, {}))
+    policy.update(app.config.get('CACHE_CONTROL_POLICIES', {}).get(endpoint, {}))
+    return policy['public' if public else 'private']
+
+
+def make_etag(*validators):
+    """Stable ETag value for a set of validators (same on every worker)"""
+    parts = [repr(value) for value in validators + (app.config['TEMPLATE_VERSION'],)]
+    return hashlib.sha1('|'.join(parts).encode('utf-8')).hexdigest()[:32]
+
+
+def conditional_response(validators, render, last_modified=None, public=True, vary_cookie=True):
+    """
+    Answer a GET with 304 when the client's copy is current, otherwise render.
+
+    Args:
+        validators: values that change whenever the response body would
+        render: callable returning anything make_response() accepts; only
+            called when the client's copy is stale
+        last_modified: naive UTC datetime of the last content change, or None
+        public: whether shared caches may store the response
+        vary_cookie: whether the same URL renders differently for logged-in users
+
+    Returns:
+        Response
+    """
+    etag = make_etag(*validators)
+
+    if request.method in ('GET', 'HEAD') and not is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render())
+        if response.status_code != 200:
+            return response
+
+    response.set_etag(etag, weak=True)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control_policy(request.endpoint, public)
+    if vary_cookie:
+        response.vary.add('Cookie')
+    return response
+
+
+def with_cache_control(body, public=False):
+    """Wrap a response without validators in the endpoint's Cache-Control policy"""
+    response = make_response(body)
+    response.headers['Cache-Control'] = cache_control_policy(request.endpoint, public)
+    response.vary.add('Cookie')
+    return response
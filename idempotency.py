@@ -0,0 +1,242 @@
+"""
+Idempotent POST handling
+
+@idempotent makes a mutating route safe to submit twice. Every request is
+keyed on the user, the endpoint, an optional client key (Idempotency-Key
+header or idempotency_key form field), a fingerprint of the method, path
+and body, and a token of the state the request acts on (the cart's lines,
+the order's latest payment attempt) supplied by the route. The first
+request claims the key with an INSERT that the unique primary key lets
+only one worker win, runs the view and stores its response. Repeats replay
+the stored response without running the view; a repeat that arrives while
+the first is still running waits for it, and gets 409 if it takes too long.
+Responses that shouldn't stick (errors, re-rendered forms) release the key
+so a retry runs again.
+
+The response is also stored under the key for the state the view left
+behind (an emptied cart, a pending attempt), so a repeat arriving after the
+first finished replays it too, while the same form submitted against a
+changed cart or after a failed payment runs again. Keys carrying a client
+key are kept for IDEMPOTENCY_TTL; fingerprint-only keys, which every plain
+form submission gets, only for IDEMPOTENCY_FINGERPRINT_TTL seconds, long
+enough to absorb double clicks and retried requests.
+
+Keys are claimed and stored on their own connection, outside the view's
+session, so the view's commit or rollback never touches them. The session
+is rolled back around those writes so each request holds only one pooled
+connection at a time.
+"""
+import functools
+import hashlib
+import itertools
+import json
+import time
+from datetime import datetime, timedelta
+
+from flask import Response, g, has_request_context, jsonify, request
+from flask_login import current_user
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import IdempotencyKey
+
+KEY_HEADER = 'Idempotency-Key'
+KEY_FIELD = 'idempotency_key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+STORED_HEADERS = ('Location', 'Content-Type')
+FORM_MIMETYPES = ('application/x-www-form-urlencoded', 'multipart/form-data')
+PURGE_EVERY = 100
+
+_claims = itertools.count(1)
+
+
+def stores_response(response):
+    """Default: keep any 2xx or 3xx response"""
+    return 200 <= response.status_code < 400
+
+
+def redirects_only(response):
+    """For form routes that redirect on success and re-render the form on failure"""
+    return response.status_code in (301, 302, 303)
+
+
+def request_fingerprint():
+    """sha256 of the method, path, query string and body (form fields sorted, the client key left out)"""
+    digest = hashlib.sha256()
+    digest.update(f'{request.method} {request.path}?{request.query_string.decode()}\n'.encode())
+    if request.mimetype in FORM_MIMETYPES:
+        for name, value in sorted(request.form.items(multi=True)):
+            if name != KEY_FIELD:
+                digest.update(f'{name}={value}\n'.encode())
+    else:
+        digest.update(request.get_data(cache=True))
+    return digest.hexdigest()
+
+
+def client_key():
+    """The client-supplied key, '' when the request has none"""
+    return request.headers.get(KEY_HEADER) or request.form.get(KEY_FIELD, '')
+
+
+def request_key(state=''):
+    """Store key for the current request against the given state token"""
+    user = current_user.get_id() if current_user.is_authenticated else f'anonymous:{request.remote_addr}'
+    parts = (str(user), request.endpoint or '', client_key(), request_fingerprint(), state)
+    return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+
+def current_key():
+    """Key claimed by the request being handled, None outside an @idempotent request"""
+    return g.get('idempotency_key') if has_request_context() else None
+
+
+def release_key(key):
+    """Forget a stored response so the same request runs again. Runs in the caller's transaction."""
+    db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.id == key))
+
+
+def _claim(key, now):
+    """Insert an in-progress row for the key. Returns True if this request won it."""
+    table = IdempotencyKey.__table__
+    lock_timeout = app.config.get('IDEMPOTENCY_LOCK_TIMEOUT', 60)
+    try:
+        with db.engine.begin() as connection:
+            # An expired row (stale response, or a worker that died mid-request) no longer counts
+            connection.execute(db.delete(table).where(table.c.id == key, table.c.expires_at <= now))
+            connection.execute(db.insert(table).values(
+                id=key, endpoint=request.endpoint or '', status='in_progress',
+                created_at=now, expires_at=now + timedelta(seconds=lock_timeout)
+            ))
+        return True
+    except IntegrityError:
+        return False
+
+
+def _load(key):
+    table = IdempotencyKey.__table__
+    with db.engine.connect() as connection:
+        return connection.execute(db.select(table).where(table.c.id == key)).first()
+
+
+def _store(key, response, ttl, after_key=None):
+    """Save the response under the key, and under after_key if given, for ttl seconds"""
+    table = IdempotencyKey.__table__
+    headers = {name: response.headers[name] for name in STORED_HEADERS if name in response.headers}
+    now = datetime.utcnow()
+    values = dict(
+        status='completed',
+        response_status=response.status_code,
+        response_headers=json.dumps(headers),
+        response_body=response.get_data(),
+        expires_at=now + timedelta(seconds=ttl)
+    )
+    with db.engine.begin() as connection:
+        stored = connection.execute(db.update(table).where(table.c.id == key).values(**values)).rowcount
+        # A payment job that already failed released the key; then nothing is replayed
+        if stored and after_key and after_key != key:
+            connection.execute(db.delete(table).where(table.c.id == after_key))
+            connection.execute(db.insert(table).values(id=after_key, endpoint=request.endpoint or '',
+                                                       created_at=now, **values))
+
+
+def _release(key):
+    table = IdempotencyKey.__table__
+    with db.engine.begin() as connection:
+        connection.execute(db.delete(table).where(table.c.id == key))
+
+
+def _replay(row):
+    response = Response(row.response_body, status=row.response_status,
+                        headers=json.loads(row.response_headers or '{}'))
+    response.headers[REPLAYED_HEADER] = 'true'
+    return response
+
+
+def purge_expired_keys(batch_size=1000):
+    """
+    Delete expired keys in batches.
+
+    Returns:
+        int: number of keys deleted
+    """
+    table = IdempotencyKey.__table__
+    deleted = 0
+    while True:
+        expired = db.select(table.c.id).where(table.c.expires_at <= datetime.utcnow()).limit(batch_size)
+        with db.engine.begin() as connection:
+            count = connection.execute(db.delete(table).where(table.c.id.in_(expired.scalar_subquery()))).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def idempotent(view=None, *, ttl=None, store=stores_response, wait=5.0, state=None):
+    """
+    Replay the first response to repeated submissions of a mutating route.
+
+    Only non-GET requests are keyed; put it below @login_required so the key
+    is per user. Usable bare (@idempotent) or with options.
+
+    Args:
+        ttl: seconds a stored response is replayed, IDEMPOTENCY_TTL by default;
+            never more than IDEMPOTENCY_FINGERPRINT_TTL without a client key
+        store: predicate deciding whether a response is kept (stores_response, redirects_only)
+        wait: seconds a repeat waits for the first request to finish before giving up with 409
+        state: callable taking the view's arguments and returning a string that
+            changes whenever a repeat of the request should run again
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method in ('GET', 'HEAD', 'OPTIONS'):
+                return view(*args, **kwargs)
+
+            key = request_key(state(**kwargs) if state else '')
+            g.idempotency_key = key
+            # Hand the session's connection (loading current_user opened one) back to the
+            # pool, so a request never holds two connections at once
+            db.session.rollback()
+            deadline = time.monotonic() + wait
+            while True:
+                now = datetime.utcnow()
+                if _claim(key, now):
+                    break
+                row = _load(key)
+                if row is not None and row.status == 'completed' and row.expires_at > now:
+                    print(f"DEBUG: Replaying stored response for {request.endpoint}")
+                    return _replay(row)
+                if time.monotonic() >= deadline:
+                    app.logger.warning(f'Duplicate {request.endpoint} request still in progress')
+                    return jsonify({'success': False,
+                                    'message': 'This request is already being processed'}), 409
+                time.sleep(0.1)
+
+            if next(_claims) % PURGE_EVERY == 0:
+                purge_expired_keys()
+
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except Exception:
+                db.session.rollback()
+                _release(key)
+                raise
+            # Whatever the view left uncommitted would be rolled back at teardown anyway;
+            # ending it now frees SQLite's write lock for the key's own connection
+            db.session.rollback()
+            if store(response):
+                keep = ttl if ttl is not None else app.config.get('IDEMPOTENCY_TTL', 24 * 3600)
+                if not client_key():
+                    keep = min(keep, app.config.get('IDEMPOTENCY_FINGERPRINT_TTL', 10))
+                after_key = None
+                if state:
+                    after_key = request_key(state(**kwargs))
+                    db.session.rollback()
+                _store(key, response, keep, after_key)
+            else:
+                _release(key)
+            return response
+        return wrapper
+
+    if view is not None:
+        return decorator(view)
+    return decorator
@@ -1,11 +1,30 @@
 from app import app
-from flask import render_template, request, redirect, url_for, flash, session, jsonify
+from flask import render_template, request, redirect, url_for, flash, session, jsonify, abort
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from datetime import datetime
-from models import db, User, Product, Category, Order, OrderItem, Cart, CartItem, PaymentMethod, Review, InvoiceTemplate, DeliveryComment, InstallationComment
-from payment import process_card_payment, process_mpesa_payment, validate_card_details
+from models import db, User, Product, ProductAssociation, Category, Order, OrderItem, Cart, CartItem, PaymentMethod, Review, InvoiceTemplate, DeliveryComment, InstallationComment
+from payment import validate_card_details
 from pdf_generator import generate_invoice_pdf, get_default_template
+from cart_pricing import cart_summary_json, price_session_cart, price_user_cart
+from cart_store import anonymous_cart, clear_anonymous_cart, save_anonymous_cart
+from cart_service import add_to_user_cart, cart_version, load_cart_item, merge_session_cart, refresh_item_counts, session_cart_count, update_user_cart_lines, user_cart_count
+from catalog_events import catalog_version, products_changed
+from category_cache import category_cache
+from facets import facet_cache
+from http_cache import conditional_response, with_cache_control
+from idempotency import idempotent, redirects_only
+from mpesa_callbacks import ingest_callback
+from page_cache import cacheable_request, page_cache, product_tag, render_cached
+from pagination import KEYSET_SORTS, InvalidCursor, keyset_paginate, page_or_cursor
+from recommendations import related_products_for
+from order_history import order_counts, order_history_page
+from order_status import can_transition, event_dict, events_since, transition
+from order_writer import create_order
+from payment_jobs import attempt_version, payment_status, pending_attempt, start_payment
+from reservations import available_stock, consume_holds, reserve_lines
+from search import apply_product_search, ensure_search_index, index_products, rebuild_search_index, remove_products_from_index
+from suggest import suggestions
 from slugify import slugify
 from flask import send_file
 import random
@@ -15,35 +34,38 @@ import string
 @app.route('/')
 def index():
     """Homepage of the Mo Solar Technologies website"""
-    # Get featured products (limit to 4)
-    featured_products = Product.query.filter_by(featured=True).limit(4).all()
-    
-    return render_template('index.html', featured_products=featured_products)
-    
-# Display all products with optional filtering
-@app.route('/products')
-def products():
-    """Display all products with optional filtering"""
-    page = request.args.get('page', 1, type=int)
-    category_slug = request.args.get('category')
-    search_query = request.args.get('search')
-    sort = request.args.get('sort', 'name_asc')
-    price_min = request.args.get('price_min', type=float)
-    price_max = request.args.get('price_max', type=float)
-    in_stock = request.args.get('in_stock')
+    def render():
+        # Get featured products (limit to 4)
+        featured_products = Product.query.filter_by(featured=True).limit(4).all()
+        
+        html = render_template('index.html', featured_products=featured_products)
+        return html, ['homepage'] + [product_tag(product.id) for product in featured_products]
+    
+    # No validators here: a cache hit must stay free of database queries
+    return with_cache_control(render_cached(('index', app.config['TEMPLATE_VERSION']), render),
+                              public=cacheable_request())
+    
+def build_catalog_query(args):
+    """Build the filtered and sorted catalog query shared by the HTML and JSON listings"""
+    category_slug = args.get('category')
+    search_query = args.get('search')
+    sort = args.get('sort', 'relevance' if search_query else 'name_asc')
+    price_min = args.get('price_min', type=float)
+    price_max = args.get('price_max', type=float)
+    in_stock = args.get('in_stock')
     
     # Build query
     query = Product.query
     
     # Apply filters
     if category_slug:
-        category = Category.query.filter_by(slug=category_slug).first()
-        if category:
-            query = query.filter_by(category_id=category.id)
+        category_id = category_cache.id_for_slug(category_slug)
+        if category_id:
+            query = query.filter_by(category_id=category_id)
     
+    search_rank = None
     if search_query:
-        query = query.filter(Product.name.ilike(f'%{search_query}%') | 
-                             Product.description.ilike(f'%{search_query}%'))
+        query, search_rank = apply_product_search(query, search_query)
     
     if price_min is not None:
         query = query.filter(Product.price >= price_min)
@@ -55,7 +77,9 @@ def products():
         query = query.filter(Product.stock > 0)
     
     # Apply sorting
-    if sort == 'name_asc':
+    if sort == 'relevance' and search_rank is not None:
+        query = query.order_by(search_rank.desc(), Product.id)
+    elif sort == 'name_asc':
         query = query.order_by(Product.name.asc())
     elif sort == 'name_desc':
         query = query.order_by(Product.name.desc())
@@ -66,39 +90,229 @@ def products():
     elif sort == 'newest':
         query = query.order_by(Product.created_at.desc())
     
-    # Paginate results
-    per_page = 12
-    products = query.paginate(page=page, per_page=per_page, error_out=False)
+    return query, sort
+
+def catalog_facets(args):
+    """Sidebar facet counts for the current catalog filters"""
+    category_slug = args.get('category')
+    return facet_cache.get(
+        search_query=args.get('search'),
+        price_min=args.get('price_min', type=float),
+        price_max=args.get('price_max', type=float),
+        in_stock=bool(args.get('in_stock')),
+        category_id=category_cache.id_for_slug(category_slug) if category_slug else None
+    )
+
+def catalog_validators():
+    """
+    Version stamp of the whole catalog for listing ETags.
     
-    # Get all categories for sidebar
-    categories = Category.query.all()
+    The newest updated_at (an index lookup) moves on inserts and updates;
+    the shared catalog version (see catalog_events.py) covers deletes,
+    which leave it where it was.
     
-    return render_template('products.html', 
-                          products=products.items,
-                          page=page,
-                          pages=products.pages,
-                          total=products.total,
-                          categories=categories, 
-                          current_category=category_slug, 
-                          search_query=search_query, 
-                          sort=sort)
+    Returns:
+        tuple: (validators, last modified datetime)
+    """
+    last_update, version = db.session.query(db.func.max(Product.updated_at), catalog_version()).one()
+    return (version, last_update, tuple(category_cache.all())), last_update
+
+def paginate_by_cursor(query, sort, cursor, per_page, listing):
+    """Keyset-paginate a product query, falling back to the first page on a bad cursor"""
+    key_column, descending = KEYSET_SORTS[sort]
+    try:
+        return keyset_paginate(query, key_column, descending, cursor=cursor, per_page=per_page, listing=listing)
+    except InvalidCursor:
+        return keyset_paginate(query, key_column, descending, per_page=per_page, listing=listing)
+
+# Display all products with optional filtering
+@app.route('/products')
+def products():
+    """Display all products with optional filtering"""
+    def render():
+        page, cursor = page_or_cursor(request.args)
+        category_slug = request.args.get('category')
+        search_query = request.args.get('search')
+        
+        query, sort = build_catalog_query(request.args)
+        per_page = 12
+        
+        # Get all categories and facet counts for sidebar
+        categories = category_cache.all()
+        facets = catalog_facets(request.args)
+        
+        # Cursor-based paging unless a page number was asked for; prev/next links carry cursors
+        if sort in KEYSET_SORTS and (cursor is not None or 'page' not in request.args):
+            products = paginate_by_cursor(query, sort, cursor, per_page, 'products')
+            
+            return render_template('products.html', 
+                                  products=products.items,
+                                  pagination=products,
+                                  page=products.page,
+                                  pages=products.pages,
+                                  total=products.total,
+                                  total_is_estimate=products.total_is_estimate,
+                                  next_cursor=products.next_cursor,
+                                  prev_cursor=products.prev_cursor,
+                                  categories=categories, 
+                                  facets=facets,
+                                  current_category=category_slug, 
+                                  search_query=search_query, 
+                                  sort=sort)
+        
+        # Paginate results
+        products = query.paginate(page=page, per_page=per_page, error_out=False)
+        
+        return render_template('products.html', 
+                              products=products.items,
+                              pagination=products,
+                              page=page,
+                              pages=products.pages,
+                              total=products.total,
+                              categories=categories, 
+                              facets=facets,
+                              current_category=category_slug, 
+                              search_query=search_query, 
+                              sort=sort)
+    
+    if not cacheable_request():
+        return with_cache_control(render())
+    
+    validators, last_modified = catalog_validators()
+    return conditional_response(('products', sorted(request.args.items(multi=True))) + validators,
+                                render, last_modified)
+
+# Catalog listing as JSON with cursor-based paging
+@app.route('/api/products')
+def api_products():
+    """Return one page of the catalog as JSON"""
+    def render():
+        query, sort = build_catalog_query(request.args)
+        per_page = min(max(request.args.get('per_page', 12, type=int), 1), 100)
+        
+        if sort in KEYSET_SORTS:
+            key_column, descending = KEYSET_SORTS[sort]
+            try:
+                products = keyset_paginate(query, key_column, descending,
+                                           cursor=request.args.get('cursor'),
+                                           per_page=per_page,
+                                           listing='products')
+            except InvalidCursor as e:
+                return jsonify({'success': False, 'message': str(e)}), 400
+            paging = {'next_cursor': products.next_cursor, 'prev_cursor': products.prev_cursor,
+                      'page': products.page, 'has_next': products.has_next,
+                      'total': products.total, 'total_is_estimate': products.total_is_estimate}
+        elif sort == 'relevance':
+            # Search rank has no cursor key: page relevance results by number (?page=N)
+            products = query.order_by(Product.id).paginate(page=request.args.get('page', 1, type=int),
+                                                           per_page=per_page, error_out=False)
+            paging = {'next_cursor': None, 'prev_cursor': None,
+                      'page': products.page, 'has_next': products.has_next,
+                      'total': products.total, 'total_is_estimate': False}
+        else:
+            return jsonify({'success': False, 'message': f'Cursor paging is not available for sort "{sort}"'}), 400
+        
+        response = {
+            'success': True,
+            'products': [{
+                'id': product.id,
+                'name': product.name,
+                'slug': product.slug,
+                'price': float(product.price),
+                'stock': product.stock,
+                'image_url': product.image_url or '',
+                'category_id': product.category_id,
+                'featured': product.featured
+            } for product in products.items],
+            **paging
+        }
+        
+        # Sidebar counts on request (?facets=1)
+        if request.args.get('facets'):
+            response['facets'] = catalog_facets(request.args)
+        
+        return jsonify(response)
+    
+    # The JSON doesn't depend on the visitor, so every response is shareable
+    validators, last_modified = catalog_validators()
+    return conditional_response(('api_products', sorted(request.args.items(multi=True))) + validators,
+                                render, last_modified, vary_cookie=False)
+
+# Search-as-you-type suggestions
+@app.route('/api/products/suggest')
+def suggest_products():
+    """Return the best matching products and categories for a partial query"""
+    query = request.args.get('q', '').strip()[:100]
+    limit = min(max(request.args.get('limit', 8, type=int), 1), 20)
+    
+    results = []
+    for suggestion in suggestions.suggest(query, limit):
+        if suggestion.kind == 'category':
+            url = url_for('products', category=suggestion.slug)
+        else:
+            url = url_for('product_detail', slug=suggestion.slug)
+        results.append({
+            'type': suggestion.kind,
+            'id': suggestion.id,
+            'label': suggestion.label,
+            'slug': suggestion.slug,
+            'url': url
+        })
+    
+    return jsonify({'success': True, 'query': query, 'suggestions': results})
     
 # Display product details
 @app.route('/products/<slug>')
 def product_detail(slug):
     """Display product details"""
-    product = Product.query.filter_by(slug=slug).first_or_404()
+    def render():
+        product = Product.query.filter_by(slug=slug).first_or_404()
+        
+        # Get related products (frequently bought together, then same category)
+        related_products = related_products_for(product, limit=4)
+        
+        # Get reviews
+        reviews = Review.query.filter_by(product_id=product.id).order_by(Review.created_at.desc()).all()
+        
+        html = render_template('product_detail.html', product=product, related_products=related_products, reviews=reviews)
+        return html, [product_tag(product.id)] + [product_tag(related.id) for related in related_products]
+    
+    if not cacheable_request():
+        return with_cache_control(render()[0])
     
-    # Get related products (same category, exclude current product)
-    related_products = Product.query.filter(
-        Product.category_id == product.category_id,
-        Product.id != product.id
-    ).limit(4).all()
+    stamp = product_detail_stamp(slug)
+    if stamp is None:
+        abort(404)
     
-    # Get reviews
-    reviews = Review.query.filter_by(product_id=product.id).order_by(Review.created_at.desc()).all()
+    # Anonymous visitors share one rendering per product version; keyed on the whole
+    # stamp so a related product written on another worker can't be served stale
+    def render_page():
+        return render_cached(('product_detail', slug, *stamp, app.config['TEMPLATE_VERSION']), render)
     
-    return render_template('product_detail.html', product=product, related_products=related_products, reviews=reviews)
+    last_modified = max(filter(None, (stamp.updated_at, stamp.related_updated_at)), default=None)
+    return conditional_response(('product_detail', slug) + tuple(stamp), render_page, last_modified)
+
+def product_detail_stamp(slug):
+    """
+    Everything the product page depends on, in one query: the product's own
+    update time and review count, plus the newest update among the products
+    that can show up as related and the co-purchase counts that order them.
+    """
+    related = db.aliased(Product)
+    related_updated_at = db.session.query(db.func.max(related.updated_at)).filter(
+        db.or_(related.category_id == Product.category_id,
+               related.id.in_(db.session.query(ProductAssociation.related_product_id)
+                              .filter(ProductAssociation.product_id == Product.id)))
+    ).correlate(Product).scalar_subquery()
+    bought_together = db.session.query(db.func.coalesce(db.func.sum(ProductAssociation.order_count), 0)) \
+        .filter(ProductAssociation.product_id == Product.id).correlate(Product).scalar_subquery()
+    
+    return db.session.query(
+        Product.updated_at,
+        Product.rating_count,
+        related_updated_at.label('related_updated_at'),
+        bought_together.label('bought_together')
+    ).filter(Product.slug == slug).first()
 
 # User login
 @app.route('/login', methods=['GET', 'POST'])
@@ -122,52 +336,19 @@ def login():
         if user and user.check_password(password):
             login_user(user, remember=remember)
             
-            # If user has items in session cart, transfer them to database cart
-            if 'cart' in session and session['cart']:
-                # Get or create user cart
-                cart = Cart.query.filter_by(user_id=user.id).first()
-                if not cart:
-                    cart = Cart(user_id=user.id)
-                    db.session.add(cart)
-                    db.session.commit()
-                
-                # Transfer items
-                for product_id, item in session['cart'].items():
-                    try:
-                        product_id = int(product_id)
-                        quantity = item.get('quantity', 1)
-                        
-                        # Verify the product exists in the database
-                        product = Product.query.get(product_id)
-                        if not product:
-                            continue  # Skip this item if product doesn't exist
-                        
-                        # Check if product exists in user's cart
-                        cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
-                        
-                        if cart_item:
-                            # Update quantity
-                            cart_item.quantity += quantity
-                        else:
-                            # Add new item
-                            cart_item = CartItem(cart_id=cart.id, product_id=product_id, quantity=quantity)
-                            db.session.add(cart_item)
-                    except Exception as e:
-                        # Log the error but continue processing other items
-                        print(f"Error adding cart item: {e}")
-                        # Rollback the current transaction
-                        db.session.rollback()
-                
+            # If user has items in their anonymous cart, transfer them to database cart
+            cart_data = anonymous_cart()
+            if cart_data:
+                # Validates every product with one query and writes every line with one upsert
                 try:
-                    # Commit all valid cart items
+                    merge_session_cart(user.id, cart_data)
                     db.session.commit()
                 except Exception as e:
-                    # If there's an error during commit, rollback
-                    print(f"Error committing cart items: {e}")
+                    print(f"Error merging session cart: {e}")
                     db.session.rollback()
                 
-                # Clear session cart
-                session.pop('cart', None)
+                # Clear anonymous cart
+                clear_anonymous_cart()
             
             next_page = request.args.get('next')
             flash('Login successful. Welcome back!', 'success')
@@ -279,10 +460,11 @@ def profile():
         flash('Profile updated successfully', 'success')
         return redirect(url_for('profile'))
     
-    # Get user's orders
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
+    # Get user's most recent orders with their lines; the full history is paged on My Orders
+    orders = order_history_page(current_user.id, per_page=5)
     
-    return render_template('profile.html', user=current_user, orders=orders)
+    return render_template('profile.html', user=current_user, orders=orders.items,
+                         has_more_orders=orders.has_next, order_counts=order_counts(current_user.id))
 
 # Shopping cart page
 @app.route('/cart')
@@ -297,43 +479,14 @@ def cart():
         flash('Access denied. Installers cannot use the shopping cart.', 'error')
         return redirect(url_for('installer_dashboard'))
         
-    cart_items = []
-    total = 0
-    
     if current_user.is_authenticated:
-        # Get cart from database
-        cart = Cart.query.filter_by(user_id=current_user.id).first()
-        
-        if cart:
-            for item in cart.items:
-                product = Product.query.get(item.product_id)
-                if product:
-                    subtotal = float(product.price) * item.quantity
-                    cart_items.append({
-                        'id': item.id,
-                        'product': product,
-                        'quantity': item.quantity,
-                        'subtotal': subtotal
-                    })
-                    total += subtotal
+        # Price the database cart, lines and totals come from one query
+        summary = price_user_cart(current_user.id)
     else:
-        # Get cart from session
-        cart_data = session.get('cart', {})
-        
-        for product_id, item in cart_data.items():
-            product = Product.query.get(int(product_id))
-            if product:
-                quantity = item.get('quantity', 1)
-                subtotal = float(product.price) * quantity
-                cart_items.append({
-                    'id': f"session_{product_id}",
-                    'product': product,
-                    'quantity': quantity,
-                    'subtotal': subtotal
-                })
-                total += subtotal
+        # Price the anonymous cart
+        summary = price_session_cart(anonymous_cart())
     
-    return render_template('cart.html', cart_items=cart_items, total=total)
+    return render_template('cart.html', cart_items=summary.lines, total=summary.total)
 
 # Add item to cart
 @app.route('/cart/add', methods=['POST'])
@@ -361,36 +514,22 @@ def add_to_cart():
         flash('Product not found', 'danger')
         return redirect(url_for('products'))
         
-    if product.stock < quantity:
-        flash(f'Only {product.stock} units available', 'danger')
+    # Stock held by other buyers' checkouts isn't available
+    buyer_id = current_user.id if current_user.is_authenticated else None
+    available = available_stock([product_id], exclude_user_id=buyer_id).get(product_id, 0)
+    if available < quantity:
+        flash(f'Only {max(available, 0)} units available', 'danger')
         return redirect(url_for('product_detail', slug=product.slug))
     
     if current_user.is_authenticated:
-        # Add to database cart
-        cart = Cart.query.filter_by(user_id=current_user.id).first()
-        
-        if not cart:
-            cart = Cart(user_id=current_user.id)
-            db.session.add(cart)
-            db.session.commit()
-        
-        # Check if product already in cart
-        cart_item = CartItem.query.filter_by(cart_id=cart.id, product_id=product_id).first()
-        
-        if cart_item:
-            # Update quantity
-            cart_item.quantity += quantity
-        else:
-            # Add new item
-            cart_item = CartItem(cart_id=cart.id, product_id=product_id, quantity=quantity)
-            db.session.add(cart_item)
-        
+        # Add to database cart; a product already in the cart gets the quantity added
+        add_to_user_cart(current_user.id, {product_id: quantity})
         db.session.commit()
     else:
-        # Add to session cart
-        cart = session.get('cart', {})
+        # Add to the anonymous cart kept in the cart store
+        cart = anonymous_cart()
         
-        # Convert product_id to string for session storage
+        # Convert product_id to string for cart storage
         product_id_str = str(product_id)
         
         if product_id_str in cart:
@@ -400,7 +539,7 @@ def add_to_cart():
             # Add new item
             cart[product_id_str] = {'quantity': quantity}
         
-        session['cart'] = cart
+        save_anonymous_cart(cart)
     
     flash(f'{product.name} added to cart', 'success')
     
@@ -431,13 +570,13 @@ def update_cart():
     if current_user.is_authenticated:
         # Update database cart
         if item_id.isdigit():  # Database cart item
-            cart_item = CartItem.query.get(int(item_id))
+            cart_item = load_cart_item(int(item_id))
             
             if not cart_item or cart_item.cart.user_id != current_user.id:
                 return jsonify({'success': False, 'message': 'Item not found'})
             
             # Check product stock
-            product = Product.query.get(cart_item.product_id)
+            product = cart_item.product
             if not product or product.stock < quantity:
                 return jsonify({
                     'success': False, 
@@ -445,60 +584,124 @@ def update_cart():
                 })
             
             cart_item.quantity = quantity
+            refresh_item_counts(cart_ids=[cart_item.cart_id])
             db.session.commit()
             
-            # Calculate new subtotal and cart total
-            subtotal = float(product.price) * quantity
-            
-            # Get cart total
-            cart = Cart.query.filter_by(user_id=current_user.id).first()
-            total = 0
-            for item in cart.items:
-                product = Product.query.get(item.product_id)
-                if product:
-                    total += float(product.price) * item.quantity
+            # Price the cart again for the new subtotal and cart total
+            summary = price_user_cart(current_user.id)
+            line = summary.line(int(item_id))
             
             return jsonify({
                 'success': True,
-                'subtotal': subtotal,
-                'total': total
+                'subtotal': float(line.subtotal) if line else 0,
+                'total': float(summary.total)
             })
     else:
         # Update session cart
         if item_id.startswith('session_'):
             product_id = item_id.split('_')[1]
-            cart = session.get('cart', {})
+            cart = anonymous_cart()
             
             if product_id in cart:
-                # Check product stock
-                product = Product.query.get(int(product_id))
-                if not product or product.stock < quantity:
+                # Price the cart with the new quantity, which also checks stock
+                updated = dict(cart)
+                updated[product_id] = dict(cart[product_id], quantity=quantity)
+                summary = price_session_cart(updated)
+                line = summary.line(item_id)
+                if not line or not line.in_stock:
                     return jsonify({
                         'success': False, 
-                        'message': f'Only {product.stock if product else 0} units available'
+                        'message': f'Only {line.product.stock if line else 0} units available'
                     })
                 
-                cart[product_id]['quantity'] = quantity
-                session['cart'] = cart
-                
-                # Calculate new subtotal and cart total
-                subtotal = float(product.price) * quantity
-                
-                # Get cart total
-                total = 0
-                for pid, item in cart.items():
-                    product = Product.query.get(int(pid))
-                    if product:
-                        total += float(product.price) * item.get('quantity', 1)
+                save_anonymous_cart(updated)
                 
                 return jsonify({
                     'success': True,
-                    'subtotal': subtotal,
-                    'total': total
+                    'subtotal': float(line.subtotal),
+                    'total': float(summary.total)
                 })
     
     return jsonify({'success': False, 'message': 'Failed to update cart'})
 
+# Apply several cart quantity changes in one request
+@app.route('/api/cart/batch', methods=['POST'])
+def batch_update_cart():
+    """
+    Apply many quantity changes and removals to the cart in one transaction.
+
+    Expects JSON {"items": [{"item_id": "12", "quantity": 3}, {"item_id": "session_7", "remove": true}]};
+    a quantity of 0 also removes the line. Either every change is applied or
+    none is, and the response carries the recomputed cart.
+    """
+    # Drivers and installers cannot update cart
+    if current_user.is_authenticated and current_user.is_driver():
+        return jsonify({'success': False, 'message': 'Access denied. Drivers cannot access shopping features.'}), 403
+    
+    if current_user.is_authenticated and current_user.is_installer():
+        return jsonify({'success': False, 'message': 'Access denied. Installers cannot access shopping features.'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    changes = data.get('items')
+    if not isinstance(changes, list) or not changes:
+        return jsonify({'success': False, 'message': 'items must be a non-empty list'}), 400
+    if len(changes) > 100:
+        return jsonify({'success': False, 'message': 'At most 100 items per batch'}), 400
+    
+    quantities = {}
+    for change in changes:
+        try:
+            item_id = str(change['item_id'])
+            quantity = 0 if change.get('remove') else int(change['quantity'])
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return jsonify({'success': False, 'message': 'Each item needs an item_id and a quantity'}), 400
+        if quantity < 0:
+            return jsonify({'success': False, 'message': 'Quantities cannot be negative'}), 400
+        quantities[item_id] = quantity
+    
+    if current_user.is_authenticated:
+        # One query checks ownership and stock for every line, then one DELETE and one UPDATE
+        errors = [{'item_id': item_id, 'message': 'Item not found', 'available': 0}
+                  for item_id in quantities if not item_id.isdigit()]
+        if not errors:
+            try:
+                errors = update_user_cart_lines(current_user.id, {int(item_id): quantity
+                                                                  for item_id, quantity in quantities.items()})
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f'Error updating cart: {str(e)}')
+                return jsonify({'success': False, 'message': 'Failed to update cart'}), 500
+        if not errors:
+            summary = price_user_cart(current_user.id)
+    else:
+        # Apply the changes to a copy and price it; the same query checks stock
+        cart = anonymous_cart()
+        updated = dict(cart)
+        errors = []
+        for item_id, quantity in quantities.items():
+            product_id = item_id[len('session_'):] if item_id.startswith('session_') else None
+            if product_id not in cart:
+                errors.append({'item_id': item_id, 'message': 'Item not found', 'available': 0})
+            elif quantity:
+                updated[product_id] = dict(cart[product_id], quantity=quantity)
+            else:
+                del updated[product_id]
+        
+        summary = price_session_cart(updated)
+        for item_id, quantity in quantities.items():
+            line = summary.line(item_id)
+            if quantity and line and not line.in_stock:
+                errors.append({'item_id': item_id, 'message': f'Only {line.product.stock} units available',
+                               'available': line.product.stock})
+        if not errors:
+            save_anonymous_cart(updated)
+    
+    if errors:
+        return jsonify({'success': False, 'message': 'Some items could not be updated', 'errors': errors}), 409
+    
+    return jsonify({'success': True, 'cart': cart_summary_json(summary)})
+
 # Remove item from cart
 @app.route('/cart/remove/<item_id>', methods=['DELETE', 'POST'])
 def remove_from_cart(item_id):
@@ -525,6 +728,7 @@ def remove_from_cart(item_id):
             
             if cart_item and cart_item.cart.user_id == current_user.id:
                 db.session.delete(cart_item)
+                refresh_item_counts(cart_ids=[cart_item.cart_id])
                 db.session.commit()
                 
                 if request.method == 'DELETE':
@@ -536,11 +740,11 @@ def remove_from_cart(item_id):
         if request.method == 'POST' or (item_id.startswith('session_') and request.method == 'DELETE'):
             if item_id.startswith('session_'):
                 product_id = item_id.split('_')[1]
-                cart = session.get('cart', {})
+                cart = anonymous_cart()
                 
                 if product_id in cart:
                     del cart[product_id]
-                    session['cart'] = cart
+                    save_anonymous_cart(cart)
                     
                     if request.method == 'DELETE':
                         return jsonify({'success': True})
@@ -555,6 +759,7 @@ def remove_from_cart(item_id):
 # Checkout page and order creation
 @app.route('/checkout', methods=['GET', 'POST'])
 @login_required
+@idempotent(store=redirects_only, state=lambda: cart_version(current_user.id))
 def checkout():
     """Checkout page and order creation"""
     # Drivers and installers cannot access checkout
@@ -577,28 +782,16 @@ def checkout():
         return redirect(url_for('login', next=url_for('checkout')))
     
     try:
-        cart_items = []
-        total = 0
-        
-        # Get cart items and total
-        cart = Cart.query.filter_by(user_id=current_user.id).first()
-        
-        if cart and cart.items:
-            for item in cart.items:
-                product = Product.query.get(item.product_id)
-                if product and product.stock >= item.quantity:
-                    subtotal = float(product.price) * item.quantity
-                    cart_items.append({
-                        'id': item.id,
-                        'product': product,
-                        'quantity': item.quantity,
-                        'subtotal': subtotal
-                    })
-                    total += subtotal
-                else:
-                    # Remove items that are out of stock or don't exist
-                    if item:
-                        db.session.delete(item)
+        # Price the cart once; the same lines and total are shown and written to the order
+        summary = price_user_cart(current_user.id, require_stock=True)
+        cart_items = summary.lines
+        total = summary.total
+        
+        # Remove items that are out of stock or don't exist
+        for item in summary.unavailable:
+            db.session.delete(item)
+        if summary.unavailable:
+            refresh_item_counts(cart_ids=[summary.cart_id])
         
         if cart_items:
             db.session.commit()
@@ -664,7 +857,17 @@ def checkout():
             
             # Create order
             try:
-                order = Order(
+                # Lines must fit in stock not held by other buyers; this buyer's own holds are used up
+                shortages = consume_holds(current_user.id, [(item.product.id, item.quantity) for item in cart_items])
+                if shortages:
+                    db.session.rollback()
+                    flash('Some items in your cart were just taken by other customers. Please review your cart.', 'warning')
+                    return redirect(url_for('cart'))
+                
+                # Stock, order, its lines and the emptied cart in a fixed number of statements
+                order_id, short = create_order(
+                    summary.cart_id,
+                    cart_items,
                     user_id=current_user.id,
                     payment_method_id=payment_method_id,
                     status='pending',
@@ -676,34 +879,18 @@ def checkout():
                     contact_phone=contact_phone,
                     contact_email=contact_email
                 )
-                
-                db.session.add(order)
-                db.session.flush()  # Get order ID without committing
-                
-                # Add order items
-                for item in cart_items:
-                    order_item = OrderItem(
-                        order_id=order.id,
-                        product_id=item['product'].id,
-                        quantity=item['quantity'],
-                        price=item['product'].price
-                    )
-                    db.session.add(order_item)
-                    
-                    # Update product stock
-                    product = item['product']
-                    product.stock -= item['quantity']
-                
-                # Empty cart
-                CartItem.query.filter_by(cart_id=cart.id).delete()
+                if short:
+                    db.session.rollback()
+                    flash('Some items in your cart just sold out. Please review your cart.', 'warning')
+                    return redirect(url_for('cart'))
                 
                 db.session.commit()
                 
                 # Redirect to payment page
                 if payment_method.code == 'card':
-                    return redirect(url_for('payment', order_id=order.id, payment_type='card'))
+                    return redirect(url_for('payment', order_id=order_id, payment_type='card'))
                 elif payment_method.code == 'mpesa':
-                    return redirect(url_for('payment', order_id=order.id, payment_type='mpesa'))
+                    return redirect(url_for('payment', order_id=order_id, payment_type='mpesa'))
 
                 else:
                     flash('Invalid payment method', 'danger')
@@ -732,6 +919,15 @@ def checkout():
             flash('No payment methods available. Please contact support.', 'danger')
             return redirect(url_for('cart'))
         
+        # Hold the cart's stock while the buyer fills in the form
+        shortages = reserve_lines(current_user.id, [(item.product.id, item.quantity) for item in cart_items])
+        if shortages:
+            db.session.rollback()
+            flash('Some items in your cart are currently held by other customers. Please try again shortly '
+                  'or reduce the quantity.', 'warning')
+            return redirect(url_for('cart'))
+        db.session.commit()
+        
         # Check if we have a direct payment method specified via query parameter
         preferred_payment = request.args.get('payment')
         preferred_method_id = None
@@ -762,6 +958,7 @@ def checkout():
 # Payment page for different payment methods
 @app.route('/payment/<int:order_id>/<payment_type>', methods=['GET', 'POST'])
 @login_required
+@idempotent(store=redirects_only, state=lambda order_id, **_: attempt_version(order_id))
 def payment(order_id, payment_type):
     """Payment page for different payment methods"""
     # Drivers and installers cannot access payment processing
@@ -785,6 +982,10 @@ def payment(order_id, payment_type):
         flash('Order has already been processed', 'warning')
         return redirect(url_for('order_confirmation', order_id=order.id))
     
+    # A payment already in flight: show its progress instead of charging again
+    if pending_attempt(order.id):
+        return redirect(url_for('payment_pending', order_id=order.id))
+    
     if payment_type == 'card':
         if request.method == 'POST':
             # Process card payment
@@ -800,25 +1001,18 @@ def payment(order_id, payment_type):
                 flash(error_message, 'danger')
                 return render_template('payment.html', order=order, payment_type=payment_type)
             
-            # Process payment
-            result = process_card_payment(order, {
+            # Queue the charge; the pending page polls until it settles
+            attempt = start_payment(order, 'card', {
                 'card_number': card_number,
                 'expiry': expiry,
                 'cvv': cvv,
                 'card_holder': card_holder
             })
             
-            if result['success']:
-                # Update order status and payment reference
-                order.status = 'paid'
-                order.payment_reference = result.get('transaction_id', 'N/A')
-                db.session.commit()
-                
-                flash('Payment successful! Your order has been confirmed.', 'success')
-                return redirect(url_for('my_orders'))
-            else:
-                flash(result.get('message', 'Payment failed'), 'danger')
+            if attempt.status == 'failed':
+                flash(attempt.message, 'danger')
                 return render_template('payment.html', order=order, payment_type=payment_type)
+            return redirect(url_for('payment_pending', order_id=order.id))
         
         return render_template('payment.html', order=order, payment_type=payment_type)
         
@@ -831,39 +1025,14 @@ def payment(order_id, payment_type):
                 flash('Phone number is required', 'danger')
                 return render_template('payment.html', order=order, payment_type=payment_type)
             
-            # Process payment
-            try:
-                result = process_mpesa_payment(order, phone_number)
-                print(f"M-Pesa payment result: {result}")  # Debug logging
-            except Exception as e:
-                print(f"Error in process_mpesa_payment: {str(e)}")  # Debug logging
-                import traceback
-                traceback.print_exc()
-                flash(f'Payment processing failed: {str(e)}', 'danger')
-                return render_template('payment.html', order=order, payment_type=payment_type)
+            # Queue the STK push; the pending page polls until the job or the callback settles it
+            attempt = start_payment(order, 'mpesa', {'phone_number': phone_number})
+            print(f"M-Pesa: queued payment attempt {attempt.id} for order {order.id}")  # Debug logging
             
-            if result['success']:
-                # Update order status and payment reference
-                try:
-                    order.status = 'paid'
-                    order.payment_reference = result.get('transaction_id', 'N/A')
-                    db.session.commit()
-                    print(f"M-Pesa: Order {order.id} status updated to paid")  # Debug logging
-                    
-                    # For test environment, automatically redirect to My Orders
-                    if result.get('dev_mode', False):
-                        flash('Payment processed successfully in test mode! Check your order in My Orders.', 'success')
-                    else:
-                        flash('Payment successful! Your order has been confirmed.', 'success')
-                    return redirect(url_for('my_orders'))
-                except Exception as e:
-                    print(f"M-Pesa: Error updating order status: {str(e)}")  # Debug logging
-                    db.session.rollback()
-                    flash(f'Payment completed but order update failed: {str(e)}', 'danger')
-                    return render_template('payment.html', order=order, payment_type=payment_type)
-            else:
-                flash(result.get('message', 'Payment failed'), 'danger')
+            if attempt.status == 'failed':
+                flash(attempt.message, 'danger')
                 return render_template('payment.html', order=order, payment_type=payment_type)
+            return redirect(url_for('payment_pending', order_id=order.id))
         
         return render_template('payment.html', order=order, payment_type=payment_type)
         
@@ -872,6 +1041,60 @@ def payment(order_id, payment_type):
     flash('Invalid payment method', 'danger')
     return redirect(url_for('checkout'))
 
+# Payment in progress
+@app.route('/payment/pending/<int:order_id>')
+@login_required
+def payment_pending(order_id):
+    """Payment pending page; polls payment_status until the attempt settles"""
+    order = Order.query.filter_by(id=order_id, user_id=current_user.id).first_or_404()
+    status = payment_status(order.id, current_user.id)
+    if status is None:
+        return redirect(url_for('order_confirmation', order_id=order.id))
+    
+    return render_template('payment_pending.html', order=order, payment=status,
+                           status_url=url_for('payment_status_api', order_id=order.id))
+
+# Payment status for the pending page
+@app.route('/api/payment/status/<int:order_id>')
+@login_required
+def payment_status_api(order_id):
+    """Latest payment attempt for an order, cheap enough to poll every couple of seconds"""
+    status = payment_status(order_id, current_user.id)
+    if status is None:
+        return jsonify({'success': False, 'message': 'No payment found for this order'}), 404
+    
+    data = {
+        'success': True,
+        'attempt_id': status.attempt_id,
+        'method': status.method,
+        'status': status.status,
+        'order_status': status.order_status,
+        'message': status.message,
+    }
+    if status.status == 'succeeded':
+        data['redirect_url'] = url_for('my_orders')
+    elif status.status == 'failed':
+        data['retry_url'] = url_for('payment', order_id=order_id, payment_type=status.method)
+    return with_cache_control(jsonify(data))
+
+# M-Pesa STK callback
+@app.route('/mpesa/callback', methods=['POST'])
+def mpesa_callback():
+    """Store the callback and acknowledge at once; callback_worker applies it in batches"""
+    payload = request.get_json(silent=True)
+    try:
+        new = ingest_callback(payload, request.get_data(as_text=True))
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f'Error storing M-Pesa callback: {str(e)}')
+        # Anything but an acknowledgement makes Daraja deliver it again
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Temporary error, please retry'}), 500
+    
+    if new is None:
+        return jsonify({'ResultCode': 1, 'ResultDesc': 'Invalid callback data'}), 400
+    print(f"DEBUG: M-Pesa callback {'stored' if new else 'duplicate'}")
+    return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'})
+
 # Payment success page
 @app.route('/payment/success')
 @login_required
@@ -915,9 +1138,12 @@ def add_review(product_id):
     
     if existing_review:
         # Update existing review
+        previous_rating = existing_review.rating
         existing_review.rating = rating
         existing_review.comment = comment
+        product.record_rating(rating, previous_rating=previous_rating)
         db.session.commit()
+        products_changed([product_id])
         flash('Your review has been updated', 'success')
     else:
         # Add new review
@@ -929,7 +1155,9 @@ def add_review(product_id):
         )
         
         db.session.add(review)
+        product.record_rating(rating)
         db.session.commit()
+        products_changed([product_id])
         
         flash('Your review has been added', 'success')
     
@@ -1086,12 +1314,15 @@ def customer_dashboard():
         flash('Access denied. Customer account required.', 'error')
         return redirect(url_for('index'))
     
-    # Get customer-specific data
-    customer_orders = Order.query.filter(Order.user_id == current_user.id).order_by(Order.created_at.desc()).all()
+    # Get customer-specific data, one page of orders (with their lines) at a time
+    customer_orders = order_history_page(current_user.id, cursor=request.args.get('cursor'))
     customer_reviews = Review.query.filter(Review.user_id == current_user.id).all()
     
     return render_template('dashboards/customer_dashboard.html',
-                         customer_orders=customer_orders,
+                         customer_orders=customer_orders.items,
+                         next_cursor=customer_orders.next_cursor,
+                         prev_cursor=customer_orders.prev_cursor,
+                         order_counts=order_counts(current_user.id),
                          customer_reviews=customer_reviews)
 
 # 404 Page not found
@@ -1110,24 +1341,17 @@ def server_error(e):
 @app.route('/api/cart/count')
 def cart_count():
     """Return the number of items in the cart"""
-    count = 0
-    
     if current_user.is_authenticated:
-        # Get cart for authenticated user
-        cart = Cart.query.filter_by(user_id=current_user.id).first()
-        if cart:
-            count = sum(item.quantity for item in cart.items)
+        # Single-column read of the counter the cart routes maintain
+        count = user_cart_count(current_user.id)
+        owner = current_user.id
     else:
-        # Get cart from session for non-authenticated user
-        cart_data = session.get('cart', {})
-        count = 0
-        for product_id, item in cart_data.items():
-            # Verify product exists
-            product = Product.query.get(int(product_id))
-            if product:
-                count += item.get('quantity', 0)
+        # Anonymous carts live in the cart store, one key lookup and a sum
+        count = session_cart_count(anonymous_cart())
+        owner = None
     
-    return jsonify({'count': count})
+    # The badge polls this on every page; unchanged counts get a 304
+    return conditional_response(('cart_count', owner, count), lambda: jsonify({'count': count}), public=False)
 
 def initialize_payment_methods():
     """Initialize payment methods if they don't exist."""
@@ -1316,11 +1540,14 @@ def seed_db():
         )
         db.session.add(product)
     
+    db.session.flush()
+    rebuild_search_index()
     db.session.commit()
 
 # Initialize database
 with app.app_context():
     initialize_payment_methods()
+    ensure_search_index()
     seed_db()
 
 # Inventory management page (admin only)
@@ -1362,13 +1589,22 @@ def inventory():
             )
         )
     
-    # Pagination
-    page = request.args.get('page', 1, type=int)
+    # Pagination: by cursor unless a page number was asked for (?page=N from numbered links)
+    page, cursor = page_or_cursor(request.args)
     per_page = 10
-    products = query.paginate(page=page, per_page=per_page, error_out=False)
+    sort = request.args.get('sort', 'name_asc')
+    if sort not in KEYSET_SORTS:
+        sort = 'name_asc'
+    if cursor is not None or 'page' not in request.args:
+        products = paginate_by_cursor(query, sort, cursor, per_page, 'inventory')
+    else:
+        key_column, descending = KEYSET_SORTS[sort]
+        query = query.order_by(key_column.desc() if descending else key_column.asc(),
+                               Product.id.desc() if descending else Product.id.asc())
+        products = query.paginate(page=page, per_page=per_page, error_out=False)
     
     # Get all categories for filtering
-    categories = Category.query.all()
+    categories = category_cache.all()
     
     # Get inventory stats
     total_products = Product.query.count()
@@ -1390,7 +1626,8 @@ def inventory():
                          current_filters={
                              'category': category_filter,
                              'stock': stock_filter,
-                             'search': search_query
+                             'search': search_query,
+                             'sort': sort
                          })
     
 # Add a new product or update an existing one
@@ -1447,7 +1684,10 @@ def add_product():
         if int(stock) != product.stock:
             product.stock = stock
             
+        db.session.flush()
+        index_products([product.id])
         db.session.commit()
+        products_changed([product.id])
         message = 'Product updated successfully'
     else:  # Add new product
         product = Product(
@@ -1462,7 +1702,10 @@ def add_product():
         )
         
         db.session.add(product)
+        db.session.flush()  # Get product ID for the search index
+        index_products([product.id])
         db.session.commit()
+        products_changed([product.id])
         message = 'Product added successfully'
         
     return jsonify({'success': True, 'message': message, 'product_id': product.id})
@@ -1490,14 +1733,17 @@ def delete_product(product_id):
     cart_items = CartItem.query.filter_by(product_id=product_id).all()
     for item in cart_items:
         db.session.delete(item)
+    refresh_item_counts(cart_ids={item.cart_id for item in cart_items})
         
     # Delete reviews
     reviews = Review.query.filter_by(product_id=product_id).all()
     for review in reviews:
         db.session.delete(review)
         
+    remove_products_from_index([product_id])
     db.session.delete(product)
     db.session.commit()
+    products_changed([product_id])
     
     return jsonify({'success': True, 'message': 'Product deleted successfully'})
     
@@ -1536,6 +1782,7 @@ def update_stock():
         
     product.updated_at = datetime.utcnow()
     db.session.commit()
+    products_changed([product.id])
     
     return jsonify({
         'success': True, 
@@ -1554,22 +1801,30 @@ def get_product(product_id):
     if not current_user.is_admin():
         return jsonify({'success': False, 'message': 'Access denied. Admin privileges required.'}), 403
         
-    product = Product.query.get_or_404(product_id)
-    
-    return jsonify({
-        'success': True,
-        'product': {
-            'id': product.id,
-            'name': product.name,
-            'category_id': product.category_id,
-            'price': float(product.price),
-            'stock': product.stock,
-            'description': product.description or '',
-            'image_url': product.image_url or '',
-            'slug': product.slug,
-            'featured': product.featured
-        }
-    })
+    stamp = db.session.query(Product.updated_at, Product.rating_count).filter_by(id=product_id).first()
+    if stamp is None:
+        abort(404)
+    
+    def render():
+        product = Product.query.get_or_404(product_id)
+        
+        return jsonify({
+            'success': True,
+            'product': {
+                'id': product.id,
+                'name': product.name,
+                'category_id': product.category_id,
+                'price': float(product.price),
+                'stock': product.stock,
+                'description': product.description or '',
+                'image_url': product.image_url or '',
+                'slug': product.slug,
+                'featured': product.featured
+            }
+        })
+    
+    return conditional_response(('get_product', product_id) + tuple(stamp), render, stamp.updated_at,
+                                public=False, vary_cookie=False)
 
 # Bulk actions for products
 @app.route('/api/products/bulk', methods=['POST'])
@@ -1594,6 +1849,8 @@ def bulk_product_actions():
     if not products:
         return jsonify({'success': False, 'message': 'No products found'}), 404
         
+    found_ids = [product.id for product in products]
+    
     try:
         if action == 'delete':
             # Check if any product is in orders
@@ -1603,6 +1860,7 @@ def bulk_product_actions():
                     return jsonify({'success': False, 'message': f'Cannot delete "{product.name}" - it has been ordered. Consider marking it as out of stock instead.'}), 400
             
             # Delete products
+            remove_products_from_index(found_ids)
             for product in products:
                 db.session.delete(product)
             message = f'Successfully deleted {len(products)} products'
@@ -1629,6 +1887,7 @@ def bulk_product_actions():
             return jsonify({'success': False, 'message': 'Invalid action'}), 400
             
         db.session.commit()
+        products_changed(found_ids)
         return jsonify({'success': True, 'message': message})
         
     except Exception as e:
@@ -2035,8 +2294,12 @@ def my_orders():
         flash('Access denied. Support staff cannot access personal order history.', 'error')
         return redirect(url_for('support_dashboard'))
         
-    orders = Order.query.filter_by(user_id=current_user.id).order_by(Order.created_at.desc()).all()
-    return render_template('my_orders.html', orders=orders)
+    # One page of orders with their items and products loaded up front
+    orders = order_history_page(current_user.id, cursor=request.args.get('cursor'))
+    return render_template('my_orders.html', orders=orders.items,
+                         next_cursor=orders.next_cursor,
+                         prev_cursor=orders.prev_cursor,
+                         order_counts=order_counts(current_user.id))
 
 @app.route('/orders/<int:order_id>/delete', methods=['POST'])
 @login_required
@@ -2065,6 +2328,9 @@ def delete_order(order_id):
             if product:
                 product.stock += item.quantity
         
+        # Log the cancellation first; events outlive the order
+        transition(order, 'cancelled', actor_id=current_user.id, note='deleted by customer')
+        
         # Delete the order (this will cascade delete order items)
         db.session.delete(order)
         db.session.commit()
@@ -2079,6 +2345,7 @@ def delete_order(order_id):
 
 @app.route('/payment/process/<int:order_id>', methods=['POST'])
 @login_required
+@idempotent(state=attempt_version)
 def process_payment_directly(order_id):
     """Process payment for an existing order directly"""
     # Drivers, installers, and support staff cannot process payments
@@ -2108,57 +2375,37 @@ def process_payment_directly(order_id):
         if not payment_method:
             return jsonify({'success': False, 'message': 'Invalid payment method'}), 400
             
-        # Process payment based on method
-        if payment_method.code == 'mpesa':
-            if not phone_number:
-                return jsonify({'success': False, 'message': 'Phone number is required for M-Pesa'}), 400
-                
-            from payment import process_mpesa_payment
-            result = process_mpesa_payment(order, phone_number)
+        # Don't charge twice while a payment is in flight
+        attempt = pending_attempt(order.id)
+        if attempt:
+            return jsonify({
+                'success': True,
+                'pending': True,
+                'attempt_id': attempt.id,
+                'message': 'A payment for this order is already in progress',
+                'status_url': url_for('payment_status_api', order_id=order.id)
+            }), 202
             
-            if result.get('success'):
-                # Update order status and payment reference
-                order.status = 'paid'
-                order.payment_reference = result.get('transaction_id')
-                db.session.commit()
-                
-                return jsonify({
-                    'success': True, 
-                    'payment_method': 'mpesa',
-                    'message': 'M-Pesa payment initiated successfully',
-                    'transaction_id': result.get('transaction_id'),
-                    'redirect_url': '/orders'
-                })
-            else:
-                return jsonify({
-                    'success': False, 
-                    'message': result.get('message', 'M-Pesa payment failed')
-                }), 400
-                
-
+        # Queue the gateway call based on method; clients poll status_url for the outcome
+        if payment_method.code in ('mpesa', 'card'):
+            if payment_method.code == 'mpesa' and not phone_number:
+                return jsonify({'success': False, 'message': 'Phone number is required for M-Pesa'}), 400
                 
-        elif payment_method.code == 'card':
-            # For card payments, we'll simulate success
-            from payment import process_card_payment
-            result = process_card_payment(order)
-            
-            if result.get('success'):
-                order.status = 'paid'
-                order.payment_reference = result.get('transaction_id')
-                db.session.commit()
+            details = {'phone_number': phone_number} if payment_method.code == 'mpesa' else None
+            attempt = start_payment(order, payment_method.code, details)
+            if attempt.status == 'failed':
+                return jsonify({'success': False, 'message': attempt.message}), 503
                 
-                return jsonify({
-                    'success': True, 
-                    'payment_method': 'card',
-                    'redirect_url': '/orders',
-                    'message': 'Card payment completed successfully',
-                    'transaction_id': result.get('transaction_id')
-                })
-            else:
-                return jsonify({
-                    'success': False, 
-                    'message': result.get('message', 'Card payment failed')
-                }), 400
+            return jsonify({
+                'success': True,
+                'pending': True,
+                'payment_method': payment_method.code,
+                'attempt_id': attempt.id,
+                'message': 'M-Pesa payment initiated, confirm it on your phone' if payment_method.code == 'mpesa'
+                           else 'Card payment is being processed',
+                'status_url': url_for('payment_status_api', order_id=order.id),
+                'redirect_url': url_for('payment_pending', order_id=order.id)
+            }), 202
         else:
             return jsonify({'success': False, 'message': 'Unsupported payment method'}), 400
             
@@ -2188,6 +2435,10 @@ def add_delivery_comment():
         # Verify order exists
         order = Order.query.get_or_404(order_id)
         
+        # Only paid or shipped orders can be delivered
+        if delivery_status == 'delivered' and order.status != 'delivered' and not can_transition(order.status, 'delivered'):
+            return jsonify({'success': False, 'message': f'Order is {order.status} and cannot be marked delivered'}), 400
+        
         # Create delivery comment
         delivery_comment = DeliveryComment(
             order_id=order_id,
@@ -2201,7 +2452,7 @@ def add_delivery_comment():
         
         # Update order status if delivery is completed
         if delivery_status == 'delivered':
-            order.status = 'delivered'
+            transition(order, 'delivered', actor_id=current_user.id)
         
         db.session.commit()
         
@@ -2256,9 +2507,9 @@ def add_installation_comment():
         
         db.session.add(installation_comment)
         
-        # Update order status based on installation status
-        if installation_status == 'completed':
-            order.status = 'shipped'  # Ready for delivery
+        # Update order status based on installation status (never moves a delivered or unpaid order)
+        if installation_status == 'completed' and can_transition(order.status, 'shipped'):
+            transition(order, 'shipped', actor_id=current_user.id, note='installation completed')  # Ready for delivery
         
         db.session.commit()
         
@@ -2317,5 +2568,46 @@ def get_installation_comments(order_id):
     })
 
 
+# Per-worker cache statistics (admin only)
+@app.route('/api/admin/cache-stats')
+@login_required
+def cache_stats():
+    """Report cache hit rates for the worker that serves the request"""
+    if not current_user.is_admin():
+        return jsonify({'success': False, 'message': 'Access denied. Admin privileges required.'}), 403
+    
+    import os
+    
+    return jsonify({
+        'success': True,
+        'pid': os.getpid(),
+        'caches': {
+            'categories': category_cache.stats(),
+            'pages': page_cache.stats(),
+            'facets': facet_cache.stats(),
+            'suggestions': suggestions.stats()
+        }
+    })
+
+
+# Order status changes since a cursor, for dashboards and jobs that follow them (admin only)
+@app.route('/api/admin/order-events')
+@login_required
+def order_events_api():
+    """Order events after ?after=<event id>, oldest first; pass back the returned cursor to read on"""
+    if not current_user.is_admin():
+        return jsonify({'success': False, 'message': 'Access denied. Admin privileges required.'}), 403
+    
+    cursor = request.args.get('after', 0, type=int)
+    limit = min(max(request.args.get('limit', 100, type=int), 1), 500)
+    events = events_since(cursor, limit)
+    
+    return jsonify({
+        'success': True,
+        'events': [event_dict(event) for event in events],
+        'cursor': events[-1].id if events else cursor
+    })
+
+
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
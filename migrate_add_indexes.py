@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+"""
+Create the secondary indexes declared in models.py on an existing database
+
+db.create_all() only adds indexes together with new tables, so databases
+created before the indexes were declared need this script. On PostgreSQL
+every index is built with CREATE INDEX CONCURRENTLY, which doesn't block
+writes; a build that failed half way leaves an INVALID index behind, which is
+dropped and rebuilt. Other databases use a plain CREATE INDEX IF NOT EXISTS.
+Safe to re-run.
+
+Usage:
+    python migrate_add_indexes.py [--dry-run]
+"""
+
+import sys
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import CreateIndex
+
+from app import app, db
+
+
+def declared_indexes():
+    """Every index declared on a model, in table dependency order"""
+    for table in db.metadata.sorted_tables:
+        for index in sorted(table.indexes, key=lambda index: index.name):
+            yield table, index
+
+
+def invalid_postgresql_indexes(connection):
+    """Names of indexes left INVALID by an interrupted concurrent build"""
+    rows = connection.execute(text(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE NOT i.indisvalid"
+    ))
+    return {row[0] for row in rows}
+
+
+def create_index_sql(index, dialect):
+    """CREATE INDEX statement for this database, built online where supported"""
+    if dialect.name == 'postgresql':
+        index.dialect_options['postgresql']['concurrently'] = True
+    return str(CreateIndex(index, if_not_exists=True).compile(dialect=dialect))
+
+
+def migrate_add_indexes(dry_run=False):
+    with app.app_context():
+        engine = db.engine
+        inspector = inspect(engine)
+        created = 0
+
+        # CONCURRENTLY can't run inside a transaction block
+        with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            invalid = invalid_postgresql_indexes(connection) if engine.dialect.name == 'postgresql' else set()
+
+            for table, index in declared_indexes():
+                if not inspector.has_table(table.name):
+                    print(f"- Skipping {index.name}: table {table.name} doesn't exist yet")
+                    continue
+
+                existing = {existing_index['name'] for existing_index in inspector.get_indexes(table.name)}
+                if index.name in existing and index.name not in invalid:
+                    print(f"✓ {index.name} already exists")
+                    continue
+
+                statement = create_index_sql(index, engine.dialect)
+                if dry_run:
+                    print(statement)
+                    continue
+
+                if index.name in invalid:
+                    connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{index.name}"'))
+                    print(f"✓ Dropped invalid index {index.name}")
+
+                connection.execute(text(statement))
+                created += 1
+                print(f"✓ Created {index.name} on {table.name}")
+
+            if created and not dry_run:
+                connection.execute(text("ANALYZE"))
+
+        print(f"\n✅ {created} index(es) created")
+
+
+if __name__ == "__main__":
+    migrate_add_indexes(dry_run='--dry-run' in sys.argv[1:])
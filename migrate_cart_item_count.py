@@ -0,0 +1,42 @@
+#!/usr/bin/env python3
+"""
+Add the denormalized item_count column to carts and backfill it
+
+Run once before deploying the version of models.py that declares
+Cart.item_count. Safe to re-run: the column is added if missing and every
+cart's count is recomputed from its lines.
+"""
+
+from app import app, db
+from sqlalchemy import inspect, text
+
+def add_item_count_column():
+    """Add carts.item_count if the table doesn't have it yet"""
+    existing = {column['name'] for column in inspect(db.engine).get_columns('carts')}
+
+    if 'item_count' not in existing:
+        db.session.execute(text("ALTER TABLE carts ADD COLUMN item_count INTEGER NOT NULL DEFAULT 0"))
+        print("✓ Added carts.item_count")
+
+def backfill_item_counts():
+    """Recompute every cart's item count from cart_items"""
+    result = db.session.execute(text("""
+        UPDATE carts SET item_count = (
+            SELECT coalesce(sum(ci.quantity), 0) FROM cart_items ci WHERE ci.cart_id = carts.id
+        )
+    """))
+    print(f"✓ Backfilled item counts for {result.rowcount} carts")
+
+def migrate_cart_item_count():
+    with app.app_context():
+        try:
+            add_item_count_column()
+            backfill_item_counts()
+            db.session.commit()
+            print("\n✅ Cart item counts are up to date")
+        except Exception as e:
+            print(f"Error migrating cart item counts: {e}")
+            db.session.rollback()
+
+if __name__ == "__main__":
+    migrate_cart_item_count()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Make cart lines unique per (cart_id, product_id)
+
+Older code could insert the same product twice into a cart. This folds such
+duplicates into the oldest line (summing their quantities), then builds the
+unique index declared on CartItem, concurrently on PostgreSQL. Run it before
+deploying the version that merges carts with ON CONFLICT. Safe to re-run.
+"""
+
+from sqlalchemy import inspect, text
+
+from app import app, db
+from migrate_add_indexes import create_index_sql, invalid_postgresql_indexes
+from models import CartItem
+
+UNIQUE_INDEX = 'uq_cart_items_cart_product'
+
+def fold_duplicate_lines():
+    """Sum duplicate lines into the oldest one and delete the rest"""
+    merged = db.session.execute(text("""
+        UPDATE cart_items SET quantity = (
+            SELECT sum(d.quantity) FROM cart_items d
+            WHERE d.cart_id = cart_items.cart_id AND d.product_id = cart_items.product_id
+        )
+        WHERE id IN (
+            SELECT min(id) FROM cart_items GROUP BY cart_id, product_id HAVING count(*) > 1
+        )
+    """)).rowcount
+    deleted = db.session.execute(text("""
+        DELETE FROM cart_items WHERE id NOT IN (
+            SELECT min(id) FROM cart_items GROUP BY cart_id, product_id
+        )
+    """)).rowcount
+    db.session.commit()
+    print(f"✓ Folded duplicates into {merged} cart line(s), deleted {deleted}")
+
+def create_unique_index():
+    """Build the unique index, rebuilding it if a previous concurrent build failed"""
+    index = next(index for index in CartItem.__table__.indexes if index.name == UNIQUE_INDEX)
+    engine = db.engine
+
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        existing = {existing_index['name'] for existing_index in inspect(engine).get_indexes('cart_items')}
+        invalid = invalid_postgresql_indexes(connection) if engine.dialect.name == 'postgresql' else set()
+
+        if UNIQUE_INDEX in existing and UNIQUE_INDEX not in invalid:
+            print(f"✓ {UNIQUE_INDEX} already exists")
+            return
+
+        if UNIQUE_INDEX in invalid:
+            connection.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{UNIQUE_INDEX}"'))
+
+        connection.execute(text(create_index_sql(index, engine.dialect)))
+        print(f"✓ Created {UNIQUE_INDEX}")
+
+def migrate_cart_items_unique():
+    with app.app_context():
+        try:
+            fold_duplicate_lines()
+            create_unique_index()
+            print("\n✅ Cart lines are unique per product")
+        except Exception as e:
+            print(f"Error making cart lines unique: {e}")
+            db.session.rollback()
+
+if __name__ == "__main__":
+    migrate_cart_items_unique()
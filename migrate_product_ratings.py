@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""
+Add the denormalized rating columns to products and backfill them from reviews
+
+Run once before deploying the version of models.py that declares
+Product.rating_count / rating_sum / rating_N_count. Safe to re-run: missing
+columns are added and every product's aggregates are recomputed.
+"""
+
+from app import app, db
+from sqlalchemy import inspect, text
+
+RATING_COLUMNS = ['rating_count', 'rating_sum'] + [f'rating_{stars}_count' for stars in range(1, 6)]
+
+def add_rating_columns():
+    """Add any rating column that the products table doesn't have yet"""
+    existing = {column['name'] for column in inspect(db.engine).get_columns('products')}
+    
+    for column in RATING_COLUMNS:
+        if column not in existing:
+            db.session.execute(text(f"ALTER TABLE products ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0"))
+            print(f"✓ Added products.{column}")
+
+def backfill_ratings():
+    """Recompute every product's rating aggregates from the reviews table"""
+    histogram = ",\n".join(
+        f"rating_{stars}_count = (SELECT count(*) FROM reviews r WHERE r.product_id = products.id AND r.rating = {stars})"
+        for stars in range(1, 6)
+    )
+    result = db.session.execute(text(f"""
+        UPDATE products SET
+            rating_count = (SELECT count(*) FROM reviews r WHERE r.product_id = products.id),
+            rating_sum = (SELECT coalesce(sum(r.rating), 0) FROM reviews r WHERE r.product_id = products.id),
+            {histogram}
+    """))
+    print(f"✓ Backfilled ratings for {result.rowcount} products")
+
+def migrate_product_ratings():
+    with app.app_context():
+        try:
+            add_rating_columns()
+            backfill_ratings()
+            db.session.commit()
+            print("\n✅ Product rating aggregates are up to date")
+        except Exception as e:
+            print(f"Error migrating product ratings: {e}")
+            db.session.rollback()
+
+if __name__ == "__main__":
+    migrate_product_ratings()
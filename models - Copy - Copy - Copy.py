@@ -2,7 +2,6 @@ from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 from app import db
-from decimal import Decimal
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
@@ -76,9 +75,25 @@ class Product(db.Model):
     slug = db.Column(db.String(128), unique=True, nullable=False)
     featured = db.Column(db.Boolean, default=False)
     category_id = db.Column(db.Integer, db.ForeignKey('categories.id'), nullable=False)
+    # Review aggregates, maintained by record_rating()
+    rating_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_sum = db.Column(db.Integer, default=0, nullable=False)
+    rating_1_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_2_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_3_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_4_count = db.Column(db.Integer, default=0, nullable=False)
+    rating_5_count = db.Column(db.Integer, default=0, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    # Created on existing databases by migrate_add_indexes.py
+    __table_args__ = (
+        db.Index('ix_products_category_price', 'category_id', 'price'),
+        db.Index('ix_products_featured', 'featured', postgresql_where=featured == True, sqlite_where=featured == True),
+        db.Index('ix_products_in_stock', 'category_id', 'price', postgresql_where=stock > 0, sqlite_where=stock > 0),
+        db.Index('ix_products_updated_at', 'updated_at'),
+    )
+    
     order_items = db.relationship('OrderItem', backref='product', lazy=True)
     cart_items = db.relationship('CartItem', backref='product', lazy=True)
     reviews = db.relationship('Review', backref='product', lazy=True)
@@ -87,28 +102,79 @@ class Product(db.Model):
         return f'<Product {self.name}>'
     
     def average_rating(self):
-        if not self.reviews:
+        if not self.rating_count:
             return 0
         
-        total = sum(review.rating for review in self.reviews)
-        return total / len(self.reviews)
+        return self.rating_sum / self.rating_count
+    
+    def rating_histogram(self):
+        return {stars: getattr(self, f'rating_{stars}_count') or 0 for stars in range(1, 6)}
+    
+    def record_rating(self, rating, previous_rating=None):
+        """Fold a new or edited review into the rating aggregates.
+        
+        Issues a single UPDATE in the caller's transaction so concurrent reviews
+        can't lose increments. Pass previous_rating when a review is edited.
+        """
+        new_bucket = getattr(Product, f'rating_{rating}_count')
+        values = {Product.updated_at: datetime.utcnow()}
+        
+        if previous_rating is None:
+            values[Product.rating_count] = Product.rating_count + 1
+            values[Product.rating_sum] = Product.rating_sum + rating
+            values[new_bucket] = new_bucket + 1
+        elif previous_rating != rating:
+            old_bucket = getattr(Product, f'rating_{previous_rating}_count')
+            values[Product.rating_sum] = Product.rating_sum + (rating - previous_rating)
+            values[old_bucket] = old_bucket - 1
+            values[new_bucket] = new_bucket + 1
+        
+        Product.query.filter_by(id=self.id).update(values, synchronize_session=False)
+        db.session.expire(self)
+
+class ProductAssociation(db.Model):
+    """How many paid orders contained both products ("frequently bought together")"""
+    __tablename__ = 'product_associations'
+    
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    related_product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), primary_key=True)
+    order_count = db.Column(db.Integer, default=0, nullable=False)
+    
+    __table_args__ = (
+        db.Index('ix_product_associations_top', 'product_id', order_count.desc()),
+    )
+    
+    def __repr__(self):
+        return f'<ProductAssociation {self.product_id} -> {self.related_product_id} ({self.order_count})>'
+
+class CatalogVersion(db.Model):
+    """Counter bumped in the same transaction as every product insert or delete (see catalog_events.py)"""
+    __tablename__ = 'catalog_version'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    
+    def __repr__(self):
+        return f'<CatalogVersion {self.version}>'
 
 class Cart(db.Model):
     __tablename__ = 'carts'
     
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    # Sum of item quantities, maintained by cart_service.refresh_item_counts()
+    item_count = db.Column(db.Integer, default=0, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_carts_user_id', 'user_id'),
+    )
+    
     items = db.relationship('CartItem', backref='cart', lazy=True, cascade="all, delete-orphan")
     
     def __repr__(self):
         return f'<Cart {self.id} for User {self.user_id}>'
-    
-    def total(self):
-        total = sum(item.subtotal() for item in self.items)
-        return total
 
 class CartItem(db.Model):
     __tablename__ = 'cart_items'
@@ -118,11 +184,13 @@ class CartItem(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
     quantity = db.Column(db.Integer, default=1, nullable=False)
     
+    # One line per product; adding it again bumps the quantity (see cart_service.add_to_user_cart)
+    __table_args__ = (
+        db.Index('uq_cart_items_cart_product', 'cart_id', 'product_id', unique=True),
+    )
+    
     def __repr__(self):
         return f'<CartItem {self.id} - {self.quantity} x Product {self.product_id}>'
-    
-    def subtotal(self):
-        return Decimal(self.product.price) * self.quantity
 
 class PaymentMethod(db.Model):
     __tablename__ = 'payment_methods'
@@ -155,6 +223,13 @@ class Order(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_orders_user_created', 'user_id', 'created_at'),
+        db.Index('ix_orders_status_created', 'status', 'created_at'),
+        db.Index('ix_orders_payment_reference', 'payment_reference',
+                 postgresql_where=payment_reference.isnot(None), sqlite_where=payment_reference.isnot(None)),
+    )
+    
     items = db.relationship('OrderItem', backref='order', lazy=True, cascade="all, delete-orphan")
     delivery_comments = db.relationship('DeliveryComment', backref='order', lazy=True, cascade="all, delete-orphan")
     installation_comments = db.relationship('InstallationComment', backref='order', lazy=True, cascade="all, delete-orphan")
@@ -170,13 +245,126 @@ class OrderItem(db.Model):
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
     quantity = db.Column(db.Integer, nullable=False)
     price = db.Column(db.Numeric(10, 2), nullable=False)
-    
+
+    # Order history loads a page's lines with order_id IN (...) and sums item counts from the index alone
+    __table_args__ = (
+        db.Index('ix_order_items_order', 'order_id', 'quantity'),
+    )
+
     def __repr__(self):
         return f'<OrderItem {self.id}>'
     
     def subtotal(self):
         return self.price * self.quantity
 
+class StockReservation(db.Model):
+    __tablename__ = 'stock_reservations'
+
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('products.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    # Held stock per product is summed from the first index alone (see reservations.available_stock)
+    __table_args__ = (
+        db.Index('ix_stock_reservations_product_expires', 'product_id', 'expires_at', 'quantity'),
+        db.Index('ix_stock_reservations_user', 'user_id'),
+        db.Index('ix_stock_reservations_expires_at', 'expires_at'),
+    )
+
+    def __repr__(self):
+        return f'<StockReservation {self.quantity} x Product {self.product_id} for User {self.user_id}>'
+
+class PaymentAttempt(db.Model):
+    __tablename__ = 'payment_attempts'
+
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, db.ForeignKey('orders.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    method = db.Column(db.String(20), nullable=False)  # mpesa, card
+    status = db.Column(db.String(20), nullable=False, default='pending')  # pending, succeeded, failed
+    reference = db.Column(db.String(128), nullable=True)  # gateway transaction / M-Pesa CheckoutRequestID
+    message = db.Column(db.String(256), nullable=True)
+    idempotency_key = db.Column(db.String(64), nullable=True)  # released when the attempt fails, see idempotency.py
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, nullable=True)
+
+    # The status endpoint reads the latest attempt per order; callbacks find theirs by reference
+    __table_args__ = (
+        db.Index('ix_payment_attempts_order', 'order_id', 'id'),
+        db.Index('ix_payment_attempts_reference', 'reference',
+                 postgresql_where=reference.isnot(None), sqlite_where=reference.isnot(None)),
+    )
+
+    def __repr__(self):
+        return f'<PaymentAttempt {self.id} {self.method} {self.status} for Order {self.order_id}>'
+
+class MpesaCallback(db.Model):
+    __tablename__ = 'mpesa_callbacks'
+
+    # Append-only: rows are inserted as received and never edited, except that
+    # the callback worker stamps processed_at/outcome once it has applied them
+    id = db.Column(db.Integer, primary_key=True)
+    checkout_request_id = db.Column(db.String(128), unique=True, nullable=False)  # duplicate deliveries are dropped
+    merchant_request_id = db.Column(db.String(128), nullable=True)
+    result_code = db.Column(db.Integer, nullable=False)
+    result_desc = db.Column(db.String(256), nullable=True)
+    payload = db.Column(db.Text, nullable=False)  # raw JSON body, for replays
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    processed_at = db.Column(db.DateTime, nullable=True)
+    outcome = db.Column(db.String(20), nullable=True)  # paid, failed, unmatched
+
+    __table_args__ = (
+        db.Index('ix_mpesa_callbacks_unprocessed', 'id',
+                 postgresql_where=processed_at.is_(None), sqlite_where=processed_at.is_(None)),
+    )
+
+    def __repr__(self):
+        return f'<MpesaCallback {self.checkout_request_id} {self.result_code}>'
+
+class OrderEvent(db.Model):
+    __tablename__ = 'order_events'
+
+    # Append-only log of order status changes, written by order_status.transition()
+    # in the same transaction as the change. Consumers keep the last id they have
+    # seen and read on from there (order_status.events_since). order_id is not a
+    # foreign key so events outlive deleted orders.
+    id = db.Column(db.Integer, primary_key=True)
+    order_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=False)  # the order's customer
+    from_status = db.Column(db.String(32), nullable=True)  # None when the order was created
+    to_status = db.Column(db.String(32), nullable=False)
+    actor_id = db.Column(db.Integer, nullable=True)  # user who caused it, None for payment callbacks and jobs
+    note = db.Column(db.String(256), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_order_events_order', 'order_id', 'id'),
+        db.Index('ix_order_events_user', 'user_id', 'id'),
+    )
+
+    def __repr__(self):
+        return f'<OrderEvent {self.id} Order {self.order_id} {self.from_status} -> {self.to_status}>'
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    # sha256 of (user, endpoint, client key, request fingerprint), see idempotency.py
+    id = db.Column(db.String(64), primary_key=True)
+    endpoint = db.Column(db.String(100), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='in_progress')  # in_progress, completed
+    response_status = db.Column(db.Integer, nullable=True)
+    response_headers = db.Column(db.Text, nullable=True)  # JSON
+    response_body = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.endpoint} {self.status}>'
+
 class Review(db.Model):
     __tablename__ = 'reviews'
     
@@ -187,6 +375,10 @@ class Review(db.Model):
     comment = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_reviews_product_created', 'product_id', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<Review {self.id} - {self.rating} stars>'
 
@@ -202,6 +394,14 @@ class SupportTicket(db.Model):
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_support_tickets_status_created', 'status', 'created_at'),
+        # Staff dashboards only ever list tickets that are still being worked on
+        db.Index('ix_support_tickets_open', 'created_at',
+                 postgresql_where=status.in_(['open', 'in_progress']),
+                 sqlite_where=status.in_(['open', 'in_progress'])),
+    )
+    
     # Relationships
     user = db.relationship('User', backref='support_tickets', lazy=True)
     messages = db.relationship('TicketMessage', backref='ticket', lazy=True, cascade="all, delete-orphan")
@@ -256,6 +456,10 @@ class ChatMessage(db.Model):
     is_system_message = db.Column(db.Boolean, default=False, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_chat_messages_session_created', 'session_id', 'created_at'),
+    )
+    
     def __repr__(self):
         return f'<ChatMessage {self.id} in Session {self.session_id}>'
 
@@ -294,6 +498,10 @@ class DeliveryComment(db.Model):
     delivery_rating = db.Column(db.Integer, nullable=True)  # 1-5 rating for delivery experience
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_delivery_comments_order_created', 'order_id', 'created_at'),
+    )
+    
     # Relationships
     driver = db.relationship('User', backref='delivery_comments', lazy=True)
     
@@ -314,6 +522,10 @@ class InstallationComment(db.Model):
     estimated_completion_date = db.Column(db.DateTime, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
+    __table_args__ = (
+        db.Index('ix_installation_comments_order_created', 'order_id', 'created_at'),
+    )
+    
     # Relationships
     installer = db.relationship('User', backref='installation_comments', lazy=True)
     
@@ -0,0 +1,200 @@
+"""
+Daraja (M-Pesa) API client
+
+One long-lived client per worker process, from mpesa_client():
+
+- a requests.Session with a keep-alive connection pool, so STK pushes reuse
+  TLS connections instead of opening one per call
+- the OAuth token is cached until MPESA_TOKEN_MARGIN seconds before it
+  expires; when it does, one thread fetches a new one while the others wait
+  for it (single flight) rather than all asking Daraja at once
+- connect/read timeouts and retries with exponential backoff on every call;
+  POSTs are only retried when the connection failed, so a customer never
+  gets a second STK prompt for one payment
+
+Point MPESA_BASE_URL at fake_daraja.py to exercise it offline.
+"""
+import base64
+import threading
+import time
+from datetime import datetime
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from app import app
+
+SANDBOX_URL = 'https://sandbox.safaricom.co.ke'
+TOKEN_PATH = '/oauth/v1/generate?grant_type=client_credentials'
+STK_PUSH_PATH = '/mpesa/stkpush/v1/processrequest'
+
+
+class MpesaError(Exception):
+    """Daraja couldn't be reached or refused the request"""
+
+
+class MpesaClient:
+    """
+    Thread-safe Daraja client with pooled connections and a cached token.
+
+    Args:
+        consumer_key, consumer_secret: app credentials for the OAuth endpoint
+        shortcode, passkey: paybill/till used for STK pushes
+        callback_url: where Daraja posts STK results (the /mpesa/callback route)
+        base_url: Daraja host, the sandbox by default
+        timeout: (connect, read) seconds per request
+        retries: attempts after the first on connection errors and 429/5xx answers
+        backoff: base of the exponential backoff between retries, in seconds
+        pool_size: keep-alive connections kept per host
+        token_margin: seconds before expiry a cached token is replaced
+    """
+
+    def __init__(self, consumer_key, consumer_secret, shortcode, passkey, callback_url,
+                 base_url=SANDBOX_URL, timeout=(3.05, 10), retries=3, backoff=0.5,
+                 pool_size=10, token_margin=60):
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.shortcode = shortcode
+        self.passkey = passkey
+        self.callback_url = callback_url
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.token_margin = token_margin
+        self.token_fetches = 0
+
+        self._token = None
+        self._token_expires = 0.0
+        self._token_lock = threading.Lock()
+
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=frozenset({'GET'}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @property
+    def configured(self):
+        return all([self.consumer_key, self.consumer_secret, self.shortcode, self.passkey])
+
+    def _request(self, method, path, **kwargs):
+        try:
+            response = self.session.request(method, self.base_url + path, timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            raise MpesaError(f'M-Pesa request failed: {e}') from e
+        return response
+
+    def get_auth_token(self):
+        """The cached OAuth token, fetched again shortly before it expires"""
+        if self._token and time.monotonic() < self._token_expires:
+            return self._token
+        with self._token_lock:
+            # Whoever waited on the lock finds the token the first thread fetched
+            if self._token and time.monotonic() < self._token_expires:
+                return self._token
+            response = self._request('GET', TOKEN_PATH, auth=(self.consumer_key, self.consumer_secret))
+            if response.status_code != 200:
+                raise MpesaError(f'M-Pesa authentication failed: HTTP {response.status_code}')
+            data = response.json()
+            self.token_fetches += 1
+            self._token = data['access_token']
+            self._token_expires = time.monotonic() + max(int(data.get('expires_in', 3599)) - self.token_margin, 0)
+            return self._token
+
+    def invalidate_token(self, token):
+        """Drop the cached token if it is still the one Daraja just rejected"""
+        with self._token_lock:
+            if self._token == token:
+                self._token = None
+
+    def stk_push_payload(self, phone_number, amount, order_id):
+        timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
+        password = base64.b64encode(f'{self.shortcode}{self.passkey}{timestamp}'.encode()).decode()
+        return {
+            'BusinessShortCode': self.shortcode,
+            'Password': password,
+            'Timestamp': timestamp,
+            'TransactionType': 'CustomerPayBillOnline',
+            'Amount': int(amount),
+            'PartyA': phone_number,
+            'PartyB': self.shortcode,
+            'PhoneNumber': phone_number,
+            'CallBackURL': self.callback_url,
+            'AccountReference': f'Order {order_id}',
+            'TransactionDesc': f'Mo Solar order {order_id}',
+        }
+
+    def initiate_stk_push(self, phone_number, amount, order_id):
+        """
+        Send an STK push prompt to the customer's phone.
+
+        A rejected token is replaced and the push sent once more; Daraja
+        refuses those before doing anything.
+
+        Returns:
+            dict: Daraja's response (CheckoutRequestID, ResponseCode, CustomerMessage...)
+        """
+        payload = self.stk_push_payload(phone_number, amount, order_id)
+        for _ in range(2):
+            token = self.get_auth_token()
+            response = self._request('POST', STK_PUSH_PATH, json=payload,
+                                     headers={'Authorization': f'Bearer {token}'})
+            if response.status_code != 401:
+                break
+            self.invalidate_token(token)
+
+        try:
+            data = response.json()
+        except ValueError:
+            data = {}
+        if response.status_code != 200:
+            raise MpesaError(data.get('errorMessage') or f'M-Pesa STK push failed: HTTP {response.status_code}')
+        return data
+
+    def close(self):
+        self.session.close()
+
+
+def format_phone_number(phone_number):
+    """07XXXXXXXX / +2547XXXXXXXX / 2547XXXXXXXX -> 2547XXXXXXXX"""
+    digits = ''.join(ch for ch in str(phone_number) if ch.isdigit())
+    if digits.startswith('0'):
+        digits = '254' + digits[1:]
+    elif len(digits) == 9:
+        digits = '254' + digits
+    return digits
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def mpesa_client():
+    """This worker's MpesaClient, built from the MPESA_* settings on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = MpesaClient(
+                    consumer_key=app.config.get('MPESA_CONSUMER_KEY'),
+                    consumer_secret=app.config.get('MPESA_CONSUMER_SECRET'),
+                    shortcode=app.config.get('MPESA_BUSINESS_SHORTCODE'),
+                    passkey=app.config.get('MPESA_PASSKEY'),
+                    callback_url=app.config.get('MPESA_CALLBACK_URL'),
+                    base_url=app.config.get('MPESA_BASE_URL') or SANDBOX_URL,
+                    timeout=(app.config.get('MPESA_CONNECT_TIMEOUT', 3.05), app.config.get('MPESA_TIMEOUT', 10)),
+                    retries=app.config.get('MPESA_RETRIES', 3),
+                    backoff=app.config.get('MPESA_BACKOFF', 0.5),
+                    pool_size=app.config.get('MPESA_POOL_SIZE', 10),
+                    token_margin=app.config.get('MPESA_TOKEN_MARGIN', 60),
+                )
+    return _client
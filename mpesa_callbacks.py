@@ -0,0 +1,239 @@
+"""
+M-Pesa STK callback ingestion
+
+Daraja retries a callback until it gets an answer, and sometimes delivers
+the same one twice, so the callback route only stores the raw body and
+acknowledges. The insert goes into the append-only mpesa_callbacks table,
+whose unique CheckoutRequestID turns duplicate deliveries into no-ops (ON
+CONFLICT DO NOTHING).
+
+A per-worker background thread, woken by every new callback, applies the
+stored callbacks in batches of MPESA_CALLBACK_BATCH. Each batch runs in one
+transaction:
+
+    1. claim the batch: UPDATE ... SET processed_at WHERE id IN (oldest unprocessed) RETURNING id
+    2. load the claimed callbacks, their payment attempts and orders (one query each)
+    3. settle attempts and orders through payment_jobs, stamp each callback's outcome
+    4. fold the newly paid orders into the recommendations with one query and one upsert
+
+Run replay_mpesa_callbacks.py to apply the backlog by hand when
+MPESA_CALLBACK_INTERVAL is 0, or to feed recorded payloads back in.
+"""
+import json
+import threading
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from db_helpers import dialect_insert
+from models import MpesaCallback, Order, PaymentAttempt
+from order_status import transition
+from payment_jobs import mark_failed, mark_paid
+from recommendations import record_orders_copurchases
+
+# How often an idle worker looks for callbacks another process stored
+IDLE_POLL = 30
+
+
+def parse_callback(payload):
+    """
+    Pull the fields we index out of an STK callback body.
+
+    Returns:
+        dict or None: checkout_request_id, merchant_request_id, result_code,
+        result_desc; None when the body isn't an STK callback
+    """
+    try:
+        result = payload['Body']['stkCallback']
+        return {
+            'checkout_request_id': str(result['CheckoutRequestID']),
+            'merchant_request_id': result.get('MerchantRequestID'),
+            'result_code': int(result['ResultCode']),
+            'result_desc': (result.get('ResultDesc') or '')[:256],
+        }
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def ingest_callback(payload, raw=None):
+    """
+    Store a callback unless its CheckoutRequestID is already stored. Commits.
+
+    Args:
+        payload: parsed JSON body
+        raw: body as received, stored verbatim; re-serialized from payload when omitted
+
+    Returns:
+        bool or None: True for a new callback, False for a duplicate delivery, None if invalid
+    """
+    fields = parse_callback(payload)
+    if fields is None:
+        return None
+    row = dict(fields, payload=raw or json.dumps(payload), received_at=datetime.utcnow())
+
+    stmt = dialect_insert(MpesaCallback)
+    if stmt is not None:
+        result = db.session.execute(
+            stmt.values(row).on_conflict_do_nothing(index_elements=['checkout_request_id'])
+        )
+        new = result.rowcount == 1
+    else:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(db.insert(MpesaCallback).values(row))
+            new = True
+        except IntegrityError:
+            new = False
+    db.session.commit()
+
+    if new:
+        callback_worker.wake()
+    return new
+
+
+def _claim_batch(batch_size, now):
+    """Stamp the oldest unprocessed callbacks as ours. Returns their ids."""
+    oldest = db.select(MpesaCallback.id) \
+        .where(MpesaCallback.processed_at.is_(None)) \
+        .order_by(MpesaCallback.id) \
+        .limit(batch_size)
+    if db.engine.dialect.name == 'postgresql':
+        # Workers in other processes skip the rows this one is applying
+        oldest = oldest.with_for_update(skip_locked=True)
+
+    claim = db.update(MpesaCallback) \
+        .where(MpesaCallback.id.in_(oldest.scalar_subquery())) \
+        .values(processed_at=now)
+    if db.engine.dialect.update_returning:
+        return db.session.execute(claim.returning(MpesaCallback.id),
+                                  execution_options={'synchronize_session': False}).scalars().all()
+    ids = db.session.execute(oldest).scalars().all()
+    db.session.execute(db.update(MpesaCallback).where(MpesaCallback.id.in_(ids)).values(processed_at=now),
+                       execution_options={'synchronize_session': False})
+    return ids
+
+
+def apply_callbacks(batch_size=None):
+    """
+    Apply one batch of stored callbacks to their payment attempts and orders, then commit.
+
+    Callbacks with a payment attempt settle it (and pay the order on
+    success); older orders whose payment_reference holds the
+    CheckoutRequestID are paid directly. Everything else is stamped
+    'unmatched' and left for a person to look at.
+
+    Returns:
+        int: callbacks applied, 0 when there was nothing to do
+    """
+    batch_size = batch_size or app.config.get('MPESA_CALLBACK_BATCH', 100)
+    now = datetime.utcnow()
+    ids = _claim_batch(batch_size, now)
+    if not ids:
+        db.session.rollback()
+        return 0
+
+    callbacks = MpesaCallback.query.filter(MpesaCallback.id.in_(ids)).order_by(MpesaCallback.id).all()
+    references = [callback.checkout_request_id for callback in callbacks]
+    attempts = {
+        attempt.reference: attempt
+        for attempt in PaymentAttempt.query.filter(PaymentAttempt.reference.in_(references))
+    }
+    orders = Order.query.filter(db.or_(
+        Order.id.in_({attempt.order_id for attempt in attempts.values()}),
+        Order.payment_reference.in_(references)
+    )).all()
+    orders_by_id = {order.id: order for order in orders}
+    orders_by_reference = {order.payment_reference: order for order in orders if order.payment_reference}
+
+    paid_order_ids = []
+    for callback in callbacks:
+        attempt = attempts.get(callback.checkout_request_id)
+        order = orders_by_id.get(attempt.order_id) if attempt else orders_by_reference.get(callback.checkout_request_id)
+
+        if order is None or (attempt is not None and attempt.status != 'pending'):
+            callback.outcome = 'unmatched'
+        elif callback.result_code != 0:
+            if attempt is not None:
+                mark_failed(attempt, callback.result_desc)
+            callback.outcome = 'failed'
+        else:
+            if attempt is not None:
+                if mark_paid(attempt, order, callback.checkout_request_id, record_copurchases=False):
+                    paid_order_ids.append(order.id)
+            elif order.status == 'pending':
+                transition(order, 'paid', note=f'mpesa {callback.checkout_request_id}')
+                paid_order_ids.append(order.id)
+            callback.outcome = 'paid'
+        callback.processed_at = now
+
+    record_orders_copurchases(paid_order_ids)
+    db.session.commit()
+    return len(callbacks)
+
+
+def drain_callbacks(batch_size=None):
+    """
+    Apply every stored callback, one batch per transaction.
+
+    Returns:
+        int: callbacks applied
+    """
+    batch_size = batch_size or app.config.get('MPESA_CALLBACK_BATCH', 100)
+    applied = 0
+    while True:
+        count = apply_callbacks(batch_size)
+        applied += count
+        if count < batch_size:
+            return applied
+
+
+class CallbackWorker:
+    """
+    Per-worker daemon thread draining stored callbacks.
+
+    Wakes on every new callback, then waits `interval` seconds so callbacks
+    arriving together are applied in one batch.
+    """
+
+    def __init__(self, interval=1.0, batch_size=100):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.applied = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    def wake(self):
+        if self.interval <= 0:
+            return
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='mpesa-callbacks', daemon=True)
+                    self._thread.start()
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(IDLE_POLL)
+            if self._stop.wait(self.interval):
+                return
+            self._wake.clear()
+            with app.app_context():
+                try:
+                    self.applied += drain_callbacks(self.batch_size)
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f'Error applying M-Pesa callbacks: {str(e)}')
+
+
+callback_worker = CallbackWorker(
+    interval=app.config.get('MPESA_CALLBACK_INTERVAL', 1),
+    batch_size=app.config.get('MPESA_CALLBACK_BATCH', 100)
+)
@@ -0,0 +1,67 @@
+"""
+Customer order history
+
+The profile, My Orders and the customer dashboard list a customer's orders
+newest first, a page at a time, with keyset paging on (created_at, id) so a
+customer with hundreds of orders costs the same as one with three:
+
+- order_history_page(): Order models with their items, products and payment
+  method loaded up front, three queries per page however many lines the
+  orders have. The order templates get these, since they read order.items,
+  order.payment_method and the shipping fields
+- order_counts(): orders per status and amount spent, for the headline
+  numbers the full list used to be counted for
+"""
+from collections import namedtuple
+from decimal import Decimal
+
+from sqlalchemy.orm import joinedload, selectinload
+
+from app import db
+from models import Order, OrderItem
+from pagination import InvalidCursor, keyset_paginate
+from recommendations import PURCHASED_STATUSES
+
+ORDER_HISTORY_PER_PAGE = 20
+
+OrderCounts = namedtuple('OrderCounts', 'total by_status spent')
+
+
+def _paginate(query, cursor, per_page, listing):
+    """Newest-first keyset page, falling back to the first page on a bad cursor"""
+    try:
+        return keyset_paginate(query, Order.created_at, True, cursor=cursor, per_page=per_page,
+                               listing=listing, id_column=Order.id, with_total=False)
+    except InvalidCursor:
+        return keyset_paginate(query, Order.created_at, True, per_page=per_page,
+                               listing=listing, id_column=Order.id, with_total=False)
+
+
+def order_history_page(user_id, cursor=None, per_page=ORDER_HISTORY_PER_PAGE):
+    """
+    A page of the customer's orders, each with its items and their products loaded.
+
+    Returns:
+        KeysetPage: Order rows, newest first
+    """
+    query = Order.query \
+        .filter(Order.user_id == user_id) \
+        .options(selectinload(Order.items).selectinload(OrderItem.product),
+                 joinedload(Order.payment_method))
+    return _paginate(query, cursor, per_page, 'order_history')
+
+
+def order_counts(user_id):
+    """
+    The customer's order totals, in one GROUP BY over their orders.
+
+    Returns:
+        OrderCounts: total orders, {status: orders}, amount spent on paid/shipped/delivered orders
+    """
+    rows = db.session.query(Order.status, db.func.count(Order.id), db.func.sum(Order.total_amount)) \
+        .filter(Order.user_id == user_id) \
+        .group_by(Order.status) \
+        .all()
+    by_status = {status: count for status, count, _ in rows}
+    spent = sum((Decimal(amount or 0) for status, _, amount in rows if status in PURCHASED_STATUSES), Decimal(0))
+    return OrderCounts(sum(by_status.values()), by_status, spent)
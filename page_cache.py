@@ -0,0 +1,152 @@
+"""
+Rendered page cache for anonymous visitors
+
+Keeps fully rendered HTML for pages that look the same to every anonymous
+visitor (homepage, product detail). Entries are evicted least-recently-used
+once the per-worker memory budget is exceeded, expire after max_age seconds,
+and are dropped early when the products they show are written.
+"""
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from flask import request, session
+from flask_login import current_user
+
+from app import app
+from cart_store import LEGACY_SESSION_KEY as LEGACY_CART_SESSION_KEY, SESSION_KEY as CART_SESSION_KEY
+from catalog_events import on_products_changed
+
+
+class PageCache:
+    """Memory-bounded LRU of rendered pages with tag-based invalidation"""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024, max_age=300):
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (html, size, stored_at, tags)
+        self._tags = {}  # tag -> set of keys
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or time.monotonic() - entry[2] > self.max_age:
+                if entry is not None:
+                    self._discard(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, html, tags=()):
+        size = sys.getsizeof(html)
+        if size > self.max_bytes:
+            return
+
+        with self._lock:
+            if key in self._entries:
+                self._discard(key)
+            self._entries[key] = (html, size, time.monotonic(), tuple(tags))
+            self._bytes += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._discard(oldest)
+                self.evictions += 1
+
+    def invalidate_tags(self, tags):
+        """Drop every entry carrying any of the given tags"""
+        with self._lock:
+            for tag in tags:
+                for key in list(self._tags.get(tag, ())):
+                    self._discard(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._bytes = 0
+
+    def _discard(self, key):
+        html, size, stored_at, tags = self._entries.pop(key)
+        self._bytes -= size
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+
+page_cache = PageCache(
+    max_bytes=app.config.get('PAGE_CACHE_MAX_BYTES', 16 * 1024 * 1024),
+    max_age=app.config.get('PAGE_CACHE_MAX_AGE', 300)
+)
+
+
+def product_tag(product_id):
+    return f'product:{product_id}'
+
+
+def cacheable_request():
+    """
+    Whether the current request sees the shared anonymous version of a page.
+
+    Logged-in users, visitors with an anonymous cart and anyone with pending
+    flash messages get per-user content and always render fresh.
+    """
+    return (
+        request.method == 'GET'
+        and not current_user.is_authenticated
+        and not session.get(CART_SESSION_KEY)
+        and not session.get(LEGACY_CART_SESSION_KEY)
+        and '_flashes' not in session
+    )
+
+
+def render_cached(cache_key, render):
+    """
+    Serve a page from the cache for anonymous visitors.
+
+    Args:
+        cache_key: hashable key identifying the rendered content
+        render: callable returning (html, tags); only called on a miss
+
+    Returns:
+        str: rendered HTML
+    """
+    if not cacheable_request():
+        return render()[0]
+
+    html = page_cache.get(cache_key)
+    if html is None:
+        html, tags = render()
+        page_cache.set(cache_key, html, tags)
+    return html
+
+
+@on_products_changed
+def _invalidate_product_pages(product_ids):
+    page_cache.invalidate_tags(['homepage'] + [product_tag(product_id) for product_id in product_ids])
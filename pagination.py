@@ -0,0 +1,303 @@
+"""
+Keyset (seek) pagination
+
+Instead of COUNT(*) plus OFFSET, each page is fetched with a range condition on
+the sort key and the row id, so deep pages cost the same as the first one.
+Cursors are signed and opaque to clients; they carry the sort key and id of
+the row at the page boundary, and the number of the page they lead to.
+
+KeysetPage answers to the same attributes as Flask-SQLAlchemy's Pagination
+(page, pages, has_prev/has_next, prev_num/next_num, iter_pages), so
+templates page through either. prev_num and next_num are cursors rather
+than numbers; routes take them back through ?page= (see page_or_cursor).
+Numbered links from iter_pages() are plain page numbers and fall back to
+OFFSET paging for that page.
+
+Totals come from the planner's estimate on PostgreSQL. Elsewhere they are an
+exact COUNT(*), kept per filter set for COUNT_CACHE_MAX_AGE seconds so that
+paging through a listing counts it once rather than on every page.
+"""
+import json
+import math
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from decimal import Decimal
+
+from itsdangerous import BadSignature, URLSafeSerializer
+from sqlalchemy import tuple_
+
+from app import app, db
+from catalog_events import on_products_changed
+from models import Product
+
+# Sort orders that can be paged with a cursor: sort name -> (key column, descending)
+KEYSET_SORTS = {
+    'name_asc': (Product.name, False),
+    'name_desc': (Product.name, True),
+    'price_asc': (Product.price, False),
+    'price_desc': (Product.price, True),
+    'newest': (Product.created_at, True),
+}
+
+
+class InvalidCursor(ValueError):
+    """Raised when a cursor is malformed, tampered with or belongs to another listing"""
+
+
+class KeysetPage:
+    """One page of keyset-paginated results, usable where templates expect a Pagination"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None, total=None, total_is_estimate=False,
+                 page=1, per_page=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.total = total
+        self.total_is_estimate = total_is_estimate
+        self.page = page
+        self.per_page = per_page
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+    @property
+    def prev_num(self):
+        """Cursor of the previous page (Pagination gives a number; pass either back as ?page=)"""
+        return self.prev_cursor
+
+    @property
+    def next_num(self):
+        """Cursor of the next page"""
+        return self.next_cursor
+
+    @property
+    def pages(self):
+        if self.total is not None and self.per_page:
+            return max(math.ceil(self.total / self.per_page), self.page or 1)
+        return (self.page or 1) + self.has_next
+
+    def iter_pages(self, left_edge=2, left_current=2, right_current=4, right_edge=2):
+        """Page numbers to link, None for a gap; same shape as Pagination.iter_pages"""
+        if not self.page:
+            return
+        pages = self.pages
+        left_end = min(1 + left_edge, pages + 1)
+        yield from range(1, left_end)
+        if left_end >= pages + 1:
+            return
+
+        mid_start = max(left_end, self.page - left_current)
+        mid_end = min(self.page + right_current + 1, pages + 1)
+        if mid_start - left_end > 0:
+            yield None
+        yield from range(mid_start, mid_end)
+        if mid_end >= pages + 1:
+            return
+
+        right_start = max(mid_end, pages - right_edge + 1)
+        if right_start - mid_end > 0:
+            yield None
+        yield from range(right_start, pages + 1)
+
+
+def _serializer():
+    return URLSafeSerializer(app.secret_key, salt='keyset-cursor')
+
+
+def _dump_value(value):
+    if isinstance(value, Decimal):
+        return ['d', str(value)]
+    if isinstance(value, datetime):
+        return ['t', value.isoformat()]
+    return ['v', value]
+
+
+def _load_value(dumped):
+    kind, value = dumped
+    if kind == 'd':
+        return Decimal(value)
+    if kind == 't':
+        return datetime.fromisoformat(value)
+    return value
+
+
+def encode_cursor(listing, value, row_id, direction='next', page=None):
+    """Encode a page boundary, and the number of the page it leads to, as an opaque cursor string"""
+    return _serializer().dumps([listing, _dump_value(value), row_id, direction, page])
+
+
+def decode_cursor(cursor, listing):
+    """
+    Decode a cursor produced by encode_cursor for the same listing.
+
+    Returns:
+        tuple: (key value, row id, direction, page number or None)
+    """
+    try:
+        cursor_listing, dumped, row_id, direction, *page = _serializer().loads(cursor)
+        value = _load_value(dumped)
+    except (BadSignature, TypeError, ValueError):
+        raise InvalidCursor('Invalid cursor')
+
+    if cursor_listing != listing or direction not in ('next', 'prev') or not isinstance(row_id, int):
+        raise InvalidCursor('Cursor does not belong to this listing')
+
+    page = page[0] if page and isinstance(page[0], int) and page[0] > 0 else None
+    return value, row_id, direction, page
+
+
+def page_or_cursor(args):
+    """
+    Read ?page= (a number, or a cursor from KeysetPage.prev_num/next_num) and ?cursor=.
+
+    Returns:
+        tuple: (page number, cursor or None); the cursor is '' for ?cursor= with no value
+    """
+    page = args.get('page', '')
+    if page and not page.isdigit():
+        return 1, page
+    return args.get('page', 1, type=int), args.get('cursor')
+
+
+class CountCache:
+    """LRU of exact row counts keyed by the SQL and parameters that were counted"""
+
+    def __init__(self, max_entries=256, max_age=30):
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (count, generation, stored_at)
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+
+    def count(self, query, compiled):
+        """Cached query.count(); compiled is the query's statement compiled with its parameters"""
+        key = (str(compiled), tuple(sorted(compiled.params.items())))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] == self._generation and time.monotonic() - entry[2] < self.max_age:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self._generation
+
+        count = query.count()
+
+        with self._lock:
+            if generation == self._generation:
+                self._entries[key] = (count, generation, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        return count
+
+
+count_cache = CountCache(max_age=app.config.get('COUNT_CACHE_MAX_AGE', 30))
+
+
+@on_products_changed
+def _invalidate_counts(product_ids):
+    count_cache.invalidate()
+
+
+def estimate_count(query):
+    """
+    Cheap row count for a query.
+
+    On PostgreSQL this reads the planner's row estimate instead of running
+    COUNT(*). Other databases get an exact count, cached per filter set in
+    count_cache.
+
+    Returns:
+        tuple: (count, is_estimate)
+    """
+    query = query.order_by(None)
+    compiled = query.statement.compile(
+        dialect=db.engine.dialect,
+        compile_kwargs={'render_postcompile': True}
+    )
+
+    if db.engine.dialect.name != 'postgresql':
+        return count_cache.count(query, compiled), False
+
+    plan = db.session.connection().exec_driver_sql(
+        f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params
+    ).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+
+    return int(plan[0]['Plan']['Plan Rows']), True
+
+
+def keyset_paginate(query, key_column, descending, cursor=None, per_page=12,
+                    listing='products', id_column=None, with_total=True):
+    """
+    Fetch one page of a query ordered by (key_column, id).
+
+    Args:
+        query: filtered query; any existing ORDER BY is replaced
+        key_column: column the listing is sorted by
+        descending: whether the listing is sorted newest/highest first
+        cursor: cursor from a previous page, or None for the first page
+        per_page: page size
+        listing: name the cursors are bound to, so they can't be replayed elsewhere
+        id_column: unique tie-breaker column (defaults to the entity's id)
+        with_total: include an (approximate) total row count
+
+    Returns:
+        KeysetPage
+    """
+    if id_column is None:
+        id_column = query.column_descriptions[0]['entity'].id
+
+    total, total_is_estimate = estimate_count(query) if with_total else (None, False)
+
+    direction, page = 'next', 1
+    if cursor:
+        value, row_id, direction, page = decode_cursor(cursor, listing)
+        keys = tuple_(key_column, id_column)
+        # Walking backwards scans the index in the opposite order
+        if descending != (direction == 'prev'):
+            query = query.filter(keys < tuple_(value, row_id))
+        else:
+            query = query.filter(keys > tuple_(value, row_id))
+
+    scan_descending = descending != (direction == 'prev')
+    if scan_descending:
+        query = query.order_by(None).order_by(key_column.desc(), id_column.desc())
+    else:
+        query = query.order_by(None).order_by(key_column.asc(), id_column.asc())
+
+    rows = query.limit(per_page + 1).all()
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+    if direction == 'prev':
+        rows.reverse()
+
+    def boundary(row, row_direction, row_page):
+        return encode_cursor(listing, getattr(row, key_column.key), row.id, row_direction, row_page)
+
+    next_cursor = prev_cursor = None
+    if rows:
+        if has_more or direction == 'prev':
+            next_cursor = boundary(rows[-1], 'next', page + 1 if page else None)
+        if cursor and (has_more or direction == 'next'):
+            prev_cursor = boundary(rows[0], 'prev', page - 1 if page and page > 1 else None)
+
+    return KeysetPage(rows, next_cursor, prev_cursor, total, total_is_estimate, page=page, per_page=per_page)
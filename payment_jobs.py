@@ -0,0 +1,255 @@
+"""
+Background payment processing
+
+Gateway calls (an M-Pesa STK push, a card charge) no longer run inside the
+web request. start_payment() records a pending PaymentAttempt and hands the
+call to a bounded per-worker thread pool; the page shows a "payment pending"
+state and polls the status endpoint until the attempt settles. Card charges
+and sandbox M-Pesa pushes settle when the job finishes; a live STK push only
+means the buyer got the prompt, so the attempt stays pending until the
+M-Pesa callback reports the outcome (see mpesa_callbacks.py).
+
+PAYMENT_GATEWAY=local swaps the real gateway for LocalGateway, which answers
+after a short delay without any network calls, for tests and development.
+"""
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from app import app, db
+from idempotency import current_key, release_key
+from models import Order, PaymentAttempt
+from mpesa import MpesaError, format_phone_number, mpesa_client
+from order_status import transition
+from recommendations import record_order_copurchases
+
+# A pending attempt older than this no longer blocks a new one (an STK prompt lapses after about a minute)
+PENDING_TIMEOUT = timedelta(minutes=5)
+
+
+class LiveGateway:
+    """
+    STK pushes through the pooled Daraja client, cards through the payment module.
+
+    Without M-Pesa credentials STK pushes go to the payment module too, which
+    answers in sandbox (dev_mode) fashion.
+    """
+
+    def charge(self, method, order, details):
+        from payment import process_card_payment, process_mpesa_payment
+        if method == 'mpesa':
+            client = mpesa_client()
+            if not client.configured:
+                return process_mpesa_payment(order, details['phone_number'])
+            try:
+                data = client.initiate_stk_push(format_phone_number(details['phone_number']),
+                                                order.total_amount, order.id)
+            except MpesaError as e:
+                return {'success': False, 'message': str(e)}
+            if str(data.get('ResponseCode')) != '0':
+                return {'success': False, 'message': data.get('ResponseDescription', 'M-Pesa request was not accepted')}
+            return {'success': True, 'transaction_id': data.get('CheckoutRequestID'),
+                    'message': data.get('CustomerMessage')}
+        if details:
+            return process_card_payment(order, details)
+        return process_card_payment(order)
+
+
+class LocalGateway:
+    """
+    Stand-in gateway for tests: sleeps for `delay` seconds, then answers like the real one.
+
+    Card numbers ending in 0002 are declined and M-Pesa numbers ending in
+    0000 fail. Other STK pushes succeed without dev_mode, so they wait for a
+    callback like live ones do.
+    """
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.calls = 0
+        self._stop = threading.Event()
+
+    def charge(self, method, order, details):
+        self.calls += 1
+        self._stop.wait(self.delay)
+        if method == 'mpesa':
+            if str(details.get('phone_number', '')).endswith('0000'):
+                return {'success': False, 'message': 'The M-Pesa request was cancelled by the user'}
+            return {'success': True, 'transaction_id': f'ws_CO_local_{uuid.uuid4().hex[:20]}'}
+        if str((details or {}).get('card_number', '')).replace(' ', '').endswith('0002'):
+            return {'success': False, 'message': 'Card declined'}
+        return {'success': True, 'transaction_id': f'CARD-LOCAL-{order.id}-{uuid.uuid4().hex[:8]}'}
+
+
+def payment_gateway():
+    if app.config.get('PAYMENT_GATEWAY') == 'local':
+        return local_gateway
+    return live_gateway
+
+
+class PaymentExecutor:
+    """
+    Thread pool for gateway calls with a bounded backlog.
+
+    ThreadPoolExecutor queues without limit; a semaphore sized workers +
+    queue_size turns payments away once that many are in flight, rather than
+    letting a gateway outage pile up work.
+    """
+
+    def __init__(self, workers=4, queue_size=32):
+        self.workers = workers
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args):
+        """Run fn(*args) on the pool. Returns False when the backlog is full."""
+        if not self._slots.acquire(blocking=False):
+            return False
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='payment')
+        future = self._pool.submit(fn, *args)
+        future.add_done_callback(lambda _: self._slots.release())
+        return True
+
+    def shutdown(self, wait=True):
+        if self._pool is not None:
+            self._pool.shutdown(wait=wait)
+
+
+def mark_paid(attempt, order, reference, record_copurchases=True):
+    """
+    Settle a successful attempt and pay its order. Runs in the caller's transaction.
+
+    Returns:
+        bool: whether the order went from pending to paid; batch callers that
+        pass record_copurchases=False record those orders themselves
+    """
+    attempt.status = 'succeeded'
+    attempt.reference = reference
+    attempt.completed_at = datetime.utcnow()
+    if order.status != 'pending':
+        return False
+    transition(order, 'paid', note=f'{attempt.method} {reference}')
+    order.payment_reference = reference
+    if record_copurchases:
+        record_order_copurchases(order.id)
+    return True
+
+
+def mark_failed(attempt, message):
+    """Fail an attempt and forget the request that started it, so resubmitting it runs again"""
+    attempt.status = 'failed'
+    attempt.message = (message or 'Payment failed')[:256]
+    attempt.completed_at = datetime.utcnow()
+    if attempt.idempotency_key:
+        release_key(attempt.idempotency_key)
+
+
+def pending_attempt(order_id):
+    """The order's unsettled attempt, if any and not yet timed out"""
+    return PaymentAttempt.query \
+        .filter(PaymentAttempt.order_id == order_id,
+                PaymentAttempt.status == 'pending',
+                PaymentAttempt.created_at > datetime.utcnow() - PENDING_TIMEOUT) \
+        .order_by(PaymentAttempt.id.desc()) \
+        .first()
+
+
+def payment_status(order_id, user_id):
+    """
+    Latest attempt and order status for the polling endpoint, in one indexed query.
+
+    Returns:
+        Row or None: (attempt_id, method, status, message, created_at, order_status),
+        None when the buyer has no attempt on the order
+    """
+    return db.session.query(PaymentAttempt.id.label('attempt_id'), PaymentAttempt.method,
+                            PaymentAttempt.status, PaymentAttempt.message, PaymentAttempt.created_at,
+                            Order.status.label('order_status')) \
+        .join(Order, Order.id == PaymentAttempt.order_id) \
+        .filter(PaymentAttempt.order_id == order_id, Order.user_id == user_id) \
+        .order_by(PaymentAttempt.id.desc()) \
+        .first()
+
+
+def attempt_version(order_id):
+    """The order's latest attempt as 'id:status', '' before the first; changes whenever an attempt starts or settles"""
+    row = db.session.query(PaymentAttempt.id, PaymentAttempt.status) \
+        .filter(PaymentAttempt.order_id == order_id) \
+        .order_by(PaymentAttempt.id.desc()) \
+        .first()
+    return f'{row.id}:{row.status}' if row else ''
+
+
+def start_payment(order, method, details):
+    """
+    Record a pending attempt for the order and queue the gateway call.
+
+    Commits the attempt so the job and the status endpoint can see it.
+
+    Args:
+        order: pending Order to pay
+        method: 'mpesa' or 'card'
+        details: gateway input ({'phone_number': ...} or card fields); kept in memory only
+
+    Returns:
+        PaymentAttempt: pending, or failed straight away when the queue is full
+    """
+    attempt = PaymentAttempt(order_id=order.id, user_id=order.user_id, method=method, status='pending',
+                             idempotency_key=current_key())
+    db.session.add(attempt)
+    db.session.commit()
+
+    if not payment_executor.submit(_run_attempt, attempt.id, details):
+        app.logger.warning(f'Payment queue full, turning away order {order.id}')
+        mark_failed(attempt, 'Payment service is busy, please try again in a moment')
+        db.session.commit()
+    return attempt
+
+
+def _run_attempt(attempt_id, details):
+    """Job body: call the gateway, then settle the attempt with what it said"""
+    with app.app_context():
+        try:
+            attempt = db.session.get(PaymentAttempt, attempt_id)
+            order = db.session.get(Order, attempt.order_id)
+            method = attempt.method
+            # Don't hold a pooled connection for the length of the gateway round trip
+            db.session.close()
+
+            try:
+                result = payment_gateway().charge(method, order, details)
+            except Exception as e:
+                app.logger.error(f'Gateway error for payment attempt {attempt_id}: {str(e)}')
+                result = {'success': False, 'message': f'Payment processing failed: {str(e)}'}
+            print(f"DEBUG: Payment attempt {attempt_id} gateway result: {result}")
+
+            attempt = db.session.get(PaymentAttempt, attempt_id)
+            order = db.session.get(Order, attempt.order_id)
+            if attempt.status != 'pending':
+                return
+            if not result.get('success'):
+                mark_failed(attempt, result.get('message'))
+            elif method == 'mpesa' and not result.get('dev_mode'):
+                # The buyer has the STK prompt; the callback settles it
+                attempt.reference = result.get('transaction_id')
+                attempt.message = 'Waiting for M-Pesa confirmation on your phone'
+                order.payment_reference = attempt.reference
+            else:
+                mark_paid(attempt, order, result.get('transaction_id', 'N/A'))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f'Error settling payment attempt {attempt_id}: {str(e)}')
+
+
+live_gateway = LiveGateway()
+local_gateway = LocalGateway()
+payment_executor = PaymentExecutor(
+    workers=app.config.get('PAYMENT_WORKERS', 4),
+    queue_size=app.config.get('PAYMENT_QUEUE_SIZE', 32)
+)
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+"""
+Rebuild the "frequently bought together" table from order history
+
+Streams every paid, shipped and delivered order's items and recomputes the
+co-purchase counts used for related products on product pages.
+"""
+
+import sys
+
+from app import app, db
+from recommendations import rebuild_copurchase_table
+
+def rebuild_recommendations(batch_size=5000):
+    """Recompute product_associations from scratch"""
+    
+    with app.app_context():
+        try:
+            orders, pairs = rebuild_copurchase_table(batch_size=batch_size)
+            db.session.commit()
+            print(f"✅ Processed {orders} orders, wrote {pairs} product pairs")
+        except Exception as e:
+            print(f"Error rebuilding recommendations: {e}")
+            db.session.rollback()
+
+if __name__ == "__main__":
+    rebuild_recommendations(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
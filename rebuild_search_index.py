@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+Rebuild the full-text product search index
+
+Run this after bulk-loading products outside the web app (for example with
+add_products.py) so the new rows show up in /products searches.
+"""
+
+from app import app, db
+from search import ensure_search_index, rebuild_search_index
+
+def rebuild_index():
+    """Recreate every product entry in the search index"""
+    
+    with app.app_context():
+        try:
+            ensure_search_index()
+            rebuild_search_index()
+            db.session.commit()
+            print("✅ Product search index rebuilt")
+        except Exception as e:
+            print(f"Error rebuilding search index: {e}")
+            db.session.rollback()
+
+if __name__ == "__main__":
+    rebuild_index()
@@ -0,0 +1,122 @@
+"""
+"Frequently bought together" product recommendations
+
+product_associations holds, for every ordered pair of products, the number of
+paid orders that contained both. Orders are folded in as they become paid;
+rebuild_copurchase_table() recomputes everything from order history.
+
+An order with n products yields n * (n - 1) pairs, and the incremental path
+runs inside mark_paid, so only the MAX_BASKET_PRODUCTS products an order
+spent most on are paired. A 100-line installer order then writes 132 rows
+instead of 9,900.
+"""
+from collections import Counter
+from itertools import groupby, permutations
+
+from app import db
+from db_helpers import upsert_increment
+from models import Order, OrderItem, Product, ProductAssociation
+
+# Order statuses that count as a completed purchase
+PURCHASED_STATUSES = ('paid', 'shipped', 'delivered')
+
+# Products per order that take part in pairs, by amount spent on them
+MAX_BASKET_PRODUCTS = 12
+
+
+def _basket(items):
+    """The order's product ids worth pairing: the MAX_BASKET_PRODUCTS it spent most on"""
+    spent = Counter()
+    for item in items:
+        spent[item.product_id] += item.quantity * item.price
+    top = sorted(spent, key=lambda product_id: (-spent[product_id], product_id))
+    return sorted(top[:MAX_BASKET_PRODUCTS])
+
+
+def _pair_rows(pair_counts):
+    return [
+        {'product_id': product_id, 'related_product_id': related_id, 'order_count': count}
+        for (product_id, related_id), count in pair_counts.items()
+    ]
+
+
+def record_order_copurchases(order_id):
+    """
+    Add one paid order's product pairs to the recommendation table.
+
+    Runs in the caller's transaction; call it once when the order becomes paid.
+    """
+    record_orders_copurchases([order_id])
+
+
+def record_orders_copurchases(order_ids):
+    """
+    Add several newly paid orders' product pairs with one query and one upsert.
+
+    Runs in the caller's transaction; call it once per order becoming paid.
+    """
+    if not order_ids:
+        return
+    rows = db.session.query(OrderItem.order_id, OrderItem.product_id, OrderItem.quantity, OrderItem.price) \
+        .filter(OrderItem.order_id.in_(order_ids)) \
+        .order_by(OrderItem.order_id)
+
+    pair_counts = Counter()
+    for order_id, items in groupby(rows, key=lambda row: row.order_id):
+        pair_counts.update(permutations(_basket(items), 2))
+    upsert_increment(ProductAssociation, _pair_rows(pair_counts),
+                     key_columns=['product_id', 'related_product_id'],
+                     counter_columns=['order_count'])
+
+
+def rebuild_copurchase_table(batch_size=5000):
+    """
+    Recompute the recommendation table from every purchased order.
+
+    OrderItem rows are streamed in order_id order, so only the pair counts are
+    held in memory, never the order history itself.
+
+    Returns:
+        tuple: (orders processed, pairs written)
+    """
+    rows = db.session.query(OrderItem.order_id, OrderItem.product_id, OrderItem.quantity, OrderItem.price) \
+        .join(Order, Order.id == OrderItem.order_id) \
+        .filter(Order.status.in_(PURCHASED_STATUSES)) \
+        .order_by(OrderItem.order_id) \
+        .yield_per(batch_size)
+
+    pair_counts = Counter()
+    order_count = 0
+    for order_id, items in groupby(rows, key=lambda row: row.order_id):
+        pair_counts.update(permutations(_basket(items), 2))
+        order_count += 1
+
+    db.session.execute(db.delete(ProductAssociation))
+    pair_rows = _pair_rows(pair_counts)
+    for start in range(0, len(pair_rows), batch_size):
+        db.session.execute(db.insert(ProductAssociation), pair_rows[start:start + batch_size])
+
+    return order_count, len(pair_rows)
+
+
+def related_products_for(product, limit=4):
+    """
+    Products most often bought together with this one.
+
+    Falls back to other products from the same category when there isn't
+    enough purchase history yet.
+    """
+    related = Product.query \
+        .join(ProductAssociation, ProductAssociation.related_product_id == Product.id) \
+        .filter(ProductAssociation.product_id == product.id) \
+        .order_by(ProductAssociation.order_count.desc(), Product.id) \
+        .limit(limit).all()
+
+    if len(related) < limit:
+        exclude = [product.id] + [item.id for item in related]
+        related += Product.query.filter(
+            Product.category_id == product.category_id,
+            Product.id.notin_(exclude)
+        ).limit(limit - len(related)).all()
+
+    return related
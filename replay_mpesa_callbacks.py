@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+"""
+Apply or replay M-Pesa STK callbacks
+
+With no arguments, applies every stored callback that hasn't been applied
+yet; run it from cron when MPESA_CALLBACK_INTERVAL is 0, or to clear a
+backlog after an outage. Given a file of recorded callback bodies (one JSON
+object per line, as written by --export or benchmark_mpesa_callbacks.py),
+stores them the way the callback route does (duplicates are skipped) and
+applies them, or with --url posts them to a running site instead.
+
+Usage:
+    python replay_mpesa_callbacks.py
+    python replay_mpesa_callbacks.py recorded.jsonl [--url https://shop.example/mpesa/callback]
+    python replay_mpesa_callbacks.py --export recorded.jsonl
+"""
+
+import argparse
+import json
+
+from app import app, db
+from models import MpesaCallback
+from mpesa_callbacks import drain_callbacks, ingest_callback
+
+
+def read_payloads(path):
+    with open(path) as recorded:
+        return [line.strip() for line in recorded if line.strip()]
+
+
+def post_payloads(payloads, url):
+    """Deliver recorded bodies to a running site, like Daraja would"""
+    import requests
+
+    counts = {}
+    with requests.Session() as http:
+        for raw in payloads:
+            response = http.post(url, data=raw, headers={'Content-Type': 'application/json'}, timeout=10)
+            counts[response.status_code] = counts.get(response.status_code, 0) + 1
+    print(f"✅ Posted {len(payloads)} callbacks to {url}: "
+          f"{', '.join(f'{count} x HTTP {status}' for status, count in sorted(counts.items()))}")
+
+
+def replay_payloads(payloads):
+    """Store recorded bodies and apply them"""
+    counts = {True: 0, False: 0, None: 0}
+    with app.app_context():
+        try:
+            for raw in payloads:
+                try:
+                    payload = json.loads(raw)
+                except ValueError:
+                    counts[None] += 1
+                    continue
+                counts[ingest_callback(payload, raw)] += 1
+            applied = drain_callbacks()
+            print(f"✅ Stored {counts[True]} callbacks ({counts[False]} duplicates, {counts[None]} invalid), "
+                  f"applied {applied}")
+        except Exception as e:
+            print(f"Error replaying M-Pesa callbacks: {e}")
+            db.session.rollback()
+
+
+def export_payloads(path):
+    """Write every stored callback body to a file, oldest first"""
+    with app.app_context():
+        with open(path, 'w') as recorded:
+            count = 0
+            for (payload,) in db.session.query(MpesaCallback.payload).order_by(MpesaCallback.id).yield_per(1000):
+                recorded.write(payload.replace('\n', ' ') + '\n')
+                count += 1
+    print(f"✅ Exported {count} callbacks to {path}")
+
+
+def apply_stored():
+    """Apply the stored callbacks the worker hasn't got to"""
+    with app.app_context():
+        try:
+            applied = drain_callbacks()
+            print(f"✅ Applied {applied} stored M-Pesa callbacks")
+        except Exception as e:
+            print(f"Error applying M-Pesa callbacks: {e}")
+            db.session.rollback()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('recorded', nargs='?', help='file of recorded callback bodies, one JSON object per line')
+    parser.add_argument('--url', help='post the recorded callbacks to this callback URL instead')
+    parser.add_argument('--export', metavar='FILE', help='write the stored callbacks to FILE and exit')
+    args = parser.parse_args()
+
+    if args.export:
+        export_payloads(args.export)
+    elif args.recorded and args.url:
+        post_payloads(read_payloads(args.recorded), args.url)
+    elif args.recorded:
+        replay_payloads(read_payloads(args.recorded))
+    else:
+        apply_stored()
@@ -0,0 +1,250 @@
+"""
+Time-limited stock reservations for checkout
+
+Opening the checkout page puts a hold on every cart line for STOCK_HOLD_TTL
+seconds. The stock other buyers can take is the product's stock minus the
+quantities under active holds, summed over the (product_id, expires_at,
+quantity) index. Creating the order consumes the buyer's holds in the same
+transaction that takes the stock with take_stock()'s conditional
+decrements; abandoned holds expire and are deleted in batches by a
+per-worker background sweeper, or by sweep_reservations.py from cron.
+"""
+import threading
+from datetime import datetime, timedelta
+
+from app import app, db
+from models import Product, StockReservation
+
+
+def _quantities(lines):
+    """Fold (product_id, quantity) pairs into {product_id: total quantity}"""
+    quantities = {}
+    for product_id, quantity in lines:
+        quantities[int(product_id)] = quantities.get(int(product_id), 0) + int(quantity)
+    return quantities
+
+
+def _held_by_product(product_ids, exclude_user_id=None):
+    """Query of (product_id, quantity) under active holds, answered from the covering index"""
+    query = db.session.query(StockReservation.product_id,
+                             db.func.sum(StockReservation.quantity).label('quantity')) \
+        .filter(StockReservation.product_id.in_(product_ids),
+                StockReservation.expires_at > datetime.utcnow())
+    if exclude_user_id is not None:
+        query = query.filter(StockReservation.user_id != exclude_user_id)
+    return query.group_by(StockReservation.product_id)
+
+
+def available_stock(product_ids, exclude_user_id=None):
+    """
+    Stock minus active holds, per product, in one query.
+
+    Args:
+        product_ids: products to look at
+        exclude_user_id: don't count this buyer's own holds against them
+
+    Returns:
+        dict: {product_id: available quantity}; missing products are omitted
+    """
+    product_ids = {int(product_id) for product_id in product_ids}
+    if not product_ids:
+        return {}
+
+    held = _held_by_product(product_ids, exclude_user_id).subquery()
+    rows = db.session.query(Product.id, Product.stock - db.func.coalesce(held.c.quantity, 0)) \
+        .outerjoin(held, held.c.product_id == Product.id) \
+        .filter(Product.id.in_(product_ids))
+    return {product_id: available for product_id, available in rows}
+
+
+def _lock_products(product_ids):
+    """Row-lock the products (FOR UPDATE on PostgreSQL) so concurrent checkouts queue up"""
+    db.session.query(Product.id) \
+        .filter(Product.id.in_(product_ids)) \
+        .order_by(Product.id) \
+        .with_for_update() \
+        .all()
+
+
+def release_holds(user_id):
+    """Drop every hold the buyer has. Runs in the caller's transaction."""
+    db.session.query(StockReservation) \
+        .filter(StockReservation.user_id == user_id) \
+        .delete(synchronize_session=False)
+
+
+def reserve_lines(user_id, lines, ttl=None):
+    """
+    Replace the buyer's holds with holds on the given lines.
+
+    Nothing is held unless every line fits in the available stock. Runs in
+    the caller's transaction; commit to make the holds visible.
+
+    Args:
+        user_id: buyer
+        lines: iterable of (product_id, quantity)
+        ttl: seconds the holds last, STOCK_HOLD_TTL by default
+
+    Returns:
+        dict: {product_id: available quantity} for lines that can't be held, empty on success
+    """
+    quantities = _quantities(lines)
+    if not quantities:
+        return {}
+    ttl = ttl if ttl is not None else app.config.get('STOCK_HOLD_TTL', 900)
+
+    _lock_products(quantities)
+    # Deleting first also takes SQLite's write lock before availability is read
+    release_holds(user_id)
+    available = available_stock(quantities)
+    shortages = {
+        product_id: max(available.get(product_id, 0), 0)
+        for product_id, quantity in quantities.items() if available.get(product_id, 0) < quantity
+    }
+    if shortages:
+        return shortages
+
+    now = datetime.utcnow()
+    db.session.execute(db.insert(StockReservation), [
+        {'product_id': product_id, 'user_id': user_id, 'quantity': quantity,
+         'created_at': now, 'expires_at': now + timedelta(seconds=ttl)}
+        for product_id, quantity in quantities.items()
+    ])
+    hold_sweeper.ensure_started()
+    return {}
+
+
+def consume_holds(user_id, lines):
+    """
+    Check the lines of a new order against stock minus other buyers' holds, then drop the buyer's holds.
+
+    Call from the order-creating transaction, before taking the stock; if
+    anything is short nothing is changed.
+
+    Args:
+        user_id: buyer
+        lines: iterable of (product_id, quantity)
+
+    Returns:
+        dict: {product_id: available quantity} for lines that are short, empty on success
+    """
+    quantities = _quantities(lines)
+    if not quantities:
+        return {}
+
+    _lock_products(quantities)
+    available = available_stock(quantities, exclude_user_id=user_id)
+    shortages = {
+        product_id: max(available.get(product_id, 0), 0)
+        for product_id, quantity in quantities.items() if available.get(product_id, 0) < quantity
+    }
+    if not shortages:
+        release_holds(user_id)
+    return shortages
+
+
+def take_stock(quantities):
+    """
+    Take stock for every line of an order with a conditional decrement.
+
+    All lines go out as one UPDATE products SET stock = stock - CASE id ...
+    WHERE id IN (...) AND stock >= CASE id ... RETURNING id, so the database
+    re-checks the stock at write time and concurrent orders can neither lose
+    an update nor oversell; a product missing from RETURNING was short.
+    Databases without UPDATE ... RETURNING get one conditional UPDATE per
+    line, checked by rowcount. Runs in the caller's transaction; if anything
+    is short the caller must roll back, which undoes the lines already taken.
+
+    Args:
+        quantities: {product_id: quantity}
+
+    Returns:
+        list: ids of products that didn't have enough stock, empty on success
+    """
+    if not quantities:
+        return []
+    now = datetime.utcnow()
+
+    if db.engine.dialect.update_returning:
+        quantity = db.case(quantities, value=Product.id)
+        taken = db.session.execute(
+            db.update(Product)
+            .where(Product.id.in_(quantities), Product.stock >= quantity)
+            .values(stock=Product.stock - quantity, updated_at=now)
+            .returning(Product.id),
+            execution_options={'synchronize_session': False}
+        ).scalars().all()
+        return sorted(set(quantities) - set(taken))
+
+    short = []
+    for product_id in sorted(quantities):
+        quantity = quantities[product_id]
+        result = db.session.execute(
+            db.update(Product)
+            .where(Product.id == product_id, Product.stock >= quantity)
+            .values(stock=Product.stock - quantity, updated_at=now),
+            execution_options={'synchronize_session': False}
+        )
+        if result.rowcount != 1:
+            short.append(product_id)
+    return short
+
+
+def sweep_expired_holds(batch_size=1000):
+    """
+    Delete expired holds, committing after every batch so locks stay short.
+
+    Returns:
+        int: number of holds deleted
+    """
+    deleted = 0
+    while True:
+        expired = db.session.query(StockReservation.id) \
+            .filter(StockReservation.expires_at <= datetime.utcnow()) \
+            .limit(batch_size) \
+            .subquery()
+        count = db.session.query(StockReservation) \
+            .filter(StockReservation.id.in_(db.select(expired.c.id))) \
+            .delete(synchronize_session=False)
+        db.session.commit()
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+class HoldSweeper:
+    """Per-worker daemon thread running sweep_expired_holds() every interval seconds"""
+
+    def __init__(self, interval=60, batch_size=1000):
+        self.interval = interval
+        self.batch_size = batch_size
+        self.swept = 0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def ensure_started(self):
+        if self.interval <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='stock-hold-sweeper', daemon=True)
+                self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            with app.app_context():
+                try:
+                    self.swept += sweep_expired_holds(self.batch_size)
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f'Error sweeping stock holds: {str(e)}')
+
+
+hold_sweeper = HoldSweeper(
+    interval=app.config.get('STOCK_HOLD_SWEEP_INTERVAL', 60),
+    batch_size=app.config.get('STOCK_HOLD_SWEEP_BATCH', 1000)
+)
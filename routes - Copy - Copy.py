@@ -5,6 +5,8 @@ from datetime import datetime
 from app import app
 from models import db, User, Product, Category, Order, OrderItem, Cart, CartItem, PaymentMethod, Review
 from payment import process_card_payment, process_mpesa_payment, process_airtel_payment, validate_card_details
+from catalog_events import products_changed
+from order_status import record_created, transition
 import random
 import string
 
@@ -517,6 +519,8 @@ def register_routes(app):
                 )
 
                 db.session.add(order)
+                db.session.flush()
+                record_created(order.id, current_user.id, actor_id=current_user.id)
                 db.session.commit()
 
                 # Add order items
@@ -604,7 +608,7 @@ def register_routes(app):
 
                 if result['success']:
                     # Update order status and payment reference
-                    order.status = 'paid'
+                    transition(order, 'paid', actor_id=current_user.id)
                     order.payment_reference = result.get('transaction_id', 'N/A')
                     db.session.commit()
 
@@ -630,7 +634,7 @@ def register_routes(app):
 
                 if result['success']:
                     # Update order status and payment reference
-                    order.status = 'paid'
+                    transition(order, 'paid', actor_id=current_user.id)
                     order.payment_reference = result.get('transaction_id', 'N/A')
                     db.session.commit()
 
@@ -656,7 +660,7 @@ def register_routes(app):
 
                 if result['success']:
                     # Update order status and payment reference
-                    order.status = 'paid'
+                    transition(order, 'paid', actor_id=current_user.id)
                     order.payment_reference = result.get('transaction_id', 'N/A')
                     db.session.commit()
 
@@ -711,9 +715,12 @@ def register_routes(app):
 
         if existing_review:
             # Update existing review
+            previous_rating = existing_review.rating
             existing_review.rating = rating
             existing_review.comment = comment
+            product.record_rating(rating, previous_rating=previous_rating)
             db.session.commit()
+            products_changed([product_id])
             flash('Your review has been updated', 'success')
         else:
             # Add new review
@@ -725,7 +732,9 @@ def register_routes(app):
             )
 
             db.session.add(review)
+            product.record_rating(rating)
             db.session.commit()
+            products_changed([product_id])
 
             flash('Your review has been added', 'success')
 
@@ -1142,60 +1151,31 @@ def register_routes(app):
     @app.route('/test-mpesa', methods=['GET'])
     def test_mpesa():
         """Test endpoint for Mpesa integration"""
+        from mpesa import mpesa_client
         try:
-            mpesa = MPesa()
+            # The worker's long-lived client: pooled connections, cached token
+            mpesa = mpesa_client()
 
-            # Test authentication
-            token = mpesa.get_auth_token()
-
-            # Test STK push with sample data
-            result = mpesa.initiate_stk_push(
-                phone_number="254712345678",  # Test phone number
-                amount=1,  # Minimal amount for testing
-                order_id="TEST001"
-            )
-
-            return jsonify({
-                'success': True,
-                'token': token,
-                'stk_push_result': result
-            })
-        except Exception as e:
-            return jsonify({
-                'success': False,
-                'error': str(e)
-            })
-
-    @app.route('/test-mpesa', methods=['GET'])
-    def test_mpesa():
-        """Test endpoint for Mpesa integration"""
-        try:
-            # Get M-Pesa credentials from environment
-            business_shortcode = os.getenv("MPESA_BUSINESS_SHORTCODE")
-            consumer_key = os.getenv("MPESA_CONSUMER_KEY")
-            consumer_secret = os.getenv("MPESA_CONSUMER_SECRET")
-            
-            if not all([business_shortcode, consumer_key, consumer_secret]):
+            if not mpesa.configured:
                 return jsonify({
                     'success': False,
                     'error': 'Missing required M-Pesa credentials in environment variables'
                 })
 
-            mpesa = MPesa()
-            
             # Test authentication
             token = mpesa.get_auth_token()
-            
+
             # Test STK push with sample data
             result = mpesa.initiate_stk_push(
                 phone_number="254712345678",  # Test phone number
                 amount=1,  # Minimal amount for testing
                 order_id="TEST001"
             )
-            
+
             return jsonify({
                 'success': True,
                 'token': token,
+                'token_fetches': mpesa.token_fetches,
                 'stk_push_result': result
             })
         except Exception as e:
@@ -1206,28 +1186,14 @@ def register_routes(app):
 
     @app.route('/mpesa/callback', methods=['POST'])
     def mpesa_callback():
-        """Handle M-Pesa payment callback"""
-        data = request.get_json()
-
-        if "Body" in data and "stkCallback" in data["Body"]:
-            result = data["Body"]["stkCallback"]
-
-            if result["ResultCode"] == 0:
-                # Payment successful
-                merchant_request_id = result["MerchantRequestID"]
-                checkout_request_id = result["CheckoutRequestID"]
-
-                # Find order by checkout request ID and update its status
-                # You'll need to store the checkout_request_id when initiating payment
-                order = Order.query.filter_by(payment_reference=checkout_request_id).first()
-
-                if order:
-                    order.status = 'paid'
-                    db.session.commit()
+        """Store the M-Pesa callback and acknowledge; mpesa_callbacks applies it in batches"""
+        from mpesa_callbacks import ingest_callback
+        data = request.get_json(silent=True)
 
-            return jsonify({'success': True}), 200
+        if ingest_callback(data, request.get_data(as_text=True)) is None:
+            return jsonify({'ResultCode': 1, 'ResultDesc': 'Invalid callback data'}), 400
 
-        return jsonify({'success': False, 'message': 'Invalid callback data'}), 400
+        return jsonify({'ResultCode': 0, 'ResultDesc': 'Accepted'}), 200
 
 
 # Register routes
@@ -0,0 +1,188 @@
+"""
+Full-text product search
+
+PostgreSQL keeps a ``product_search`` side table holding a weighted tsvector
+per product behind a GIN index. SQLite (used for local and test databases)
+gets an FTS5 virtual table with the same name. Any other database falls back
+to the original ILIKE scan.
+"""
+import re
+
+from sqlalchemy import bindparam, text
+
+from app import db
+from models import Product
+
+SEARCH_TABLE = 'product_search'
+MAX_SEARCH_TERMS = 8
+
+_TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def _dialect():
+    return db.engine.dialect.name
+
+
+def search_terms(search_query):
+    """Split a raw search string into lowercase index terms"""
+    return [term.lower() for term in _TERM_RE.findall(search_query or '')][:MAX_SEARCH_TERMS]
+
+
+def search_key(search_query):
+    """
+    Hashable key for the set of products a search matches, for caches.
+
+    Queries with the same terms match the same products when full-text search
+    is used. A query with no terms ("!!!"), or any query on a database without
+    full-text support, is matched with ILIKE instead and keyed on its text.
+    """
+    terms = search_terms(search_query)
+    if terms and _dialect() in ('postgresql', 'sqlite'):
+        return ('terms',) + tuple(terms)
+    return ('text', (search_query or '').strip())
+
+
+def ensure_search_index():
+    """
+    Create the search table and its index if they don't exist yet.
+
+    A freshly created index is filled from the products table so that existing
+    catalogs become searchable without a separate rebuild step.
+    """
+    dialect = _dialect()
+    if dialect not in ('postgresql', 'sqlite'):
+        return
+
+    if db.inspect(db.engine).has_table(SEARCH_TABLE):
+        return
+
+    if dialect == 'postgresql':
+        db.session.execute(text(
+            "CREATE TABLE IF NOT EXISTS product_search ("
+            " product_id INTEGER PRIMARY KEY REFERENCES products(id) ON DELETE CASCADE,"
+            " document TSVECTOR NOT NULL)"
+        ))
+        db.session.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_product_search_document "
+            "ON product_search USING GIN (document)"
+        ))
+    else:
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS product_search "
+            "USING fts5(name, description, tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+        ))
+
+    rebuild_search_index()
+    db.session.commit()
+
+
+def _index_statements(where_clause):
+    if _dialect() == 'postgresql':
+        return [
+            "INSERT INTO product_search (product_id, document) "
+            "SELECT id, setweight(to_tsvector('simple', coalesce(name, '')), 'A') || "
+            "setweight(to_tsvector('simple', coalesce(description, '')), 'B') "
+            "FROM products " + where_clause + " "
+            "ON CONFLICT (product_id) DO UPDATE SET document = EXCLUDED.document"
+        ]
+    return [
+        "INSERT INTO product_search (rowid, name, description) "
+        "SELECT id, name, coalesce(description, '') FROM products " + where_clause
+    ]
+
+
+def index_products(product_ids):
+    """
+    Add or refresh the search entries for the given products.
+
+    Runs inside the caller's transaction, so it should be called after the
+    product rows are flushed and before the commit.
+    """
+    product_ids = [int(product_id) for product_id in product_ids]
+    if not product_ids or _dialect() not in ('postgresql', 'sqlite'):
+        return
+
+    if _dialect() == 'sqlite':
+        # FTS5 has no upsert, replace the rows instead
+        remove_products_from_index(product_ids)
+
+    for statement in _index_statements("WHERE id IN :ids"):
+        db.session.execute(
+            text(statement).bindparams(bindparam('ids', expanding=True)),
+            {'ids': product_ids}
+        )
+
+
+def remove_products_from_index(product_ids):
+    """Drop the search entries for the given products"""
+    product_ids = [int(product_id) for product_id in product_ids]
+    if not product_ids:
+        return
+
+    dialect = _dialect()
+    if dialect == 'postgresql':
+        statement = "DELETE FROM product_search WHERE product_id IN :ids"
+    elif dialect == 'sqlite':
+        statement = "DELETE FROM product_search WHERE rowid IN :ids"
+    else:
+        return
+
+    db.session.execute(
+        text(statement).bindparams(bindparam('ids', expanding=True)),
+        {'ids': product_ids}
+    )
+
+
+def rebuild_search_index():
+    """Rebuild the whole search index from the products table"""
+    if _dialect() not in ('postgresql', 'sqlite'):
+        return
+
+    db.session.execute(text("DELETE FROM product_search"))
+    for statement in _index_statements(""):
+        db.session.execute(text(statement))
+
+
+def search_rank_subquery(search_query):
+    """
+    Build a subquery of (product_id, rank) for products matching the search.
+
+    Every term is matched as a prefix so partially typed words still hit.
+    Higher rank means a better match. Returns None when the database has no
+    full-text support or the query has no searchable terms.
+    """
+    terms = search_terms(search_query)
+    dialect = _dialect()
+    if not terms or dialect not in ('postgresql', 'sqlite'):
+        return None
+
+    if dialect == 'postgresql':
+        statement = text(
+            "SELECT product_id, ts_rank(document, to_tsquery('simple', :query)) AS rank "
+            "FROM product_search WHERE document @@ to_tsquery('simple', :query)"
+        ).bindparams(query=' & '.join(f'{term}:*' for term in terms))
+    else:
+        # bm25() is lower-is-better, negate it so both backends sort the same way.
+        # Name matches weigh ten times more than description matches.
+        statement = text(
+            "SELECT rowid AS product_id, -bm25(product_search, 10.0, 1.0) AS rank "
+            "FROM product_search WHERE product_search MATCH :query"
+        ).bindparams(query=' '.join(f'"{term}"*' for term in terms))
+
+    return statement.columns(product_id=db.Integer, rank=db.Float).subquery('search_rank')
+
+
+def apply_product_search(query, search_query):
+    """
+    Restrict a Product query to products matching the search.
+
+    Returns:
+        tuple: (filtered query, rank column or None when ranking is unavailable)
+    """
+    ranked = search_rank_subquery(search_query)
+
+    if ranked is None:
+        pattern = f'%{search_query.strip()}%'
+        return query.filter(Product.name.ilike(pattern) | Product.description.ilike(pattern)), None
+
+    return query.join(ranked, ranked.c.product_id == Product.id), ranked.c.rank
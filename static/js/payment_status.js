@@ -0,0 +1,48 @@
+/*
+ * Poll a payment's status endpoint (/api/payment/status/<order_id>) until the
+ * attempt settles, backing off from 2 to 5 seconds between requests.
+ *
+ *   pollPaymentStatus(statusUrl, {
+ *       onPending: function (status) {},    // every answer while still pending
+ *       onSucceeded: function (status) {},  // default: go to status.redirect_url
+ *       onFailed: function (status) {},     // status.message, status.retry_url
+ *       onTimeout: function () {}           // gave up after `timeout` ms
+ *   });
+ *
+ * Used by payment_pending.html, and by any page that starts a payment through
+ * /payment/process/<order_id> and gets its status_url back.
+ */
+function pollPaymentStatus(statusUrl, handlers, timeout) {
+    handlers = handlers || {};
+    timeout = timeout || 3 * 60 * 1000;
+    var started = Date.now();
+    var delay = 2000;
+
+    function schedule() {
+        if (Date.now() - started > timeout) {
+            if (handlers.onTimeout) handlers.onTimeout();
+            return;
+        }
+        setTimeout(poll, delay);
+        delay = Math.min(delay + 1000, 5000);
+    }
+
+    function poll() {
+        fetch(statusUrl, {credentials: 'same-origin', headers: {'Accept': 'application/json'}})
+            .then(function (response) { return response.json(); })
+            .then(function (status) {
+                if (status.status === 'succeeded') {
+                    if (handlers.onSucceeded) handlers.onSucceeded(status);
+                    else if (status.redirect_url) window.location = status.redirect_url;
+                } else if (status.status === 'failed') {
+                    if (handlers.onFailed) handlers.onFailed(status);
+                } else {
+                    if (handlers.onPending) handlers.onPending(status);
+                    schedule();
+                }
+            })
+            .catch(schedule);  // network blip: keep trying until the timeout
+    }
+
+    poll();
+}
@@ -0,0 +1,227 @@
+"""
+Search-as-you-type suggestions
+
+Each worker keeps a sorted array of (term, position, entry) keys over product
+names, product slugs and category names. A lookup is a bisect to the first
+key starting with the typed prefix followed by a short forward scan, so it
+never touches the database. Product writes patch the affected entries in
+place; the whole index is reloaded when it gets older than max_age so writes
+made by other workers are picked up.
+"""
+import re
+import threading
+import time
+from bisect import bisect_left, insort
+from collections import namedtuple
+
+from app import app, db
+from catalog_events import on_products_changed
+
+Suggestion = namedtuple('Suggestion', ['kind', 'id', 'label', 'slug', 'score'])
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+# Above this many changed products a full reload is cheaper than patching
+MAX_INCREMENTAL_UPDATE = 500
+
+
+def normalize(text):
+    """Lowercase words joined by single spaces"""
+    return ' '.join(_WORD_RE.findall((text or '').lower()))
+
+
+def _entry_terms(suggestion):
+    """Index terms for an entry: the label from every word onwards, plus the slug"""
+    words = normalize(suggestion.label).split()
+    terms = {(' '.join(words[position:]), position) for position in range(len(words))}
+    if suggestion.slug:
+        terms.add((normalize(suggestion.slug.replace('-', ' ')), 0))
+    return terms
+
+
+class PrefixIndex:
+    """Sorted-array prefix index of suggestions"""
+
+    def __init__(self, max_candidates=64, max_scan=500):
+        self.max_candidates = max_candidates
+        self.max_scan = max_scan
+        self._lock = threading.RLock()
+        self._keys = []  # sorted (term, position, entry_key)
+        self._entries = {}  # entry_key -> Suggestion
+        self._terms = {}  # entry_key -> set of (term, position)
+        self._text = {}  # entry_key -> ' ' + normalized label, for word prefix checks
+
+    def __len__(self):
+        return len(self._entries)
+
+    def build(self, suggestions):
+        """Replace the whole index"""
+        keys, entries, terms, texts = [], {}, {}, {}
+        for suggestion in suggestions:
+            entry_key = (suggestion.kind, suggestion.id)
+            entries[entry_key] = suggestion
+            terms[entry_key] = _entry_terms(suggestion)
+            texts[entry_key] = ' ' + normalize(suggestion.label)
+            keys.extend((term, position, entry_key) for term, position in terms[entry_key])
+        keys.sort()
+
+        with self._lock:
+            self._keys, self._entries, self._terms, self._text = keys, entries, terms, texts
+
+    def remove(self, kind, entry_id):
+        entry_key = (kind, entry_id)
+        with self._lock:
+            self._entries.pop(entry_key, None)
+            self._text.pop(entry_key, None)
+            for term, position in self._terms.pop(entry_key, ()):
+                index = bisect_left(self._keys, (term, position, entry_key))
+                if index < len(self._keys) and self._keys[index] == (term, position, entry_key):
+                    del self._keys[index]
+
+    def upsert(self, suggestion):
+        entry_key = (suggestion.kind, suggestion.id)
+        with self._lock:
+            self.remove(suggestion.kind, suggestion.id)
+            self._entries[entry_key] = suggestion
+            self._terms[entry_key] = _entry_terms(suggestion)
+            self._text[entry_key] = ' ' + normalize(suggestion.label)
+            for term, position in self._terms[entry_key]:
+                insort(self._keys, (term, position, entry_key))
+
+    def _range(self, prefix):
+        """Slice bounds of the keys starting with prefix"""
+        start = bisect_left(self._keys, (prefix,))
+        end = bisect_left(self._keys, (prefix[:-1] + chr(ord(prefix[-1]) + 1),))
+        return start, end
+
+    def lookup(self, query, limit=8):
+        """
+        Best suggestions for a partially typed query.
+
+        The whole query is matched as a phrase prefix at any word of the label.
+        If that finds too little, the typed word with the fewest keys is
+        scanned and entries are kept when every other typed word prefixes one
+        of their words. Scans are bounded, so very short prefixes rank only
+        the first matches in key order.
+        """
+        prefix = normalize(query)
+        if not prefix:
+            return []
+
+        with self._lock:
+            matches = {}
+            start, end = self._range(prefix)
+            for term, position, entry_key in self._keys[start:min(end, start + self.max_scan)]:
+                if position < matches.get(entry_key, position + 1):
+                    matches[entry_key] = position
+                    if len(matches) >= self.max_candidates:
+                        break
+
+            typed = prefix.split()
+            if len(matches) < limit and len(typed) > 1:
+                rarest = min(typed, key=lambda word: self._range(word)[1] - self._range(word)[0])
+                others = [' ' + word for word in typed if word is not rarest]
+                texts = self._text
+                start, end = self._range(rarest)
+                for term, position, entry_key in self._keys[start:min(end, start + self.max_scan)]:
+                    label = texts[entry_key]
+                    for other in others:
+                        if other not in label:
+                            break
+                    else:
+                        matches.setdefault(entry_key, len(typed))
+                        if len(matches) >= self.max_candidates:
+                            break
+
+            entries = self._entries
+            ranked = sorted(
+                matches.items(),
+                key=lambda item: (item[1] > 0, -entries[item[0]].score, entries[item[0]].label)
+            )
+            return [entries[entry_key] for entry_key, position in ranked[:limit]]
+
+
+def product_suggestion(product_id, name, slug, featured, stock):
+    # Featured and in-stock products rank first
+    score = (2 if featured else 0) + (1 if stock and stock > 0 else 0)
+    return Suggestion('product', product_id, name, slug, score)
+
+
+def category_suggestion(category_id, name, slug):
+    return Suggestion('category', category_id, name, slug, 3)
+
+
+class SuggestionService:
+    """Per-worker prefix index kept in sync with the catalog"""
+
+    def __init__(self, max_age=600):
+        self.max_age = max_age
+        self.index = PrefixIndex()
+        self._loaded_at = None
+        self._load_lock = threading.Lock()
+        self.lookups = 0
+        self.reloads = 0
+
+    def _load_products(self, product_ids=None):
+        from models import Product
+
+        query = db.session.query(Product.id, Product.name, Product.slug, Product.featured, Product.stock)
+        if product_ids is not None:
+            query = query.filter(Product.id.in_(product_ids))
+        return [product_suggestion(*row) for row in query]
+
+    def reload(self):
+        """Rebuild the whole index from the database"""
+        from category_cache import category_cache
+
+        suggestions = self._load_products()
+        suggestions += [
+            category_suggestion(category.id, category.name, category.slug)
+            for category in category_cache.all()
+        ]
+        self.index.build(suggestions)
+        self._loaded_at = time.monotonic()
+        self.reloads += 1
+
+    def ensure_loaded(self):
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.max_age:
+            return
+        with self._load_lock:
+            if self._loaded_at is None or time.monotonic() - self._loaded_at >= self.max_age:
+                self.reload()
+
+    def products_changed(self, product_ids):
+        """Patch the entries of written products, or reload for large batches"""
+        if self._loaded_at is None:
+            return
+        if len(product_ids) > MAX_INCREMENTAL_UPDATE:
+            self._loaded_at = None
+            return
+
+        current = {suggestion.id: suggestion for suggestion in self._load_products(product_ids)}
+        for product_id in product_ids:
+            if product_id in current:
+                self.index.upsert(current[product_id])
+            else:
+                self.index.remove('product', product_id)
+
+    def suggest(self, query, limit=8):
+        self.ensure_loaded()
+        self.lookups += 1
+        return self.index.lookup(query, limit)
+
+    def stats(self):
+        return {
+            'entries': len(self.index),
+            'lookups': self.lookups,
+            'reloads': self.reloads,
+            'age_seconds': round(time.monotonic() - self._loaded_at, 1) if self._loaded_at is not None else None,
+        }
+
+
+suggestions = SuggestionService(max_age=app.config.get('SUGGEST_INDEX_MAX_AGE', 600))
+
+
+@on_products_changed
+def _update_suggestions(product_ids):
+    suggestions.products_changed(product_ids)
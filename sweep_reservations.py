@@ -0,0 +1,26 @@
+#!/usr/bin/env python3
+"""
+Delete expired checkout stock holds
+
+Workers sweep expired holds in the background; run this from cron instead
+when STOCK_HOLD_SWEEP_INTERVAL is 0, or to clear a backlog by hand.
+"""
+
+import sys
+
+from app import app, db
+from reservations import sweep_expired_holds
+
+def sweep_reservations(batch_size=1000):
+    """Delete every expired hold, one batch per transaction"""
+    
+    with app.app_context():
+        try:
+            deleted = sweep_expired_holds(batch_size=batch_size)
+            print(f"✅ Deleted {deleted} expired stock holds")
+        except Exception as e:
+            print(f"Error sweeping stock holds: {e}")
+            db.session.rollback()
+
+if __name__ == "__main__":
+    sweep_reservations(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+"""
+Statement-count test for cart pricing, cart writes and order writing
+
+Builds carts of 1, 10 and 150 lines in a scratch database and counts the SQL
+statements cart_pricing needs to price them, cart_service needs to count
+them and to merge a session cart of the same size at login, and
+order_writer needs to turn them into an order. Every cart size must cost the same number of
+statements; a per-item lookup sneaking back in makes the count grow with the
+cart and fails the test. Priced totals must also match the exact Decimal sum
+of the line prices.
+
+Usage:
+    python test_cart_queries.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import os
+import sys
+import tempfile
+from decimal import Decimal
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_cart_queries.db")
+)
+
+from sqlalchemy import event
+
+from app import app, db
+from models import User, Category, Product, Cart, CartItem, PaymentMethod
+from cart_pricing import price_session_cart, price_user_cart
+from order_writer import create_order
+from cart_service import merge_session_cart, refresh_item_counts, session_cart_count, update_user_cart_lines, user_cart_count
+
+# The largest stands in for a B2B order
+CART_SIZES = [1, 10, 150]
+
+# Statements each call may run, whatever the cart size
+EXPECTED_STATEMENTS = {
+    'price_user_cart': 1,
+    'price_user_cart(require_stock=True)': 1,
+    'price_session_cart': 1,
+    'user_cart_count': 1,
+    'session_cart_count': 0,
+    'merge_session_cart': 4,
+    'update_user_cart_lines': 3,
+    'create_order': 6,
+}
+
+
+class StatementCounter:
+    """Count statements sent to the database while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def seed():
+    """Recreate the schema with one customer per cart size and enough products"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    category = Category(name='Solar Panels', slug='solar-panels')
+    db.session.add_all([category, PaymentMethod(name='M-Pesa', code='mpesa', is_active=True)])
+    db.session.flush()
+
+    # Prices with cents, so float arithmetic anywhere in pricing shows up as a wrong total
+    products = [Product(name=f'Panel {i}', slug=f'panel-{i}', price=Decimal('1000.10') + i, stock=100,
+                        category_id=category.id)
+                for i in range(max(CART_SIZES))]
+    db.session.add_all(products)
+
+    users, items = {}, {}
+    for size in CART_SIZES:
+        user = User(username=f'cart{size}', email=f'cart{size}@example.com')
+        user.set_password('Secret123!')
+        db.session.add(user)
+        db.session.flush()
+        cart = Cart(user_id=user.id)
+        db.session.add(cart)
+        db.session.flush()
+        lines = [CartItem(cart_id=cart.id, product_id=product.id, quantity=2) for product in products[:size]]
+        db.session.add_all(lines)
+        refresh_item_counts(cart_ids=[cart.id])
+        users[size] = user.id
+        items[size] = [line.id for line in lines]
+
+    db.session.commit()
+    return users, items, [product.id for product in products]
+
+
+def run_cart_query_checks():
+    with app.app_context():
+        db.engine.echo = False
+        users, items, product_ids = seed()
+        priced = {size: price_user_cart(users[size]) for size in CART_SIZES}
+        counter = StatementCounter(db.engine)
+        failures = 0
+
+        def session_cart(size):
+            return {str(product_id): {'quantity': 2} for product_id in product_ids[:size]}
+
+        # name -> (call under test, quantity in the cart it should leave or report)
+        checks = {
+            'price_user_cart': (lambda size: price_user_cart(users[size]).count, 2),
+            'price_user_cart(require_stock=True)': (
+                lambda size: price_user_cart(users[size], require_stock=True).count, 2),
+            'price_session_cart': (lambda size: price_session_cart(session_cart(size)).count, 2),
+            'user_cart_count': (lambda size: user_cart_count(users[size]), 2),
+            'session_cart_count': (lambda size: session_cart_count(session_cart(size)), 2),
+            # Every line already holds 2, merging the same lines again makes it 4
+            'merge_session_cart': (
+                lambda size: merge_session_cart(users[size], session_cart(size)) and None, 4),
+            'update_user_cart_lines': (
+                lambda size: update_user_cart_lines(users[size], {item_id: 3 for item_id in items[size]}) or None, 3),
+            # Leaves the cart empty
+            'create_order': (lambda size: create_order(
+                priced[size].cart_id, priced[size].lines, user_id=users[size], payment_method_id=1,
+                total_amount=priced[size].total, shipping_address='Moi Avenue', shipping_city='Nairobi',
+                shipping_country='Kenya', shipping_postal_code='00100', contact_phone='0700000000',
+                contact_email='buyer@example.com') and None, 0),
+        }
+
+        for name, (call, per_line) in checks.items():
+            counts = []
+            for size in CART_SIZES:
+                db.session.expunge_all()
+                with counter:
+                    quantity = call(size)
+                counts.append(counter.count)
+                if quantity is None:
+                    quantity = user_cart_count(users[size])
+                db.session.rollback()
+
+                if quantity != size * per_line:
+                    failures += 1
+                    print(f"❌ {name}: {size}-line cart came to quantity {quantity}, expected {size * per_line}")
+
+            if set(counts) == {EXPECTED_STATEMENTS[name]}:
+                print(f"✅ {name}: {counts[0]} statement(s) for carts of {', '.join(map(str, CART_SIZES))} lines")
+            else:
+                failures += 1
+                print(f"❌ {name}: {dict(zip(CART_SIZES, counts))} statements, expected {EXPECTED_STATEMENTS[name]}")
+
+        # Every line holds 2 of a product priced 1000.10 + i (the checks above roll back their writes)
+        wrong_totals = 0
+        for size in CART_SIZES:
+            expected = sum(Decimal('1000.10') + i for i in range(size)) * 2
+            for name, total in (('price_user_cart', price_user_cart(users[size]).total),
+                                ('price_session_cart', price_session_cart(session_cart(size)).total)):
+                if total != expected or not isinstance(total, Decimal):
+                    wrong_totals += 1
+                    print(f"❌ {name}: {size}-line cart totals {total!r}, expected {expected}")
+        if not wrong_totals:
+            print(f"✅ priced totals are exact Decimals for carts of {', '.join(map(str, CART_SIZES))} lines")
+        failures += wrong_totals
+
+        return failures == 0
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_cart_query_checks() else 1)
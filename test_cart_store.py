@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Checks for the anonymous cart store
+
+Round-trips carts through the compact encoding, exercises every configured
+backend (memory and SQLite always, Redis when CART_STORE_TEST_REDIS_URL is
+set) including TTL expiry, and checks that a visitor's session cookie stays
+the same size however many products they add.
+
+Usage:
+    python test_cart_store.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_cart_store.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+
+import main  # registers the routes
+from app import app, db
+from models import Category, Product
+from cart_store import MemoryCartStore, SQLiteCartStore, cart_store_from_url, decode_cart, encode_cart
+
+PRODUCTS = 40
+
+
+def backends():
+    """Fresh instance of every backend we can reach, with a one-second TTL"""
+    path = os.path.join(tempfile.gettempdir(), "mosolar_cart_store_test.db")
+    if os.path.exists(path):
+        os.remove(path)
+    stores = {'memory': MemoryCartStore(ttl=1), 'sqlite': SQLiteCartStore(path, ttl=1)}
+    redis_url = os.environ.get('CART_STORE_TEST_REDIS_URL')
+    if redis_url:
+        stores['redis'] = cart_store_from_url(redis_url, ttl=1)
+    return stores
+
+
+def seed():
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+    category = Category(name='Solar Panels', slug='solar-panels')
+    db.session.add(category)
+    db.session.flush()
+    db.session.add_all(Product(name=f'Panel {i}', slug=f'panel-{i}', price=1000 + i, stock=100,
+                               category_id=category.id) for i in range(PRODUCTS))
+    db.session.commit()
+    return [product.id for product in Product.query.order_by(Product.id)]
+
+
+def run_cart_store_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    cart = {'12': {'quantity': 3}, '7': {'quantity': 1}, '105': {'quantity': 20}}
+    encoded = encode_cart(cart)
+    check(decode_cart(encoded) == cart and decode_cart(encoded.encode()) == cart,
+          f"encoding round-trips ({encoded!r})")
+    check(decode_cart('12:3,junk,:4,9:x') == {'12': {'quantity': 3}}, "malformed pairs are skipped")
+
+    for name, store in backends().items():
+        store.save('visitor', cart)
+        check(store.load('visitor') == cart, f"{name}: saved cart loads back")
+        store.save('visitor', {})
+        check(store.load('visitor') == {}, f"{name}: saving an empty cart deletes it")
+        store.save('visitor', cart)
+        time.sleep(1.2)
+        check(store.load('visitor') == {}, f"{name}: cart expires after its TTL")
+        store.save('stale', cart)
+        time.sleep(1.2)
+        store.purge_expired()
+        check(store.get('stale') is None, f"{name}: purge drops expired carts")
+
+    with app.app_context():
+        db.engine.echo = False
+        product_ids = seed()
+
+    client = app.test_client()
+    sizes = []
+    for count, product_id in enumerate(product_ids, 1):
+        client.post('/cart/add', data={'product_id': product_id, 'quantity': 2})
+        with client.session_transaction() as visitor_session:
+            # A page view would consume the "added to cart" flash
+            visitor_session.pop('_flashes', None)
+            keys = set(visitor_session)
+        # From the second request on, Flask-Login has added its own '_fresh' flag
+        if count in (2, PRODUCTS):
+            sizes.append(len(client.get_cookie('session').value))
+    check('cart_id' in keys and 'cart' not in keys, f"session carries the cart id, not the cart ({', '.join(sorted(keys))})")
+    check(sizes[0] == sizes[1], f"session cookie is {sizes[0]} bytes with 2 products and {sizes[1]} with {PRODUCTS}")
+
+    response = client.get('/api/cart/count')
+    check(response.json == {'count': 2 * PRODUCTS}, f"cart count reads the store ({response.json})")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_cart_store_checks() else 1)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""
+Checks for the per-worker category cache
+
+Seeds a few categories and checks that, once warm, the category list and
+slug/id lookups cost no statements; that a category written through this
+worker's session shows up on the next read; that a write made behind its
+back (another worker, a script) shows up once the cached copy is older than
+CATEGORY_CACHE_MAX_AGE; and that cached categories still offer .products.
+
+Usage:
+    python test_category_cache.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_category_cache.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+# Short enough to wait out below
+os.environ["CATEGORY_CACHE_MAX_AGE"] = "1"
+
+from sqlalchemy import event
+
+from app import app, db
+from category_cache import category_cache
+from models import Category, Product
+
+CATEGORIES = ['Solar Panels', 'Inverters', 'Batteries']
+
+
+class StatementCounter:
+    """Count statements sent to the database while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def seed():
+    """Recreate the schema with a few categories, two panels in the first"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    categories = [Category(name=name, slug=name.lower().replace(' ', '-')) for name in CATEGORIES]
+    db.session.add_all(categories)
+    db.session.flush()
+    db.session.add_all([
+        Product(name=f'Panel {i}', slug=f'panel-{i}', price=15000, stock=5, category_id=categories[0].id)
+        for i in range(2)
+    ])
+    db.session.commit()
+
+
+def run_category_cache_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        seed()
+        counter = StatementCounter(db.engine)
+
+        check(category_cache.max_age == 1, f"CATEGORY_CACHE_MAX_AGE sets the cache age ({category_cache.max_age})")
+
+        listed = category_cache.all()
+        with counter:
+            again = category_cache.all()
+            panels = category_cache.get_by_slug('solar-panels')
+            by_id = category_cache.get(panels.id)
+            missing = category_cache.get_by_slug('wind-turbines')
+        check(counter.count == 0, f"a warm cache answers lists and lookups with no statements ({counter.count})")
+        check([category.name for category in listed] == CATEGORIES and again == listed
+              and by_id == panels and missing is None,
+              "lists and lookups match the categories table")
+
+        check(sorted(product.name for product in panels.products) == ['Panel 0', 'Panel 1'],
+              "a cached category lists its products like Category.products")
+
+        db.session.add(Category(name='Water Heaters', slug='water-heaters'))
+        db.session.commit()
+        check(category_cache.id_for_slug('water-heaters') is not None,
+              "a category written through this worker shows up on the next read")
+
+        # Another worker's write: no session events reach this cache
+        with db.engine.begin() as connection:
+            connection.execute(db.update(Category).where(Category.slug == 'batteries').values(name='Lithium Batteries'))
+        check(category_cache.get_by_slug('batteries').name == 'Batteries',
+              "a write behind the cache's back isn't seen while the copy is fresh")
+        time.sleep(category_cache.max_age + 0.1)
+        check(category_cache.get_by_slug('batteries').name == 'Lithium Batteries',
+              "it is seen once the copy is older than CATEGORY_CACHE_MAX_AGE")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_category_cache_checks() else 1)
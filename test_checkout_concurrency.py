@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""
+Concurrency stress test for checkout
+
+Seeds one hot product with little stock and many buyers who each have it in
+their cart, then has every buyer POST /checkout at once from a thread pool.
+Passes when no stock is oversold: units ordered never exceed the starting
+stock, the stock left is exactly the starting stock minus the units ordered
+and never negative, and every buyer gets either an order or a sold-out
+redirect. Reports checkout throughput and latency.
+
+Usage:
+    python test_checkout_concurrency.py [buyers] [stock] [threads]
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_checkout_concurrency.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+
+from werkzeug.security import generate_password_hash
+
+import main  # registers the routes
+from app import app, db
+from models import User, Category, Product, Cart, CartItem, Order, OrderItem, PaymentMethod
+
+CHECKOUT_FORM = {
+    'shipping_address': 'Moi Avenue',
+    'shipping_city': 'Nairobi',
+    'shipping_country': 'Kenya',
+    'shipping_postal_code': '00100',
+    'contact_phone': '0700000000',
+    'contact_email': 'buyer@example.com',
+}
+
+
+def seed(buyers, stock):
+    """Recreate the schema: a hot product with `stock` units and `buyers` carts holding it"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    payment_method = PaymentMethod(name='M-Pesa', code='mpesa', is_active=True)
+    category = Category(name='Solar Panels', slug='solar-panels')
+    db.session.add_all([payment_method, category])
+    db.session.flush()
+
+    hot = Product(name='Hot Panel', slug='hot-panel', price=15000, stock=stock, category_id=category.id)
+    db.session.add(hot)
+    db.session.flush()
+
+    # One hash for everyone, hashing per buyer would dominate the seeding time
+    password_hash = generate_password_hash('Secret123!')
+    users = [User(username=f'buyer{i}', email=f'buyer{i}@example.com', password_hash=password_hash)
+             for i in range(buyers)]
+    db.session.add_all(users)
+    db.session.flush()
+
+    carts = [Cart(user_id=user.id, item_count=1) for user in users]
+    db.session.add_all(carts)
+    db.session.flush()
+    db.session.add_all(CartItem(cart_id=cart.id, product_id=hot.id, quantity=1) for cart in carts)
+    db.session.commit()
+    return [user.username for user in users], hot.id, payment_method.id
+
+
+def checkout_as(username, payment_method_id):
+    """Log in and place an order. Returns (outcome, seconds spent in POST /checkout)."""
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'Secret123!'})
+
+    started = time.perf_counter()
+    response = client.post('/checkout', data=dict(CHECKOUT_FORM, payment_method_id=payment_method_id))
+    elapsed = time.perf_counter() - started
+
+    location = response.headers.get('Location', '')
+    if response.status_code == 302 and '/payment/' in location:
+        return 'ordered', elapsed
+    if response.status_code == 302 and location.endswith('/cart'):
+        return 'sold out', elapsed
+    return f'error {response.status_code}', elapsed
+
+
+def run_checkout_concurrency(buyers=60, stock=20, threads=8):
+    with app.app_context():
+        db.engine.echo = False
+        print(f"Database: {db.engine.dialect.name}, {buyers} buyers, {stock} in stock, {threads} threads")
+        usernames, product_id, payment_method_id = seed(buyers, stock)
+
+    # The routes print DEBUG lines on every request
+    with redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=threads) as pool:
+        started = time.perf_counter()
+        results = list(pool.map(lambda username: checkout_as(username, payment_method_id), usernames))
+        wall = time.perf_counter() - started
+
+    outcomes = {}
+    for outcome, _ in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    latencies = sorted(elapsed for _, elapsed in results)
+
+    with app.app_context():
+        stock_left = db.session.get(Product, product_id).stock
+        units_ordered = db.session.query(db.func.coalesce(db.func.sum(OrderItem.quantity), 0)) \
+            .filter(OrderItem.product_id == product_id).scalar()
+        orders = Order.query.count()
+
+    print(f"Outcomes: {', '.join(f'{count} {outcome}' for outcome, count in sorted(outcomes.items()))}")
+    print(f"Throughput: {len(results) / wall:.1f} checkouts/s, {outcomes.get('ordered', 0) / wall:.1f} orders/s")
+    print(f"Latency: p50 {statistics.median(latencies) * 1000:.1f} ms, "
+          f"p95 {latencies[int(len(latencies) * 0.95) - 1] * 1000:.1f} ms")
+
+    failures = 0
+    checks = [
+        (units_ordered <= stock, f"ordered {units_ordered} of {stock} units, no oversell"),
+        (stock_left == stock - units_ordered, f"stock left {stock_left} = {stock} - {units_ordered} ordered"),
+        (stock_left >= 0, "stock never goes negative"),
+        (orders == outcomes.get('ordered', 0), f"{orders} orders written for {outcomes.get('ordered', 0)} successes"),
+        (set(outcomes) <= {'ordered', 'sold out'}, "every buyer got an order or a sold-out redirect"),
+        (units_ordered == min(stock, buyers), f"all {min(stock, buyers)} sellable units were sold"),
+    ]
+    for passed, message in checks:
+        print(f"{'✅' if passed else '❌'} {message}")
+        failures += not passed
+    return failures == 0
+
+
+if __name__ == "__main__":
+    args = [int(arg) for arg in sys.argv[1:4]]
+    sys.exit(0 if run_checkout_concurrency(*args) else 1)
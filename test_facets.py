@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Checks for the catalog sidebar facets and their cache
+
+Seeds two categories of products at known prices and stock levels, then
+checks that the grouped facet statement counts them correctly, that
+searches matching different products get different counts (including a
+query with no index terms, which the listing matches with ILIKE), and that
+repeated filter sets are served from the cache without touching the
+database until products are written.
+
+Usage:
+    python test_facets.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import os
+import sys
+import tempfile
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_facets.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+from sqlalchemy import event
+
+import main  # registers the routes
+from app import app, db
+from catalog_events import products_changed
+from category_cache import category_cache
+from facets import PRICE_BUCKETS, FacetCache, compute_facets, facet_cache
+from models import Category, Product
+from search import ensure_search_index, rebuild_search_index
+
+# (name, category slug, price, stock)
+PRODUCTS = [
+    ('Solar Panel 100W', 'panels', 4500, 10),
+    ('Solar Panel 300W', 'panels', 15000, 0),
+    ('Solar Panel 550W!!!', 'panels', 28000, 4),
+    ('Hybrid Inverter 3kVA', 'inverters', 45000, 2),
+    ('Hybrid Inverter 5kVA!!!', 'inverters', 85000, 0),
+    ('Hybrid Inverter 10kVA', 'inverters', 150000, 1),
+]
+
+
+class StatementCounter:
+    """Count statements sent to the database while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def seed():
+    """Recreate the schema with the products above, searchable"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+    ensure_search_index()
+
+    categories = {slug: Category(name=slug.title(), slug=slug) for slug in ('panels', 'inverters')}
+    db.session.add_all(categories.values())
+    db.session.flush()
+    db.session.add_all([
+        Product(name=name, slug=name.lower().replace(' ', '-').strip('!'), price=price, stock=stock,
+                category_id=categories[slug].id)
+        for name, slug, price, stock in PRODUCTS
+    ])
+    db.session.flush()
+    rebuild_search_index()
+    db.session.commit()
+    return {slug: category.id for slug, category in categories.items()}
+
+
+def expected_facets(match, category_id=None, category_ids=None):
+    """Facet counts worked out in Python for the products match() accepts"""
+    matching = [(category_ids[slug], price, stock) for name, slug, price, stock in PRODUCTS if match(name)]
+    selected = [row for row in matching if category_id is None or row[0] == category_id]
+    return {
+        'total': len(selected),
+        'categories': {cid: sum(row[0] == cid for row in matching) for cid in category_ids.values()},
+        'in_stock': sum(stock > 0 for _, _, stock in selected),
+        'price_buckets': [sum(low <= price and (high is None or price < high) for _, price, _ in selected)
+                          for low, high in PRICE_BUCKETS],
+    }
+
+
+def shape(facets):
+    """The parts of a facets dict expected_facets() produces"""
+    return {
+        'total': facets['total'],
+        'categories': {category['id']: category['count'] for category in facets['categories']},
+        'in_stock': facets['in_stock'],
+        'price_buckets': [bucket['count'] for bucket in facets['price_buckets']],
+    }
+
+
+def run_facet_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        category_ids = seed()
+        counter = StatementCounter(db.engine)
+        category_cache.all()  # the sidebar's category names come from the warm category cache
+
+        def expect(match, category_id=None):
+            return expected_facets(match, category_id, category_ids)
+
+        with counter:
+            everything = compute_facets()
+        check(counter.count == 1, f"facets come from one statement ({counter.count})")
+        check(shape(everything) == expect(lambda name: True), "catalog-wide counts are right")
+        check(shape(compute_facets(category_id=category_ids['inverters']))
+              == expect(lambda name: True, category_ids['inverters']),
+              "in-stock and price counts follow the selected category")
+        check(shape(compute_facets(search_query='panel')) == expect(lambda name: 'Panel' in name),
+              "a search counts only its matches")
+
+        cache = FacetCache()
+        panels, inverters = cache.get(search_query='panel'), cache.get(search_query='inverter')
+        check(shape(panels) != shape(inverters) and shape(inverters) == expect(lambda name: 'Inverter' in name),
+              "different searches get different cached counts")
+        check(shape(cache.get(search_query='!!!')) == expect(lambda name: '!!!' in name)
+              and shape(cache.get()) == expect(lambda name: True),
+              "a search with no terms isn't served the no-search counts")
+
+        hits = cache.hits
+        with counter:
+            again = cache.get(search_query='panel')
+            same_terms = cache.get(search_query='  PANEL! ')
+            filtered = cache.get(search_query='panel', category_id=category_ids['panels'])
+        check(counter.count == 0 and cache.hits == hits + 3,
+              f"repeated filter sets are cache hits with no statements ({counter.count} statements)")
+        check(shape(again) == shape(panels) == shape(same_terms) and filtered['total'] == 3,
+              "cached counts match the first answer")
+
+        facet_cache.get(search_query='panel')
+        misses = facet_cache.misses
+        Product.query.filter_by(name='Solar Panel 100W').one().stock = 0
+        db.session.commit()
+        products_changed([Product.query.filter_by(name='Solar Panel 100W').one().id])
+        check(facet_cache.get(search_query='panel')['in_stock'] == 1 and facet_cache.misses == misses + 1,
+              "writing a product drops the cached counts")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_facet_checks() else 1)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Conditional GET checks for the catalog listing and product pages
+
+Fetches /products and a product page as an anonymous visitor, then writes
+products straight to the database the way another worker or a script would,
+without products_changed() reaching this worker's caches, and checks that:
+
+- repeating a request with the ETag it got answers 304
+- a price change answers 200 with a new body
+- deleting a product answers 200 with the product gone from the listing
+- writing a related product changes the product page's ETag and body (the
+  rendered page cache must not hand back the old HTML under the new ETag)
+
+Usage:
+    python test_http_cache.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_http_cache.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+import main  # registers the routes
+from app import app, db
+from models import Category, Product
+from recommendations import related_products_for
+
+PRODUCTS = 10
+
+
+def seed():
+    """Recreate the schema with one category of products"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    category = Category(name='Solar Panels', slug='solar-panels')
+    db.session.add(category)
+    db.session.flush()
+    db.session.add_all([
+        Product(name=f'Panel {i}', slug=f'panel-{i}', price=15000 + i * 100, stock=10, category_id=category.id)
+        for i in range(PRODUCTS)
+    ])
+    db.session.commit()
+
+
+def write(change):
+    """Run change() and commit it behind the app's back: no products_changed() notification"""
+    with app.app_context():
+        change()
+        db.session.commit()
+
+
+def set_price(slug, price):
+    def change():
+        Product.query.filter_by(slug=slug).one().price = price
+    write(change)
+
+
+def run_http_cache_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        seed()
+        related_slug = related_products_for(Product.query.filter_by(slug='panel-0').one())[0].slug
+
+    client = app.test_client()
+
+    def get(url, etag=None):
+        # The routes print DEBUG lines on every request
+        with redirect_stdout(io.StringIO()):
+            return client.get(url, headers={'If-None-Match': etag} if etag else {})
+
+    # Catalog listing
+    first = get('/products')
+    check(first.status_code == 200 and first.headers.get('ETag'), "/products answers 200 with an ETag")
+    check(get('/products', first.headers['ETag']).status_code == 304, "/products repeated with its ETag answers 304")
+
+    set_price('panel-3', 99999)
+    repriced = get('/products', first.headers['ETag'])
+    check(repriced.status_code == 200 and repriced.data != first.data,
+          f"/products after a price change answers 200 with a new body ({repriced.status_code})")
+
+    def delete_panel():
+        db.session.delete(Product.query.filter_by(slug='panel-7').one())
+    write(delete_panel)
+    after_delete = get('/products', repriced.headers['ETag'])
+    check(after_delete.status_code == 200 and b'Panel 7' not in after_delete.data,
+          f"/products after a delete answers 200 without the product ({after_delete.status_code})")
+    check(get('/products', after_delete.headers['ETag']).status_code == 304, "/products settles back to 304")
+
+    # Product page
+    url = '/products/panel-0'
+    page = get(url)
+    check(page.status_code == 200 and page.headers.get('ETag'), f"{url} answers 200 with an ETag")
+    check(get(url, page.headers['ETag']).status_code == 304, f"{url} repeated with its ETag answers 304")
+
+    set_price('panel-0', 12345)
+    repriced = get(url, page.headers['ETag'])
+    check(repriced.status_code == 200 and repriced.data != page.data,
+          f"{url} after its price changed answers 200 with a new body ({repriced.status_code})")
+
+    set_price(related_slug, 54321)
+    related = get(url, repriced.headers['ETag'])
+    check(related.status_code == 200 and related.headers.get('ETag') != repriced.headers['ETag'],
+          f"{url} after {related_slug} changed answers 200 with a new ETag ({related.status_code})")
+    check(related.data != repriced.data and get(url).data == related.data,
+          f"{url} after {related_slug} changed renders a new body, not the cached one")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_http_cache_checks() else 1)
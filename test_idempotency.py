@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+"""
+Checks for idempotent checkout and payment
+
+Submits the same checkout twice in a row and from several threads at once,
+and pays the same order twice, checking that one order and one payment come
+out and that repeats replay the first response. Also checks that the same
+form runs again once the cart has changed or the payment failed, that failed
+requests are not stored, so they can be retried, and that expired keys are
+purged.
+
+Usage:
+    python test_idempotency.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_idempotency.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+os.environ["PAYMENT_GATEWAY"] = "local"
+
+from werkzeug.security import generate_password_hash
+
+import main  # registers the routes
+from app import app, db
+from models import User, Category, Product, Cart, CartItem, Order, PaymentMethod, IdempotencyKey
+from idempotency import REPLAYED_HEADER, purge_expired_keys
+from payment_jobs import local_gateway
+
+CHECKOUT_FORM = {
+    'shipping_address': 'Moi Avenue',
+    'shipping_city': 'Nairobi',
+    'shipping_country': 'Kenya',
+    'shipping_postal_code': '00100',
+    'contact_phone': '0700000000',
+    'contact_email': 'buyer@example.com',
+}
+
+
+def seed(buyers):
+    """Recreate the schema with `buyers` customers, each with one panel in their cart"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    mpesa = PaymentMethod(name='M-Pesa', code='mpesa', is_active=True)
+    card = PaymentMethod(name='Card', code='card', is_active=True)
+    category = Category(name='Solar Panels', slug='solar-panels')
+    db.session.add_all([mpesa, card, category])
+    db.session.flush()
+    product = Product(name='Panel', slug='panel', price=15000, stock=100, category_id=category.id)
+    db.session.add(product)
+    db.session.flush()
+
+    password_hash = generate_password_hash('Secret123!')
+    users = [User(username=f'buyer{i}', email=f'buyer{i}@example.com', password_hash=password_hash)
+             for i in range(buyers)]
+    db.session.add_all(users)
+    db.session.flush()
+    carts = [Cart(user_id=user.id, item_count=1) for user in users]
+    db.session.add_all(carts)
+    db.session.flush()
+    db.session.add_all(CartItem(cart_id=cart.id, product_id=product.id, quantity=1) for cart in carts)
+    db.session.commit()
+    return [user.username for user in users], mpesa.id, card.id
+
+
+def logged_in(username):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': 'Secret123!'})
+    return client
+
+
+def add_panels(username, quantity):
+    """Put a new line in the user's cart, as adding from the product page does"""
+    with app.app_context():
+        cart = Cart.query.join(User).filter(User.username == username).one()
+        product = Product.query.first()
+        db.session.add(CartItem(cart_id=cart.id, product_id=product.id, quantity=quantity))
+        cart.item_count = quantity
+        db.session.commit()
+
+
+def settled(client, order_id, timeout=10):
+    """Poll the status endpoint until the latest attempt settles"""
+    deadline = time.monotonic() + timeout
+    while True:
+        status = client.get(f'/api/payment/status/{order_id}').json
+        if status.get('status') != 'pending' or time.monotonic() > deadline:
+            return status
+        time.sleep(0.05)
+
+
+def orders_for(username):
+    with app.app_context():
+        user = User.query.filter_by(username=username).one()
+        return Order.query.filter_by(user_id=user.id).all()
+
+
+def run_idempotency_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    # Slow enough that repeats land while the first payment is still pending
+    local_gateway.delay = 1.0
+    with app.app_context():
+        db.engine.echo = False
+        usernames, mpesa_id, card_id = seed(2)
+    form = dict(CHECKOUT_FORM, payment_method_id=mpesa_id)
+
+    # The routes print DEBUG lines on every request
+    with redirect_stdout(io.StringIO()):
+        client = logged_in(usernames[0])
+        first = client.post('/checkout', data=form)
+        second = client.post('/checkout', data=form)
+    orders = orders_for(usernames[0])
+    check(len(orders) == 1, f"double-submitted checkout wrote {len(orders)} order(s)")
+    check(second.headers.get(REPLAYED_HEADER) == 'true' and second.status_code == first.status_code
+          and second.headers.get('Location') == first.headers.get('Location'),
+          f"repeat replays the first redirect ({second.headers.get('Location')})")
+
+    add_panels(usernames[0], 2)
+    with redirect_stdout(io.StringIO()):
+        again = client.post('/checkout', data=form)
+    orders = orders_for(usernames[0])
+    check(len(orders) == 2 and REPLAYED_HEADER not in again.headers,
+          f"same checkout form with a changed cart places a new order ({len(orders)} orders)")
+
+    local_gateway.delay = 0
+    order_id = orders[-1].id
+    with redirect_stdout(io.StringIO()):
+        client.post(f'/payment/{order_id}/mpesa', data={'phone_number': '0700000000'})
+        cancelled = settled(client, order_id)
+        calls = local_gateway.calls
+        retried = client.post(f'/payment/{order_id}/mpesa', data={'phone_number': '0700000000'})
+        settled(client, order_id)
+    check(cancelled.get('status') == 'failed' and REPLAYED_HEADER not in retried.headers
+          and local_gateway.calls == calls + 1,
+          f"retrying a cancelled M-Pesa prompt with the same phone calls the gateway again ({calls} -> {local_gateway.calls})")
+
+    with redirect_stdout(io.StringIO()):
+        declined = client.post(f'/payment/process/{order_id}', json={'payment_method_id': mpesa_id,
+                                                                      'phone_number': '0700000000'})
+        settled(client, order_id)
+        calls = local_gateway.calls
+        redeclined = client.post(f'/payment/process/{order_id}', json={'payment_method_id': mpesa_id,
+                                                                        'phone_number': '0700000000'})
+        settled(client, order_id)
+    check(declined.status_code == 202 and REPLAYED_HEADER not in redeclined.headers
+          and redeclined.json.get('attempt_id') != declined.json.get('attempt_id') and local_gateway.calls == calls + 1,
+          "retrying a failed direct payment starts a new attempt")
+    local_gateway.delay = 1.0
+
+    with redirect_stdout(io.StringIO()), ThreadPoolExecutor(max_workers=6) as pool:
+        clients = [logged_in(usernames[1]) for _ in range(6)]
+        responses = list(pool.map(lambda c: c.post('/checkout', data=form), clients))
+    orders = orders_for(usernames[1])
+    locations = {response.headers.get('Location') for response in responses}
+    check(len(orders) == 1, f"six concurrent identical checkouts wrote {len(orders)} order(s)")
+    check(len(locations) == 1, f"every concurrent submission got the same redirect ({len(locations)} distinct)")
+
+    order_id = orders[0].id
+    with redirect_stdout(io.StringIO()):
+        client = logged_in(usernames[1])
+        missing = client.post(f'/payment/process/{order_id}', json={})
+        retried = client.post(f'/payment/process/{order_id}', json={})
+        paid = client.post(f'/payment/process/{order_id}', json={'payment_method_id': card_id})
+        repaid = client.post(f'/payment/process/{order_id}', json={'payment_method_id': card_id})
+    check(missing.status_code == 400 and REPLAYED_HEADER not in retried.headers,
+          "failed payment requests are not stored and run again")
+    check(paid.json.get('success') and repaid.json == paid.json and repaid.headers.get(REPLAYED_HEADER) == 'true',
+          f"repeated payment replays the first result (attempt {repaid.json.get('attempt_id')})")
+
+    with app.app_context():
+        keys = IdempotencyKey.query.count()
+        IdempotencyKey.query.update({'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+        db.session.commit()
+        purged = purge_expired_keys(batch_size=2)
+        check(keys > 0 and purged == keys and IdempotencyKey.query.count() == 0,
+              f"expired keys are purged ({purged} of {keys})")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_idempotency_checks() else 1)
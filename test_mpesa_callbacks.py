@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+Checks for M-Pesa callback ingestion
+
+Posts STK callbacks to /mpesa/callback, including duplicate deliveries and
+junk, and checks that each is stored once and acknowledged straight away,
+that the background worker applies them in batches (paying orders, failing
+cancelled prompts, flagging unknown ones) and that replaying the recorded
+bodies changes nothing.
+
+Usage:
+    python test_mpesa_callbacks.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import json
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_mpesa_callbacks.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ["MPESA_CALLBACK_INTERVAL"] = "0.05"
+
+import main  # registers the routes
+from app import app, db
+from models import User, Order, PaymentAttempt, PaymentMethod, MpesaCallback
+from mpesa_callbacks import callback_worker
+from replay_mpesa_callbacks import replay_payloads
+
+
+def stk_callback(checkout_request_id, result_code=0):
+    return json.dumps({'Body': {'stkCallback': {
+        'MerchantRequestID': '29115-34620561-1',
+        'CheckoutRequestID': checkout_request_id,
+        'ResultCode': result_code,
+        'ResultDesc': 'The service request is processed successfully.' if result_code == 0
+                      else 'Request cancelled by user',
+    }}})
+
+
+def seed():
+    """Two orders waiting on STK attempts and one older order carrying the reference itself"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    payment_method = PaymentMethod(name='M-Pesa', code='mpesa', is_active=True)
+    user = User(username='buyer', email='buyer@example.com', password_hash='x')
+    db.session.add_all([payment_method, user])
+    db.session.flush()
+    orders = [Order(user_id=user.id, payment_method_id=payment_method.id, total_amount=15000,
+                    shipping_address='Moi Avenue', shipping_city='Nairobi', shipping_country='Kenya',
+                    shipping_postal_code='00100', contact_phone='0700000000', contact_email='buyer@example.com',
+                    payment_reference=reference)
+              for reference in ('ws_CO_paid', 'ws_CO_cancelled', 'ws_CO_legacy')]
+    db.session.add_all(orders)
+    db.session.flush()
+    db.session.add_all(PaymentAttempt(order_id=order.id, user_id=user.id, method='mpesa', status='pending',
+                                      reference=order.payment_reference) for order in orders[:2])
+    db.session.commit()
+
+
+def state():
+    with app.app_context():
+        orders = {order.payment_reference: order.status for order in Order.query}
+        attempts = {attempt.reference: attempt.status for attempt in PaymentAttempt.query}
+        outcomes = {callback.checkout_request_id: callback.outcome for callback in MpesaCallback.query}
+        return orders, attempts, outcomes
+
+
+def run_mpesa_callback_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        seed()
+
+    deliveries = [stk_callback('ws_CO_paid'), stk_callback('ws_CO_cancelled', 1032), stk_callback('ws_CO_legacy'),
+                  stk_callback('ws_CO_unknown'), stk_callback('ws_CO_paid')]
+    client = app.test_client()
+    # The callback route prints a DEBUG line per delivery
+    with redirect_stdout(io.StringIO()):
+        responses = [client.post('/mpesa/callback', data=body, content_type='application/json')
+                     for body in deliveries]
+        junk = client.post('/mpesa/callback', data='{"Body": {}}', content_type='application/json')
+
+    check(all(response.json == {'ResultCode': 0, 'ResultDesc': 'Accepted'} for response in responses),
+          "every delivery is acknowledged, duplicates included")
+    check(junk.status_code == 400, "a body that isn't an STK callback is rejected")
+    with app.app_context():
+        stored = MpesaCallback.query.count()
+    check(stored == 4, f"duplicate delivery stored once ({stored} rows for 5 deliveries)")
+
+    deadline = time.monotonic() + 10
+    while callback_worker.applied < 4 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    orders, attempts, outcomes = state()
+    check(callback_worker.applied == 4, f"background worker applied the stored callbacks ({callback_worker.applied})")
+    check(orders['ws_CO_paid'] == 'paid' and attempts['ws_CO_paid'] == 'succeeded',
+          "successful callback settles the attempt and pays the order")
+    check(orders['ws_CO_cancelled'] == 'pending' and attempts['ws_CO_cancelled'] == 'failed',
+          "cancelled prompt fails the attempt and leaves the order payable")
+    check(orders['ws_CO_legacy'] == 'paid', "order without an attempt is found by payment_reference")
+    check(outcomes == {'ws_CO_paid': 'paid', 'ws_CO_cancelled': 'failed', 'ws_CO_legacy': 'paid',
+                       'ws_CO_unknown': 'unmatched'}, f"each callback is stamped with its outcome ({outcomes})")
+
+    with redirect_stdout(io.StringIO()):
+        replay_payloads(deliveries)
+    check(state() == (orders, attempts, outcomes), "replaying the recorded callbacks changes nothing")
+
+    callback_worker.stop()
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_mpesa_callback_checks() else 1)
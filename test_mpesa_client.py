@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Checks for the pooled Daraja client, against fake_daraja.py
+
+Compares STK push latency and connection count with the old pattern of a
+fresh token and fresh connections per push, and checks that the token is
+fetched once and shared (single flight), replaced before expiry and after a
+rejection, that failed GETs are retried with backoff while failed POSTs
+are not, and that timeouts are honoured.
+
+Usage:
+    python test_mpesa_client.py [pushes]
+
+Needs no database or network access beyond 127.0.0.1.
+Exits with status 1 on failure.
+"""
+
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_mpesa_client.db")
+)
+
+import requests
+
+from fake_daraja import FakeDaraja
+from mpesa import STK_PUSH_PATH, TOKEN_PATH, MpesaClient, MpesaError
+
+LATENCY = 0.01
+PHONE = '254712345678'
+
+
+def client_for(daraja, **options):
+    options.setdefault('backoff', 0.05)
+    return MpesaClient('key', 'secret', '174379', 'passkey', 'https://shop.example/mpesa/callback',
+                       base_url=daraja.url, **options)
+
+
+def fresh_push(daraja, client, order_id):
+    """What the old client did: a new token and new connections for every push"""
+    token = requests.get(daraja.url + TOKEN_PATH, auth=('key', 'secret'), timeout=10).json()['access_token']
+    return requests.post(daraja.url + STK_PUSH_PATH, json=client.stk_push_payload(PHONE, 1500, order_id),
+                         headers={'Authorization': f'Bearer {token}'}, timeout=10).json()
+
+
+def timed(pushes, push):
+    latencies = []
+    for order_id in range(pushes):
+        started = time.perf_counter()
+        push(order_id)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return statistics.median(latencies)
+
+
+def run_mpesa_client_checks(pushes=50):
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    daraja = FakeDaraja(latency=LATENCY).start()
+    try:
+        client = client_for(daraja, pool_size=8)
+        fresh_ms = timed(pushes, lambda order_id: fresh_push(daraja, client, order_id))
+        fresh = dict(daraja.counters)
+        daraja.reset_counters()
+        pooled_ms = timed(pushes, lambda order_id: client.initiate_stk_push(PHONE, 1500, order_id))
+        pooled = dict(daraja.counters)
+        print(f"Sequential STK push, p50: {fresh_ms:.1f} ms fresh ({fresh['connections']} connections, "
+              f"{fresh['token_requests']} tokens), {pooled_ms:.1f} ms pooled ({pooled['connections']} connections, "
+              f"{pooled['token_requests']} tokens)")
+        check(pooled['connections'] == 1 and pooled['token_requests'] == 1,
+              f"{pushes} sequential pushes use one connection and one token")
+        check(pooled_ms < fresh_ms, "pooled pushes are faster than fresh ones")
+
+        daraja.reset_counters()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            results = list(pool.map(lambda order_id: client.initiate_stk_push(PHONE, 1500, order_id), range(pushes)))
+        check(all(result['ResponseCode'] == '0' for result in results) and daraja.counters['token_requests'] == 0,
+              f"{pushes} pushes from 8 threads share the cached token")
+        check(daraja.counters['connections'] <= 8,
+              f"concurrent pushes stay within the pool ({daraja.counters['connections']} new connections)")
+
+        daraja.reset_counters()
+        cold = client_for(daraja)
+        barrier = threading.Barrier(16)
+
+        def racing_token(_):
+            barrier.wait()
+            return cold.get_auth_token()
+
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            tokens = set(pool.map(racing_token, range(16)))
+        check(len(tokens) == 1 and daraja.counters['token_requests'] == 1,
+              f"16 threads racing for a token trigger one fetch ({daraja.counters['token_requests']})")
+
+        daraja.token_ttl = 3
+        expiring = client_for(daraja, token_margin=2)
+        expiring.initiate_stk_push(PHONE, 1500, 1)
+        time.sleep(1.2)
+        expiring.initiate_stk_push(PHONE, 1500, 2)
+        check(expiring.token_fetches == 2, "token is replaced before it expires")
+        daraja.token_ttl = 3599
+
+        daraja.expire_tokens()
+        result = client.initiate_stk_push(PHONE, 1500, 3)
+        check(result['ResponseCode'] == '0', "a rejected token is replaced and the push sent again")
+
+        daraja.reset_counters()
+        daraja.fail_next(2)
+        retrying = client_for(daraja)
+        started = time.perf_counter()
+        retrying.get_auth_token()
+        check(daraja.counters['token_requests'] == 3,
+              f"token fetch retried through two 503s with backoff ({(time.perf_counter() - started) * 1000:.0f} ms)")
+
+        daraja.reset_counters()
+        daraja.fail_next(1)
+        try:
+            retrying.initiate_stk_push(PHONE, 1500, 4)
+            refused = False
+        except MpesaError:
+            refused = True
+        check(refused and daraja.counters['stk_requests'] == 1, "a failed STK push is not retried (no double prompt)")
+
+        daraja.latency = 0.5
+        impatient = client_for(daraja, timeout=(1, 0.2), retries=0)
+        started = time.perf_counter()
+        try:
+            impatient.get_auth_token()
+            timed_out = False
+        except MpesaError:
+            timed_out = True
+        elapsed = time.perf_counter() - started
+        check(timed_out and elapsed < 0.45, f"read timeout is honoured ({elapsed * 1000:.0f} ms)")
+    finally:
+        daraja.stop()
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_mpesa_client_checks(*[int(arg) for arg in sys.argv[1:2]]) else 1)
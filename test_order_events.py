@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Checks for the order status state machine and its event log
+
+Walks orders through checkout, payment, delivery and deletion and checks
+that only allowed transitions happen, that each one appends an event in the
+same transaction, that events outlive deleted orders, and that a consumer
+reading with a cursor sees every event once, in order, without stepping
+past ids an open transaction may still commit.
+
+Usage:
+    python test_order_events.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_order_events.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+from werkzeug.security import generate_password_hash
+
+import main  # registers the routes
+from app import app, db
+from models import User, Category, Product, Order, OrderEvent, PaymentAttempt, PaymentMethod
+from order_status import InvalidTransition, events_since, record_created, transition
+from payment_jobs import mark_paid
+
+PASSWORD = 'Secret123!'
+
+
+def seed():
+    """Recreate the schema with a customer, a driver, an admin and four pending orders"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    payment_method = PaymentMethod(name='Card', code='card', is_active=True)
+    category = Category(name='Solar Panels', slug='solar-panels')
+    users = [User(username=role, email=f'{role}@example.com', role=role,
+                  password_hash=generate_password_hash(PASSWORD))
+             for role in ('customer', 'driver', 'admin')]
+    db.session.add_all([payment_method, category] + users)
+    db.session.flush()
+    db.session.add(Product(name='Panel', slug='panel', price=15000, stock=10, category_id=category.id))
+    orders = [Order(user_id=users[0].id, payment_method_id=payment_method.id, total_amount=15000,
+                    shipping_address='Moi Avenue', shipping_city='Nairobi', shipping_country='Kenya',
+                    shipping_postal_code='00100', contact_phone='0700000000', contact_email='customer@example.com')
+              for _ in range(4)]
+    db.session.add_all(orders)
+    db.session.flush()
+    for order in orders:
+        record_created(order.id, order.user_id, actor_id=order.user_id)
+    db.session.commit()
+    return [order.id for order in orders]
+
+
+def logged_in(username):
+    client = app.test_client()
+    client.post('/login', data={'username': username, 'password': PASSWORD})
+    return client
+
+
+def history(order_id):
+    with app.app_context():
+        return [(event.from_status, event.to_status)
+                for event in OrderEvent.query.filter_by(order_id=order_id).order_by(OrderEvent.id)]
+
+
+def run_order_event_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        paid_order, delivered_order, deleted_order, unpaid_order = seed()
+
+        order = db.session.get(Order, paid_order)
+        attempt = PaymentAttempt(order_id=order.id, user_id=order.user_id, method='card', status='pending')
+        db.session.add(attempt)
+        mark_paid(attempt, order, 'TXN-1')
+        db.session.commit()
+        try:
+            transition(order, 'pending')
+            refused = False
+        except InvalidTransition:
+            refused = True
+        db.session.rollback()
+        check(refused and db.session.get(Order, paid_order).status == 'paid', "paid -> pending is refused")
+        check(transition(db.session.get(Order, paid_order), 'paid') is None, "moving to the current status logs nothing")
+        db.session.rollback()
+
+        order = db.session.get(Order, delivered_order)
+        transition(order, 'paid')
+        transition(order, 'shipped', note='installation completed')
+        db.session.commit()
+
+    check(history(paid_order) == [(None, 'pending'), ('pending', 'paid')],
+          f"creation and payment are logged ({history(paid_order)})")
+
+    # The routes print DEBUG lines on every request
+    with redirect_stdout(io.StringIO()):
+        customer, driver, admin = logged_in('customer'), logged_in('driver'), logged_in('admin')
+        early = driver.post('/delivery/comment', data={'order_id': unpaid_order, 'comment': 'Dropped off',
+                                                       'delivery_status': 'delivered'})
+        delivered = driver.post('/delivery/comment', data={'order_id': delivered_order, 'comment': 'Dropped off',
+                                                           'delivery_status': 'delivered'})
+        customer.post(f'/orders/{deleted_order}/delete')
+        forbidden = customer.get('/api/admin/order-events')
+
+    check(early.status_code == 400 and history(unpaid_order) == [(None, 'pending')],
+          "an unpaid order can't be marked delivered")
+    check(delivered.json.get('success') and history(delivered_order)[-1] == ('shipped', 'delivered'),
+          "driver's delivery comment logs shipped -> delivered")
+    with app.app_context():
+        gone = db.session.get(Order, deleted_order) is None
+    check(gone and history(deleted_order) == [(None, 'pending'), ('pending', 'cancelled')],
+          "deleted order leaves its cancellation in the log")
+    check(forbidden.status_code == 403, "customers can't read the event feed")
+
+    with app.app_context():
+        everything = [event.id for event in OrderEvent.query.order_by(OrderEvent.id)]
+    seen, cursor = [], 0
+    with redirect_stdout(io.StringIO()):
+        while True:
+            page = admin.get(f'/api/admin/order-events?after={cursor}&limit=3').json
+            seen += [event['id'] for event in page['events']]
+            if page['cursor'] == cursor:
+                break
+            cursor = page['cursor']
+    check(seen == everything, f"reading with a cursor sees all {len(everything)} events once, in order")
+
+    with app.app_context():
+        late = OrderEvent(id=cursor + 2, order_id=unpaid_order, user_id=1, from_status='pending', to_status='paid')
+        db.session.add(late)
+        db.session.commit()
+        waited = events_since(cursor)
+        late.created_at = datetime.utcnow() - timedelta(seconds=app.config['ORDER_EVENTS_SETTLE'] + 1)
+        db.session.commit()
+        settled = events_since(cursor)
+    check(waited == [], "a fresh event after an id gap is held back while the gap may still commit")
+    check([event.id for event in settled] == [cursor + 2], "once settled, the gap is skipped")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_order_event_checks() else 1)
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+"""
+Checks for the paged customer order history
+
+Seeds a long-standing customer with a few hundred orders of several lines
+each, then checks that a page of history costs a fixed number of statements
+(where loading everything and touching order.items used to cost one per
+order plus one per product), that walking the cursors forwards and back
+visits every order once, newest first, and that the counts agree with the
+orders themselves.
+
+Usage:
+    python test_order_history.py [orders]
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_order_history.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+from flask import request, template_rendered
+from sqlalchemy import event, inspect
+from werkzeug.security import generate_password_hash
+
+import main  # registers the routes
+from app import app, db
+from models import User, Category, Product, Order, OrderItem, PaymentMethod
+from order_history import order_counts, order_history_page
+
+DEFAULT_ORDERS = 300
+LINES_PER_ORDER = 4
+STATUSES = ['delivered'] * 6 + ['shipped', 'paid', 'pending', 'cancelled']
+
+
+class StatementCounter:
+    """Count statements sent to the database while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def seed(orders):
+    """Recreate the schema with one customer holding `orders` orders, several sharing a timestamp"""
+    rng = random.Random(7)
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    payment_method = PaymentMethod(name='M-Pesa', code='mpesa', is_active=True)
+    category = Category(name='Solar Panels', slug='solar-panels')
+    users = [User(username=name, email=f'{name}@example.com', password_hash=generate_password_hash('Secret123!'))
+             for name in ('installer_co', 'neighbour')]
+    db.session.add_all([payment_method, category] + users)
+    db.session.flush()
+    db.session.execute(db.insert(Product), [
+        {'name': f'Panel {i}', 'slug': f'panel-{i}', 'price': 15000, 'stock': 100, 'category_id': category.id}
+        for i in range(60)
+    ])
+    product_ids = [product_id for (product_id,) in db.session.query(Product.id)]
+
+    start = datetime(2022, 1, 1)
+    db.session.execute(db.insert(Order), [
+        {'user_id': users[index % 10 == 9].id, 'payment_method_id': payment_method.id,
+         'status': rng.choice(STATUSES), 'total_amount': rng.randint(5, 500) * 1000,
+         'shipping_address': 'Moi Avenue', 'shipping_city': 'Nairobi', 'shipping_country': 'Kenya',
+         'shipping_postal_code': '00100', 'contact_phone': '0700000000', 'contact_email': 'buyer@example.com',
+         # Every third order shares its timestamp with the previous one, so paging must break ties on id
+         'created_at': start + timedelta(days=index - index // 3)}
+        for index in range(orders + orders // 9)
+    ])
+    db.session.execute(db.insert(OrderItem), [
+        {'order_id': order_id, 'product_id': rng.choice(product_ids), 'quantity': rng.randint(1, 5), 'price': 15000}
+        for (order_id,) in db.session.query(Order.id)
+        for _ in range(LINES_PER_ORDER)
+    ])
+    db.session.commit()
+    return users[0].id
+
+
+def touch_lines(orders):
+    """What the templates do with each order: read its lines and their products"""
+    return sum(item.quantity for order in orders for item in order.items if item.product.name)
+
+
+def walk(fetch):
+    """Follow next cursors to the end, then prev cursors back. Returns (ids forwards, ids backwards)."""
+    forwards, pages = [], []
+    page = fetch(None)
+    while True:
+        pages.append(page)
+        forwards += [row.id for row in page.items]
+        if not page.has_next:
+            break
+        page = fetch(page.next_cursor)
+
+    backwards = [row.id for row in page.items]
+    while page.has_prev:
+        page = fetch(page.prev_cursor)
+        backwards = [row.id for row in page.items] + backwards
+    return forwards, backwards
+
+
+def run_order_history_checks(orders=DEFAULT_ORDERS):
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        user_id = seed(orders)
+        expected = [order_id for (order_id,) in db.session.query(Order.id).filter(Order.user_id == user_id)
+                    .order_by(Order.created_at.desc(), Order.id.desc())]
+        counter = StatementCounter(db.engine)
+
+        db.session.expunge_all()
+        started = time.perf_counter()
+        with counter:
+            everything = Order.query.filter_by(user_id=user_id).order_by(Order.created_at.desc()).all()
+            touch_lines(everything)
+        old_ms, old_statements = (time.perf_counter() - started) * 1000, counter.count
+
+        db.session.expunge_all()
+        started = time.perf_counter()
+        with counter:
+            page = order_history_page(user_id)
+            touch_lines(page.items)
+        new_ms, new_statements = (time.perf_counter() - started) * 1000, counter.count
+        print(f"{len(expected)} orders: full history {old_statements} statements, {old_ms:.1f} ms; "
+              f"first page {new_statements} statements, {new_ms:.1f} ms")
+        check(new_statements == 3, f"a page of orders with lines and products takes 3 statements ({new_statements})")
+
+        db.session.expunge_all()
+        with counter:
+            deep = order_history_page(user_id, cursor=order_history_page(user_id, per_page=250).next_cursor)
+            touch_lines(deep.items)
+        check(counter.count == 6, f"a deep page costs the same ({counter.count - 3} statements)")
+
+        forwards, backwards = walk(lambda cursor: order_history_page(user_id, cursor=cursor))
+        check(forwards == expected and backwards == expected,
+              f"paging visits all {len(expected)} orders once, newest first, both ways")
+
+        counts = order_counts(user_id)
+        owned = Order.query.filter_by(user_id=user_id).all()
+        check(counts.total == len(owned) and counts.by_status.get('pending') == sum(o.status == 'pending' for o in owned)
+              and counts.spent == sum(o.total_amount for o in owned if o.status in ('paid', 'shipped', 'delivered')),
+              "counts match the orders")
+
+        check(order_history_page(user_id, cursor='tampered').items[0].id == expected[0],
+              "a bad cursor falls back to the first page")
+
+    rendered = {}
+
+    def remember_context(sender, template, context, **extra):
+        rendered[request.path] = context
+
+    # The routes print DEBUG lines on every request
+    with redirect_stdout(io.StringIO()), template_rendered.connected_to(remember_context, app):
+        client = app.test_client()
+        client.post('/login', data={'username': 'installer_co', 'password': 'Secret123!'})
+        pages = {url: client.get(url) for url in ('/orders', '/profile', '/dashboard/customer')}
+    check(all(response.status_code == 200 for response in pages.values()),
+          f"order pages render ({', '.join(f'{url} {r.status_code}' for url, r in pages.items())})")
+
+    # The templates read order.items, order.payment_method and the shipping fields
+    shown = [order for context in rendered.values()
+             for order in context.get('orders', context.get('customer_orders', []))]
+    check(len(rendered) == 3 and shown and all(
+              isinstance(order, Order) and not {'items', 'payment_method'} & inspect(order).unloaded
+              for order in shown),
+          "order pages get Order models with lines and payment method loaded")
+    check(rendered.get('/profile', {}).get('has_more_orders') is True
+          and rendered.get('/dashboard/customer', {}).get('next_cursor')
+          and rendered.get('/orders', {}).get('order_counts') == counts,
+          "order pages get the paging cursors and counts")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_order_history_checks(*[int(arg) for arg in sys.argv[1:2]]) else 1)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Checks for the rendered page cache
+
+Exercises PageCache directly (least-recently-used eviction at the byte
+budget, expiry, tag invalidation) and through the product page: a second
+anonymous visit is served from the cache, and products_changed() for the
+product or one of its related products drops the page, while other pages
+stay cached.
+
+Usage:
+    python test_page_cache.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import os
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_page_cache.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+import main  # registers the routes
+from app import app, db
+from catalog_events import products_changed
+from models import Category, Product
+from page_cache import PageCache, page_cache
+from recommendations import related_products_for
+
+PAGE = 'x' * 1000
+
+
+def seed():
+    """Recreate the schema with two categories of products"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    categories = [Category(name=name, slug=name.lower()) for name in ('Panels', 'Inverters')]
+    db.session.add_all(categories)
+    db.session.flush()
+    db.session.add_all([
+        Product(name=f'{category.name} {i}', slug=f'{category.slug}-{i}', price=15000 + i, stock=5,
+                category_id=category.id)
+        for category in categories for i in range(5)
+    ])
+    db.session.commit()
+
+
+def run_page_cache_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    # The cache on its own: room for three pages
+    cache = PageCache(max_bytes=3 * sys.getsizeof(PAGE) + 10, max_age=60)
+    for key in 'abc':
+        cache.set(key, PAGE, tags=[f'tag:{key}'])
+    cache.get('a')  # a becomes the most recently used
+    cache.set('d', PAGE)
+    check(cache.get('b') is None and all(cache.get(key) == PAGE for key in 'acd') and cache.evictions == 1,
+          "at capacity the least recently used page is evicted")
+    check(cache.stats()['bytes'] <= cache.max_bytes, "the byte budget holds")
+
+    cache.set('huge', 'x' * 10_000)
+    check(cache.get('huge') is None and cache.get('a') == PAGE, "a page bigger than the budget isn't stored")
+
+    cache.invalidate_tags(['tag:c'])
+    check(cache.get('c') is None and cache.get('a') == PAGE, "invalidating a tag drops only its pages")
+
+    short = PageCache(max_age=0.05)
+    short.set('a', PAGE)
+    time.sleep(0.1)
+    check(short.get('a') is None and short.stats()['entries'] == 0, "pages expire after max_age")
+
+    # Through the product page
+    with app.app_context():
+        db.engine.echo = False
+        seed()
+        product = Product.query.filter_by(slug='panels-0').one()
+        product_id = product.id
+        related_id = related_products_for(product)[0].id
+        other_id = Product.query.filter_by(slug='inverters-0').one().id
+
+    client = app.test_client()
+
+    def visit(slug):
+        # The routes print DEBUG lines on every request
+        with redirect_stdout(io.StringIO()):
+            return client.get(f'/products/{slug}')
+
+    page_cache.clear()
+    visit('panels-0')
+    visit('inverters-0')
+    hits = page_cache.hits
+    visit('panels-0')
+    check(page_cache.hits == hits + 1, "a second anonymous visit is served from the cache")
+
+    with app.app_context():
+        products_changed([related_id])
+    hits, misses = page_cache.hits, page_cache.misses
+    visit('panels-0')
+    visit('inverters-0')
+    check(page_cache.misses == misses + 1 and page_cache.hits == hits + 1,
+          "products_changed() for a related product drops the page and leaves other pages")
+
+    with app.app_context():
+        products_changed([product_id])
+    misses = page_cache.misses
+    visit('panels-0')
+    check(page_cache.misses == misses + 1, "products_changed() for the product itself drops its page")
+
+    with app.app_context():
+        products_changed([other_id])
+    hits = page_cache.hits
+    visit('panels-0')
+    check(page_cache.hits == hits + 1,
+          "writes to unrelated products leave the page cached")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_page_cache_checks() else 1)
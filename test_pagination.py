@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""
+Checks for catalog paging through /api/products
+
+Seeds a small catalog, then walks /api/products by cursor for a keyset sort
+and by page number for a relevance-ranked search (which has no cursor key),
+checking that every matching product comes back exactly once, and that the
+walk counts the listing once rather than on every page until
+products_changed() drops the cached total.
+
+Usage:
+    python test_pagination.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import os
+import sys
+import tempfile
+from contextlib import redirect_stdout
+
+from sqlalchemy import event
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_pagination.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+import main  # registers the routes
+from app import app, db
+from catalog_events import products_changed
+from models import Category, Product
+from pagination import count_cache
+from search import ensure_search_index, rebuild_search_index
+
+PANELS = 20
+INVERTERS = 10
+PER_PAGE = 8
+
+
+class CountStatements:
+    """Count COUNT(*) statements sent to the database while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, conn, cursor, statement, *args):
+        self.count += 'count(*)' in statement.lower()
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def seed():
+    """Recreate the schema with panels and inverters, searchable"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+    ensure_search_index()
+
+    category = Category(name='Solar', slug='solar')
+    db.session.add(category)
+    db.session.flush()
+    db.session.execute(db.insert(Product), [
+        {'name': f'Solar Panel {i:02d}', 'slug': f'solar-panel-{i}', 'price': 15000 + i, 'stock': 5,
+         'category_id': category.id, 'description': 'Monocrystalline panel'}
+        for i in range(PANELS)
+    ] + [
+        {'name': f'Hybrid Inverter {i:02d}', 'slug': f'hybrid-inverter-{i}', 'price': 40000 + i, 'stock': 5,
+         'category_id': category.id, 'description': 'Pure sine wave'}
+        for i in range(INVERTERS)
+    ])
+    rebuild_search_index()
+    db.session.commit()
+
+
+def run_pagination_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        seed()
+        names = sorted(name for (name,) in db.session.query(Product.name))
+
+    client = app.test_client()
+
+    def get(params):
+        # The routes print DEBUG lines on every request
+        with redirect_stdout(io.StringIO()):
+            response = client.get('/api/products', query_string=params)
+        return response.status_code, response.get_json()
+
+    # Keyset sort: follow next_cursor to the end
+    with app.app_context():
+        counter = CountStatements(db.engine)
+        counts_exactly = db.engine.dialect.name != 'postgresql'
+    count_cache.invalidate()
+    seen, cursor, statuses, totals = [], None, set(), set()
+    with counter:
+        while True:
+            status, body = get({'per_page': PER_PAGE, **({'cursor': cursor} if cursor else {})})
+            statuses.add(status)
+            totals.add(body['total'])
+            seen += [product['name'] for product in body['products']]
+            cursor = body['next_cursor']
+            if not cursor:
+                break
+    check(statuses == {200} and seen == names, f"cursor paging visits all {len(names)} products once, in name order")
+    if counts_exactly:
+        check(counter.count == 1 and totals == {len(names)},
+              f"the walk counts the listing once ({counter.count} COUNT statements)")
+
+    with app.app_context():
+        db.session.add(Product(name='Charge Controller 30A', slug='charge-controller-30a', price=4500, stock=5,
+                               category_id=Category.query.one().id))
+        db.session.commit()
+        products_changed([Product.query.filter_by(slug='charge-controller-30a').one().id])
+    status, body = get({'per_page': PER_PAGE})
+    if counts_exactly:
+        check(body['total'] == len(names) + 1, f"products_changed() drops cached totals ({body['total']})")
+
+    # Search without a sort is ranked by relevance and paged by number
+    status, body = get({'search': 'panel', 'per_page': PER_PAGE})
+    check(status == 200 and body['success'], f"/api/products?search=panel answers 200 ({status})")
+    check(body.get('next_cursor') is None and body.get('page') == 1 and body.get('has_next'),
+          "relevance results come without a cursor, as page 1 of several")
+
+    found, page = [], 1
+    while True:
+        status, body = get({'search': 'panel', 'per_page': PER_PAGE, 'page': page})
+        found += [product['name'] for product in body['products']]
+        if status != 200 or not body['has_next']:
+            break
+        page += 1
+    panels = [name for name in names if 'Panel' in name]
+    check(sorted(found) == panels and len(found) == len(set(found)),
+          f"numbered pages visit all {len(panels)} matches once ({len(found)} over {page} pages)")
+
+    status, body = get({'search': 'panel', 'sort': 'price_desc', 'per_page': PER_PAGE})
+    check(status == 200 and body['next_cursor'] and body['products'][0]['name'] == f'Solar Panel {PANELS - 1:02d}',
+          "a search with a keyset sort still pages by cursor")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_pagination_checks() else 1)
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+"""
+Checks for the background payment pipeline
+
+Runs the payment routes against the local stand-in gateway with a slow
+response and checks that the request returns before the gateway does, that
+the status endpoint reports pending and then the outcome (card charges
+settle from the job, M-Pesa pushes from the callback), that a payment in
+flight is not started twice, and that the job queue turns work away once
+full.
+
+Usage:
+    python test_payment_jobs.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import io
+import os
+import sys
+import tempfile
+import threading
+import time
+from contextlib import redirect_stdout
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_payment_jobs.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+os.environ["PAYMENT_GATEWAY"] = "local"
+
+from werkzeug.security import generate_password_hash
+
+import main  # registers the routes
+from app import app, db
+from models import User, Category, Product, Order, PaymentMethod
+from mpesa_callbacks import drain_callbacks
+from payment_jobs import PaymentExecutor, local_gateway
+
+GATEWAY_DELAY = 0.5
+CARD = {'card_number': '4242424242424242', 'expiry': '12/30', 'cvv': '123', 'card_holder': 'Buyer'}
+
+
+def seed(orders):
+    """Recreate the schema with one customer and `orders` pending orders"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    payment_method = PaymentMethod(name='M-Pesa', code='mpesa', is_active=True)
+    category = Category(name='Solar Panels', slug='solar-panels')
+    user = User(username='buyer', email='buyer@example.com', password_hash=generate_password_hash('Secret123!'))
+    db.session.add_all([payment_method, category, user])
+    db.session.flush()
+    db.session.add(Product(name='Panel', slug='panel', price=15000, stock=10, category_id=category.id))
+    db.session.add_all(Order(user_id=user.id, payment_method_id=payment_method.id, total_amount=15000,
+                             shipping_address='Moi Avenue', shipping_city='Nairobi', shipping_country='Kenya',
+                             shipping_postal_code='00100', contact_phone='0700000000',
+                             contact_email='buyer@example.com') for _ in range(orders))
+    db.session.commit()
+    return [order.id for order in Order.query.order_by(Order.id)]
+
+
+def wait_for(client, order_id, timeout=10):
+    """Poll the status endpoint until the attempt settles"""
+    deadline = time.monotonic() + timeout
+    while True:
+        status = client.get(f'/api/payment/status/{order_id}').json
+        if status.get('status') != 'pending' or time.monotonic() > deadline:
+            return status
+        time.sleep(0.05)
+
+
+def order_status(order_id):
+    with app.app_context():
+        return db.session.get(Order, order_id).status
+
+
+def run_payment_job_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    local_gateway.delay = GATEWAY_DELAY
+    with app.app_context():
+        db.engine.echo = False
+        card_order, declined_order, mpesa_order = seed(3)
+
+    # The routes print DEBUG lines on every request
+    with redirect_stdout(io.StringIO()):
+        client = app.test_client()
+        client.post('/login', data={'username': 'buyer', 'password': 'Secret123!'})
+
+        started = time.perf_counter()
+        response = client.post(f'/payment/{card_order}/card', data=CARD)
+        elapsed = time.perf_counter() - started
+        first = client.get(f'/api/payment/status/{card_order}')
+        pending_page = client.get(f'/payment/pending/{card_order}')
+        again = client.post(f'/payment/{card_order}/card', data=dict(CARD, card_holder='Buyer Again'))
+        settled = wait_for(client, card_order)
+        calls = local_gateway.calls
+
+        client.post(f'/payment/{declined_order}/card', data=dict(CARD, card_number='4000000000000002'))
+        declined = wait_for(client, declined_order)
+        declined_page = client.get(f'/payment/pending/{declined_order}')
+
+        client.post(f'/payment/{mpesa_order}/mpesa', data={'phone_number': '254712345678'})
+        time.sleep(GATEWAY_DELAY + 0.5)
+        prompted = client.get(f'/api/payment/status/{mpesa_order}').json
+        with app.app_context():
+            reference = db.session.get(Order, mpesa_order).payment_reference
+        client.post('/mpesa/callback', json={'Body': {'stkCallback': {
+            'MerchantRequestID': '29115-34620561-1', 'CheckoutRequestID': reference,
+            'ResultCode': 0, 'ResultDesc': 'The service request is processed successfully.'}}})
+        with app.app_context():
+            drain_callbacks()
+        confirmed = client.get(f'/api/payment/status/{mpesa_order}').json
+
+    check(response.status_code == 302 and '/payment/pending/' in response.headers.get('Location', ''),
+          f"payment POST redirects to the pending page in {elapsed * 1000:.0f} ms "
+          f"(gateway takes {GATEWAY_DELAY * 1000:.0f} ms)")
+    check(elapsed < GATEWAY_DELAY, "the request doesn't wait for the gateway")
+    check(first.json.get('status') == 'pending' and 'no-store' in first.headers.get('Cache-Control', ''),
+          f"status endpoint reports pending, uncached ({first.headers.get('Cache-Control')})")
+    page = pending_page.get_data(as_text=True)
+    check(pending_page.status_code == 200 and f'/api/payment/status/{card_order}' in page
+          and 'pollPaymentStatus' in page, "pending page renders and polls the status endpoint")
+    check(declined_page.status_code == 200 and 'Try again' in declined_page.get_data(as_text=True),
+          "pending page for a failed attempt offers a retry")
+    check(again.status_code == 302 and calls == 1,
+          "a second payment while one is in flight doesn't call the gateway again")
+    check(settled.get('status') == 'succeeded' and settled.get('redirect_url') and order_status(card_order) == 'paid',
+          "card charge settles from the job and pays the order")
+    check(declined.get('status') == 'failed' and declined.get('retry_url') and order_status(declined_order) == 'pending',
+          f"declined card fails the attempt and leaves the order payable ({declined.get('message')})")
+    check(prompted.get('status') == 'pending' and reference and reference.startswith('ws_CO_'),
+          f"STK push waits for the callback ({prompted.get('message')})")
+    check(confirmed.get('status') == 'succeeded' and order_status(mpesa_order) == 'paid',
+          "M-Pesa callback settles the attempt and pays the order")
+
+    release = threading.Event()
+    executor = PaymentExecutor(workers=1, queue_size=1)
+    accepted = [executor.submit(release.wait) for _ in range(3)]
+    release.set()
+    executor.shutdown()
+    check(accepted == [True, True, False], f"a full queue turns payments away ({accepted})")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_payment_job_checks() else 1)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Query-plan regression test for the hot query patterns
+
+Seeds a scratch database with a large synthetic dataset, then EXPLAINs the
+queries behind the busiest routes and checks that each one is answered from
+the index declared for it in models.py instead of a full table scan.
+
+Usage:
+    python test_query_plans.py [scale]
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 when any plan regresses.
+"""
+
+import json
+import os
+import random
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_query_plans.db")
+)
+
+from sqlalchemy import tuple_
+
+from app import app, db
+from catalog_events import catalog_version
+from models import (User, Category, Product, Order, OrderItem, PaymentMethod, Review, SupportTicket, ChatSession,
+                    ChatMessage, DeliveryComment, InstallationComment, StockReservation)
+
+BASE_ROWS = {
+    'users': 2_000,
+    'products': 20_000,
+    'orders': 50_000,
+    'order_items': 150_000,
+    'reviews': 50_000,
+    'chat_sessions': 2_000,
+    'chat_messages': 50_000,
+    'comments': 20_000,
+    'tickets': 10_000,
+    'reservations': 5_000,
+}
+ORDER_STATUSES = ['delivered'] * 85 + ['shipped'] * 5 + ['paid'] * 5 + ['pending'] * 3 + ['cancelled'] * 2
+TICKET_STATUSES = ['closed'] * 80 + ['resolved'] * 15 + ['open'] * 3 + ['in_progress'] * 2
+
+# Route -> (query, indexes that may serve it)
+HOT_QUERIES = {
+    'my_orders': (
+        lambda: Order.query.filter_by(user_id=7).order_by(Order.created_at.desc()),
+        {'ix_orders_user_created'}),
+    'order history next page': (
+        lambda: Order.query.filter(Order.user_id == 7,
+                                   tuple_(Order.created_at, Order.id) < tuple_(datetime.utcnow(), 10**9))
+        .order_by(Order.created_at.desc(), Order.id.desc()).limit(21),
+        {'ix_orders_user_created'}),
+    'order history lines': (
+        lambda: OrderItem.query.filter(OrderItem.order_id.in_(range(100, 120))),
+        {'ix_order_items_order'}),
+    'admin pending orders': (
+        lambda: Order.query.filter(Order.status == 'pending'),
+        {'ix_orders_status_created'}),
+    'mpesa callback lookup': (
+        lambda: Order.query.filter_by(payment_reference='ws_CO_000123'),
+        {'ix_orders_payment_reference'}),
+    'homepage featured': (
+        lambda: Product.query.filter_by(featured=True).limit(4),
+        {'ix_products_featured'}),
+    'category listing by price': (
+        lambda: Product.query.filter_by(category_id=3).order_by(Product.price.asc()).limit(12),
+        {'ix_products_category_price', 'ix_products_in_stock'}),
+    'category price range': (
+        lambda: Product.query.filter(Product.category_id == 3, Product.price.between(5000, 20000)),
+        {'ix_products_category_price', 'ix_products_in_stock'}),
+    'catalog watermark': (
+        lambda: db.session.query(db.func.max(Product.updated_at), catalog_version()),
+        {'ix_products_updated_at'}),
+    'product reviews': (
+        lambda: Review.query.filter_by(product_id=42).order_by(Review.created_at.desc()),
+        {'ix_reviews_product_created'}),
+    'chat history': (
+        lambda: ChatMessage.query.filter_by(session_id=11).order_by(ChatMessage.created_at),
+        {'ix_chat_messages_session_created'}),
+    'delivery comments': (
+        lambda: DeliveryComment.query.filter_by(order_id=99).order_by(DeliveryComment.created_at.desc()),
+        {'ix_delivery_comments_order_created'}),
+    'installation comments': (
+        lambda: InstallationComment.query.filter_by(order_id=99).order_by(InstallationComment.created_at.desc()),
+        {'ix_installation_comments_order_created'}),
+    'helpdesk open tickets': (
+        lambda: SupportTicket.query.filter(SupportTicket.status.in_(['open', 'in_progress']))
+        .order_by(SupportTicket.created_at.desc()).limit(10),
+        {'ix_support_tickets_open', 'ix_support_tickets_status_created'}),
+    'checkout stock holds': (
+        lambda: db.session.query(StockReservation.product_id, db.func.sum(StockReservation.quantity))
+        .filter(StockReservation.product_id.in_([42, 43, 44]), StockReservation.expires_at > datetime.utcnow())
+        .group_by(StockReservation.product_id),
+        {'ix_stock_reservations_product_expires'}),
+}
+
+
+def seed(scale):
+    """Recreate the schema and fill it with synthetic rows"""
+    rng = random.Random(1)
+    counts = {name: count * scale for name, count in BASE_ROWS.items()}
+    now = datetime.utcnow()
+
+    def moment():
+        return now - timedelta(minutes=rng.randint(0, 525_600))
+
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    def insert(model, rows, batch=10_000):
+        for start in range(0, len(rows), batch):
+            db.session.execute(db.insert(model), rows[start:start + batch])
+
+    insert(User, [{'username': f'user{i}', 'email': f'user{i}@example.com', 'password_hash': 'x',
+                   'role': 'customer', 'account_active': True}
+                  for i in range(1, counts['users'] + 1)])
+    insert(PaymentMethod, [{'name': 'M-Pesa', 'code': 'mpesa', 'is_active': True}])
+    insert(Category, [{'name': f'Category {i}', 'slug': f'category-{i}'} for i in range(1, 11)])
+    insert(Product, [{'name': f'Product {i}', 'slug': f'product-{i}', 'price': rng.randint(500, 150000),
+                      'stock': rng.choice([0, 0, rng.randint(1, 80)]), 'featured': rng.random() < 0.01,
+                      'category_id': rng.randint(1, 10), 'created_at': moment(), 'updated_at': moment()}
+                     for i in range(1, counts['products'] + 1)])
+    insert(Order, [{'user_id': rng.randint(1, counts['users']), 'payment_method_id': 1,
+                    'status': rng.choice(ORDER_STATUSES), 'total_amount': rng.randint(500, 300000),
+                    'shipping_address': 'Moi Avenue', 'shipping_city': 'Nairobi', 'shipping_country': 'Kenya',
+                    'shipping_postal_code': '00100', 'contact_phone': '0700000000',
+                    'contact_email': 'buyer@example.com',
+                    'payment_reference': f'ws_CO_{i:06d}' if rng.random() < 0.7 else None,
+                    'created_at': moment()}
+                   for i in range(1, counts['orders'] + 1)])
+    insert(OrderItem, [{'order_id': rng.randint(1, counts['orders']), 'product_id': rng.randint(1, counts['products']),
+                        'quantity': rng.randint(1, 4), 'price': rng.randint(500, 150000)}
+                       for _ in range(counts['order_items'])])
+    insert(Review, [{'product_id': rng.randint(1, counts['products']), 'user_id': rng.randint(1, counts['users']),
+                     'rating': rng.randint(1, 5), 'created_at': moment()}
+                    for _ in range(counts['reviews'])])
+    insert(SupportTicket, [{'user_id': rng.randint(1, counts['users']), 'subject': 'Inverter beeping',
+                            'status': rng.choice(TICKET_STATUSES), 'priority': 'medium', 'created_at': moment()}
+                           for _ in range(counts['tickets'])])
+    insert(ChatSession, [{'session_token': f'chat-{i}', 'is_active': False, 'created_at': moment()}
+                         for i in range(1, counts['chat_sessions'] + 1)])
+    insert(ChatMessage, [{'session_id': rng.randint(1, counts['chat_sessions']), 'message': 'Hello',
+                          'is_staff_message': False, 'is_system_message': False, 'created_at': moment()}
+                         for _ in range(counts['chat_messages'])])
+    insert(DeliveryComment, [{'order_id': rng.randint(1, counts['orders']), 'driver_id': 1, 'comment': 'Delivered',
+                              'delivery_status': 'delivered', 'created_at': moment()}
+                             for _ in range(counts['comments'])])
+    insert(InstallationComment, [{'order_id': rng.randint(1, counts['orders']), 'installer_id': 1,
+                                  'comment': 'Panels mounted', 'installation_status': 'completed',
+                                  'completion_percentage': 100, 'created_at': moment()}
+                                 for _ in range(counts['comments'])])
+    insert(StockReservation, [{'product_id': rng.randint(1, counts['products']),
+                               'user_id': rng.randint(1, counts['users']), 'quantity': rng.randint(1, 3),
+                               'created_at': now, 'expires_at': now + timedelta(minutes=rng.randint(-60, 15))}
+                              for _ in range(counts['reservations'])])
+    db.session.commit()
+    db.session.execute(db.text("ANALYZE"))
+    db.session.commit()
+
+
+def plan_indexes(query):
+    """
+    EXPLAIN a query.
+
+    Returns:
+        tuple: (names of the indexes the plan reads, plan as printable text)
+    """
+    statement = query.statement if hasattr(query, 'statement') else query
+    compiled = statement.compile(dialect=db.engine.dialect, compile_kwargs={'render_postcompile': True})
+    connection = db.session.connection()
+
+    if db.engine.dialect.name == 'postgresql':
+        plan = connection.exec_driver_sql(f'EXPLAIN (FORMAT JSON) {compiled}', compiled.params).scalar()
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+
+        names, nodes = set(), [plan[0]['Plan']]
+        while nodes:
+            node = nodes.pop()
+            if 'Index Name' in node:
+                names.add(node['Index Name'])
+            nodes.extend(node.get('Plans', []))
+        return names, json.dumps(plan[0]['Plan'], indent=2)
+
+    params = tuple(compiled.params[name] for name in compiled.positiontup) if compiled.positiontup else ()
+    rows = connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}', params).fetchall()
+    details = [row[-1] for row in rows]
+    names = {
+        detail.split(' INDEX ', 1)[1].split(' ')[0]
+        for detail in details if ' INDEX ' in detail
+    }
+    return names, '\n'.join(details)
+
+
+def run_plan_checks(scale=1):
+    with app.app_context():
+        db.engine.echo = False
+        print(f"Database: {db.engine.dialect.name}, scale {scale}")
+        seed(scale)
+
+        failures = 0
+        for route, (build_query, expected) in HOT_QUERIES.items():
+            used, plan = plan_indexes(build_query())
+            if used & expected:
+                print(f"✅ {route}: {', '.join(sorted(used & expected))}")
+            else:
+                failures += 1
+                print(f"❌ {route}: expected one of {', '.join(sorted(expected))}")
+                print(plan)
+
+        print(f"\n{len(HOT_QUERIES) - failures}/{len(HOT_QUERIES)} hot queries use their index")
+        return failures == 0
+
+
+if __name__ == "__main__":
+    scale = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    sys.exit(0 if run_plan_checks(scale) else 1)
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Checks for the "frequently bought together" table
+
+Seeds paid orders, folds them in as mark_paid would, and checks that:
+pairs are counted once per order in both directions (an order with the same
+product on two lines included), a large order only pairs its
+MAX_BASKET_PRODUCTS biggest products, the incremental counts equal a full
+rebuild, and related_products_for() orders by those counts before falling
+back to the same category.
+
+Usage:
+    python test_recommendations.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import os
+import sys
+import tempfile
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_recommendations.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+from app import app, db
+from models import User, Category, Product, Order, OrderItem, PaymentMethod, ProductAssociation
+from recommendations import (MAX_BASKET_PRODUCTS, rebuild_copurchase_table, record_order_copurchases,
+                             record_orders_copurchases, related_products_for)
+
+LARGE_ORDER_LINES = 100
+
+
+def seed():
+    """Recreate the schema with a customer and two categories of products"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    payment_method = PaymentMethod(name='M-Pesa', code='mpesa', is_active=True)
+    user = User(username='installer_co', email='installer@example.com', password_hash='x')
+    categories = [Category(name=name, slug=name.lower()) for name in ('Panels', 'Accessories')]
+    db.session.add_all([payment_method, user] + categories)
+    db.session.flush()
+    db.session.execute(db.insert(Product), [
+        {'name': f'{category.name} {i}', 'slug': f'{category.slug}-{i}', 'price': 1000 + i,
+         'stock': 100, 'category_id': category.id}
+        for category in categories for i in range(LARGE_ORDER_LINES // 2 + 5)
+    ])
+    db.session.commit()
+    return user.id, payment_method.id
+
+
+def place_order(user_id, payment_method_id, lines):
+    """A paid order with the given (product_id, quantity, price) lines"""
+    order = Order(user_id=user_id, payment_method_id=payment_method_id, status='paid', total_amount=0,
+                  shipping_address='Moi Avenue', shipping_city='Nairobi', shipping_country='Kenya',
+                  shipping_postal_code='00100', contact_phone='0700000000', contact_email='buyer@example.com')
+    db.session.add(order)
+    db.session.flush()
+    db.session.add_all([OrderItem(order_id=order.id, product_id=product_id, quantity=quantity, price=price)
+                        for product_id, quantity, price in lines])
+    db.session.flush()
+    return order.id
+
+
+def pair_counts():
+    return {(row.product_id, row.related_product_id): row.order_count for row in ProductAssociation.query}
+
+
+def run_recommendation_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        user_id, payment_method_id = seed()
+        ids = [product_id for (product_id,) in db.session.query(Product.id).order_by(Product.id)]
+        a, b, c, d = ids[:4]
+
+        # The same product on two lines still makes one pair per order
+        first = place_order(user_id, payment_method_id, [(a, 1, 1000), (b, 2, 1000), (a, 1, 1000)])
+        record_order_copurchases(first)
+        db.session.commit()
+        check(pair_counts() == {(a, b): 1, (b, a): 1}, "an order's pairs are counted once, both ways")
+
+        others = [place_order(user_id, payment_method_id, [(a, 1, 1000), (b, 1, 1000), (c, 1, 1000)]),
+                  place_order(user_id, payment_method_id, [(a, 1, 1000), (d, 1, 1000)])]
+        record_orders_copurchases(others)
+        db.session.commit()
+        counts = pair_counts()
+        check(counts[(a, b)] == 2 and counts[(a, c)] == 1 and counts[(c, a)] == 1 and counts[(a, d)] == 1
+              and (b, d) not in counts,
+              "a batch of orders adds onto the existing counts")
+
+        # Line value decides which products of a large order are paired
+        large_lines = [(product_id, 1, 100 + index) for index, product_id in enumerate(ids[4:4 + LARGE_ORDER_LINES])]
+        biggest = {product_id for product_id, _, _ in large_lines[-MAX_BASKET_PRODUCTS:]}
+        before = len(pair_counts())
+        record_order_copurchases(place_order(user_id, payment_method_id, large_lines))
+        db.session.commit()
+        counts = pair_counts()
+        new_pairs = [pair for pair in counts if pair[0] in ids[4:]]
+        check(len(counts) - before == MAX_BASKET_PRODUCTS * (MAX_BASKET_PRODUCTS - 1)
+              and {product_id for pair in new_pairs for product_id in pair} == biggest,
+              f"a {LARGE_ORDER_LINES}-line order pairs only its {MAX_BASKET_PRODUCTS} biggest products "
+              f"({len(counts) - before} rows)")
+
+        incremental = pair_counts()
+        orders, pairs = rebuild_copurchase_table()
+        db.session.commit()
+        check(orders == 4 and pairs == len(incremental) and pair_counts() == incremental,
+              "a full rebuild gives the same counts")
+
+        related = [product.id for product in related_products_for(db.session.get(Product, a))]
+        check(related[0] == b and set(related[1:3]) == {c, d} and len(related) == 4
+              and db.session.get(Product, related[3]).category_id == db.session.get(Product, a).category_id,
+              "related products follow the counts, then fill up from the same category")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_recommendation_checks() else 1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Checks for the full-text product search
+
+Seeds a handful of products and checks that searches match the same
+products the old ILIKE scan would for whole words, that every term must
+match (as a prefix), that name matches rank above description matches, that
+a query with no index terms falls back to ILIKE, and that index_products()
+and remove_products_from_index() keep the index in step with product
+writes. benchmark_search.py covers speed; this covers answers.
+
+Usage:
+    python test_search.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import os
+import sys
+import tempfile
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_search.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+from app import app, db
+from models import Category, Product
+from search import (apply_product_search, ensure_search_index, index_products, rebuild_search_index,
+                    remove_products_from_index, search_terms)
+
+# (name, description)
+PRODUCTS = [
+    ('Growatt 5kW Hybrid Inverter', 'Pure sine wave inverter with MPPT charge controller'),
+    ('Must 3kW Off-grid Inverter', 'Backup power for homes'),
+    ('Mo Solar 550W Panel', 'Monocrystalline solar panel'),
+    ('LiFePO4 Battery 200Ah', 'Deep cycle battery, pairs with any hybrid inverter'),
+    ('Flood Light 100W!!!', 'Solar flood light with motion sensor'),
+]
+
+
+def seed():
+    """Recreate the schema with the products above, then create the search index"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    category = Category(name='Solar', slug='solar')
+    db.session.add(category)
+    db.session.flush()
+    db.session.add_all([
+        Product(name=name, description=description, slug=f'product-{index}', price=1000, stock=1,
+                category_id=category.id)
+        for index, (name, description) in enumerate(PRODUCTS)
+    ])
+    db.session.commit()
+    ensure_search_index()  # fills the new index from the products table
+
+
+def search(query):
+    """Names of the products matching a search, best match first"""
+    results, rank = apply_product_search(Product.query, query)
+    if rank is not None:
+        results = results.order_by(rank.desc(), Product.id)
+    return [product.name for product in results.all()]
+
+
+def run_search_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    with app.app_context():
+        db.engine.echo = False
+        seed()
+
+        check(search_terms('  Hybrid, INVERTER-5kW ') == ['hybrid', 'inverter', '5kw'],
+              "queries split into lowercase terms")
+        check(sorted(search('inverter')) == sorted(name for name, description in PRODUCTS
+                                                   if 'inverter' in (name + description).lower()),
+              "a word matches wherever the ILIKE scan found it")
+        check(search('hybrid inverter')[0] == 'Growatt 5kW Hybrid Inverter',
+              "name matches rank above description matches")
+        check(search('hybrid inverter') == ['Growatt 5kW Hybrid Inverter', 'LiFePO4 Battery 200Ah'],
+              "every term has to match")
+        check(search('monocryst') == ['Mo Solar 550W Panel'], "terms match as prefixes")
+        check(search('!!!') == ['Flood Light 100W!!!'], "a query with no terms falls back to ILIKE")
+
+        panel = Product.query.filter_by(slug='product-2').one()
+        panel.name = 'Mo Solar 550W Bifacial Module'
+        db.session.flush()
+        index_products([panel.id])
+        db.session.commit()
+        check(search('bifacial') == ['Mo Solar 550W Bifacial Module'],
+              "index_products() refreshes an edited product")
+
+        battery = Product.query.filter_by(slug='product-3').one()
+        remove_products_from_index([battery.id])
+        db.session.delete(battery)
+        db.session.commit()
+        check('LiFePO4 Battery 200Ah' not in search('hybrid'), "remove_products_from_index() drops a product")
+
+        rebuild_search_index()
+        db.session.commit()
+        check(sorted(search('solar')) == ['Flood Light 100W!!!', 'Mo Solar 550W Bifacial Module'],
+              "a rebuild indexes the products table as it stands")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_search_checks() else 1)
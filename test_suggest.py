@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+Checks for the search-as-you-type prefix index
+
+Checks PrefixIndex lookups (prefixes at any word, ranking, multi-word
+queries) and that the per-worker SuggestionService, once loaded, answers
+without touching the database and follows product adds, renames and
+deletes incrementally through products_changed() instead of reloading.
+benchmark_suggest.py covers speed; this covers answers.
+
+Usage:
+    python test_suggest.py
+
+Uses DATABASE_URL when set, otherwise a throwaway SQLite file in the temp
+directory. Never point this at a production database: it drops every table.
+Exits with status 1 on failure.
+"""
+
+import os
+import sys
+import tempfile
+
+os.environ.setdefault(
+    "DATABASE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "mosolar_suggest.db")
+)
+os.environ.setdefault("CART_STORE_URL", "memory://")
+os.environ.setdefault("STOCK_HOLD_SWEEP_INTERVAL", "0")
+os.environ.setdefault("MPESA_CALLBACK_INTERVAL", "0")
+
+from sqlalchemy import event
+
+from app import app, db
+from catalog_events import products_changed
+from models import Category, Product
+from suggest import (MAX_INCREMENTAL_UPDATE, PrefixIndex, SuggestionService, category_suggestion,
+                     product_suggestion, suggestions)
+
+
+class StatementCounter:
+    """Count statements sent to the database while active"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def _count(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+def labels(results):
+    return [suggestion.label for suggestion in results]
+
+
+def seed():
+    """Recreate the schema with a category and a few products"""
+    db.session.execute(db.text("DROP TABLE IF EXISTS product_search"))
+    db.session.commit()
+    db.drop_all()
+    db.create_all()
+
+    category = Category(name='Inverters', slug='inverters')
+    db.session.add(category)
+    db.session.flush()
+    db.session.add_all([
+        Product(name='Growatt Hybrid Inverter 5kW', slug='growatt-hybrid-5kw', price=85000, stock=3,
+                category_id=category.id),
+        Product(name='Must Off-grid Inverter 3kW', slug='must-3kw', price=45000, stock=0,
+                category_id=category.id),
+    ])
+    db.session.commit()
+    return category.id
+
+
+def run_suggest_checks():
+    failures = []
+
+    def check(condition, message):
+        print(f"{'✅' if condition else '❌'} {message}")
+        if not condition:
+            failures.append(message)
+
+    # The index on its own
+    index = PrefixIndex()
+    index.build([
+        product_suggestion(1, 'Mo Solar 550W Panel', 'mo-solar-550w', False, 5),
+        product_suggestion(2, 'Solar Flood Light 100W', 'flood-light-100w', True, 5),
+        product_suggestion(3, 'Portable Solar Generator', 'portable-generator', False, 0),
+        category_suggestion(10, 'Solar Panels', 'solar-panels'),
+    ])
+    check(labels(index.lookup('sol')) == ['Solar Flood Light 100W', 'Solar Panels', 'Mo Solar 550W Panel',
+                                          'Portable Solar Generator'],
+          "label starts rank first, then featured and in-stock entries")
+    check(labels(index.lookup('flood')) == ['Solar Flood Light 100W'], "prefixes match at any word")
+    check(labels(index.lookup('550w pan')) == ['Mo Solar 550W Panel'], "a phrase prefix matches mid-label")
+    check(labels(index.lookup('generator solar')) == ['Portable Solar Generator'],
+          "words typed out of order still find the entry")
+    check(index.lookup('  ') == [] and index.lookup('inverter') == [], "empty and unmatched queries find nothing")
+
+    index.upsert(product_suggestion(1, 'Mo Solar 550W Bifacial Module', 'mo-solar-550w', False, 5))
+    index.remove('product', 3)
+    check(labels(index.lookup('bifacial')) == ['Mo Solar 550W Bifacial Module']
+          and labels(index.lookup('panel')) == ['Solar Panels'],
+          "upsert replaces an entry's terms")
+    check(index.lookup('generator') == [] and len(index) == 3, "remove drops an entry")
+
+    # The per-worker service, following catalog writes
+    with app.app_context():
+        db.engine.echo = False
+        category_id = seed()
+        service = SuggestionService()
+        counter = StatementCounter(db.engine)
+
+        check(labels(service.suggest('inv')) == ['Inverters', 'Growatt Hybrid Inverter 5kW',
+                                                  'Must Off-grid Inverter 3kW'],
+              "the service loads products and categories")
+        with counter:
+            service.suggest('growatt')
+            service.suggest('must off')
+        check(counter.count == 0 and service.reloads == 1, f"loaded lookups cost no statements ({counter.count})")
+
+        added = Product(name='Felicity Inverter 10kW', slug='felicity-10kw', price=150000, stock=1,
+                        category_id=category_id)
+        db.session.add(added)
+        db.session.commit()
+        service.products_changed([added.id])
+        check(labels(service.suggest('felicity')) == ['Felicity Inverter 10kW'], "an added product is suggested")
+
+        renamed = Product.query.filter_by(slug='must-3kw').one()
+        renamed.name = 'Must PV1800 Inverter 3kW'
+        db.session.commit()
+        service.products_changed([renamed.id])
+        check(labels(service.suggest('pv18')) == ['Must PV1800 Inverter 3kW'] and service.suggest('off grid') == [],
+              "a renamed product is suggested under its new name only")
+
+        deleted_id = Product.query.filter_by(slug='growatt-hybrid-5kw').one().id
+        db.session.delete(db.session.get(Product, deleted_id))
+        db.session.commit()
+        service.products_changed([deleted_id])
+        check(service.suggest('growatt') == [], "a deleted product is no longer suggested")
+        check(service.reloads == 1, "adds, renames and deletes are patched in without a reload")
+
+        service.products_changed(list(range(1, MAX_INCREMENTAL_UPDATE + 2)))
+        service.suggest('inv')
+        check(service.reloads == 2, "a very large batch reloads the index instead")
+
+        suggestions.suggest('inv')
+        felicity = Product.query.filter_by(slug='felicity-10kw').one()
+        felicity.name = 'Felicity IVEM Inverter 10kW'
+        db.session.commit()
+        products_changed([felicity.id])
+        check(labels(suggestions.suggest('ivem')) == ['Felicity IVEM Inverter 10kW'],
+              "products_changed() reaches the shared index")
+
+    return not failures
+
+
+if __name__ == "__main__":
+    sys.exit(0 if run_suggest_checks() else 1)